@@ -0,0 +1,51 @@
+import numpy as np
+import numpy.fft as fft
+
+
+def xcorr(f: np.ndarray, g: np.ndarray, maxlags: int, nfft: int) -> np.ndarray:
+    "`sum(f[..., t] * g[..., t - n] for t in range(n, N))` for lags `n < maxlags`, via FFT"
+    return fft.irfft(fft.rfft(f, nfft) * np.conj(fft.rfft(g, nfft)), nfft)[..., :maxlags]
+
+
+def acf(arr, maxlags=None, axis=-1):
+    """Auto-correlation of each series along `axis`, for lags 0 through `maxlags - 1`.
+
+    Each lag's value is the Pearson correlation between `y[n:]` and `y[:-n]`, i.e., each of the two
+    overlapping segments is centered and scaled by its own mean and standard deviation, same as
+    `np.corrcoef`. NaNs are treated as missing days: a lag only uses pairs of days where both are
+    present. Everything is done with six FFT cross-correlations of the whole (..., time) block, so
+    it's O(N log N) per series instead of O(N^2).
+
+    Returns `(ac, lags)`, with `ac` having lags along its last axis."""
+    y = np.moveaxis(np.asarray(arr, dtype=float), axis, -1)
+    N = y.shape[-1]
+    maxlags = min(maxlags or (N - 1), N)
+    w = np.isfinite(y).astype(float)
+    # Correlations don't care about shifts and scales, but float64 round-off in the FFTs does
+    y = np.where(w > 0, y, 0)
+    mu = (y * w).sum(-1, keepdims=True) / np.maximum(w.sum(-1, keepdims=True), 1)
+    y = (y - mu) * w
+    sigma = np.sqrt((y**2).sum(-1, keepdims=True) / np.maximum(w.sum(-1, keepdims=True), 1))
+    y = y / np.where(sigma > 0, sigma, 1)
+
+    nfft = 1 << (2 * N - 1).bit_length()
+    n = np.round(xcorr(w, w, maxlags, nfft))
+    sa = xcorr(y, w, maxlags, nfft)
+    sb = xcorr(w, y, maxlags, nfft)
+    saa = xcorr(y**2, w, maxlags, nfft)
+    sbb = xcorr(w, y**2, maxlags, nfft)
+    sab = xcorr(y, y, maxlags, nfft)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = sab - sa * sb / n
+        vara, varb = saa - sa**2 / n, sbb - sb**2 / n
+        # A constant segment's variance is round-off, not zero, so it's relative to its sum of
+        # squares, like `rollingcorr.windowCorr`'s
+        ok = (n > 1) & (vara > 1e-10 * saa) & (varb > 1e-10 * sbb)
+        ac = np.where(ok, cov / np.sqrt(np.abs(vara * varb)), np.nan)
+    return np.clip(ac, -1, 1), range(maxlags)
+
+
+def acfSpectrum(ac: np.ndarray, nfft=16 * 1024, fs=365.):
+    "Magnitude spectrum of Hamming-windowed auto-correlations (last axis), and its frequencies"
+    ac = np.nan_to_num(ac)
+    return fft.rfftfreq(nfft, d=1 / fs), np.abs(fft.rfft(np.hamming(ac.shape[-1]) * ac, n=nfft))
@@ -0,0 +1,200 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, 'benchmark-baseline.json')
+DATA_DIR = 'bench-data'
+
+# Synthetic LevelDBs (see `synthdb.py`) to time ingest on
+SCALES = {
+    'small': dict(wikis=2, years=[2016, 2018], topN=20),
+    'medium': dict(wikis=6, years=[2014, 2018], topN=50),
+    'large': dict(wikis=20, years=[2010, 2018], topN=100),
+}
+BENCHES = ['updateDataset', 'groupToDataset', 'ingest']
+
+
+def peakRssMb() -> float:
+    "Peak RSS of this process or its largest finished child (Linux reports kB)"
+    kb = max(resource.getrusage(who).ru_maxrss
+             for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    return kb / 1024
+
+
+def makeDb(scale: str, directory=DATA_DIR) -> str:
+    "The LevelDB for a scale, regenerated only if `SCALES` changed since it was made"
+    import synthdb
+    path = os.path.join(directory, scale)
+    paramsFile = os.path.join(path, 'params.json')
+    params = dict(SCALES[scale], seed=0)
+    if os.path.exists(paramsFile):
+        with open(paramsFile, 'r') as f:
+            if json.load(f)['params'] == params:
+                return os.path.join(path, 'db')
+        shutil.rmtree(path)
+    os.makedirs(path)
+    print('generating', scale, params)
+    made = synthdb.generate(os.path.join(path, 'db'), **params)
+    with open(paramsFile, 'w') as f:
+        json.dump(dict(params=params, **made), f)
+    return os.path.join(path, 'db')
+
+
+def benchUpdateDataset(db) -> dict:
+    "Decode and scatter every non-top-by-edits response, from memory, into fresh Datasets"
+    import leveltoxarray
+    seconds = keys = nbytes = 0
+    for endlang, iterator in leveltoxarray.groupedScan(db):
+        if endlang['endpoint'].find('/top-by-edits/') >= 0:
+            continue
+        items = list(iterator)
+        start = time.perf_counter()
+        ds = leveltoxarray.endpointToDataset(endlang['endpoint'], endlang['language'])
+        for key, value in items:
+            ds = leveltoxarray.growTime(ds, key)
+            leveltoxarray.updateDataset(ds, (key, value))
+        seconds += time.perf_counter() - start
+        keys += len(items)
+        nbytes += sum(len(value) for _, value in items)
+    return dict(seconds=seconds, keys=keys, bytes=nbytes)
+
+
+def benchGroupToDataset(db) -> dict:
+    "Read, decode, and save every (endpoint, wiki) group, one at a time, as a serial ingest does"
+    import leveltoxarray
+    seconds = keys = nbytes = 0
+    for endlang, iterator in leveltoxarray.groupedScan(db):
+        items = list(iterator)
+        start = time.perf_counter()
+        leveltoxarray.groupToDataset((endlang, iter(items)))
+        seconds += time.perf_counter() - start
+        keys += len(items)
+        nbytes += sum(len(value) for _, value in items)
+    return dict(seconds=seconds, keys=keys, bytes=nbytes)
+
+
+def benchIngest(dbPath: str, workers=1) -> dict:
+    "`leveltoxarray.py` end to end, rollups included"
+    with open(os.path.join(os.path.dirname(dbPath), 'params.json'), 'r') as f:
+        made = json.load(f)
+    sys.argv = ['leveltoxarray.py', '--db', dbPath, '-j', str(workers)]
+    start = time.perf_counter()
+    runpy.run_path(os.path.join(HERE, 'leveltoxarray.py'), run_name='__main__')
+    return dict(seconds=time.perf_counter() - start, keys=made['keys'], bytes=made['bytes'])
+
+
+def child(bench: str, dbPath: str, workers: int):
+    "Run one benchmark in an empty scratch directory and print its result as JSON"
+    dbPath = os.path.abspath(dbPath)
+    sys.path.insert(0, HERE)
+    os.chdir(tempfile.mkdtemp(prefix='bench-'))
+    os.mkdir('latest')
+    try:
+        if bench == 'ingest':
+            result = benchIngest(dbPath, workers)
+        else:
+            import plyvel
+            db = plyvel.DB(dbPath, create_if_missing=False)
+            result = (benchUpdateDataset if bench == 'updateDataset' else benchGroupToDataset)(db)
+            db.close()
+    finally:
+        shutil.rmtree(os.getcwd())
+    result.update(
+        keysPerSec=result['keys'] / result['seconds'],
+        mbPerSec=result['bytes'] / 2**20 / result['seconds'],
+        peakRssMb=peakRssMb())
+    print(json.dumps(result))
+
+
+def run(bench: str, dbPath: str, workers=1, repeat=1) -> dict:
+    "Best of `repeat` fresh-process runs (peak RSS is per run, so never mixes benchmarks)"
+    results = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', bench, dbPath, '-j',
+             str(workers)],
+            stdout=subprocess.PIPE,
+            check=True).stdout
+        results.append(json.loads(out.decode('utf8').strip().splitlines()[-1]))
+    return min(results, key=lambda r: r['seconds'])
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    "Regressions: throughput more than `tolerance` below the baseline, or peak RSS that far above"
+    regressions = []
+    for scale, benches in results.items():
+        for bench, r in benches.items():
+            b = baseline.get(scale, {}).get(bench)
+            if b is None:
+                continue
+            if r['keysPerSec'] < b['keysPerSec'] * (1 - tolerance):
+                regressions.append('{} {}: {:.0f} keys/s vs baseline {:.0f}'.format(
+                    scale, bench, r['keysPerSec'], b['keysPerSec']))
+            if r['peakRssMb'] > b['peakRssMb'] * (1 + tolerance):
+                regressions.append('{} {}: peak RSS {:.0f} MB vs baseline {:.0f}'.format(
+                    scale, bench, r['peakRssMb'], b['peakRssMb']))
+    return regressions
+
+
+def report(results: dict, baseline: dict):
+    print('{:8} {:15} {:>8} {:>10} {:>8} {:>9} {:>9}'.format('scale', 'bench', 'keys', 'keys/s',
+                                                           'MB/s', 'peak MB', 'vs base'))
+    for scale, benches in results.items():
+        for bench, r in benches.items():
+            b = baseline.get(scale, {}).get(bench)
+            ratio = '{:.2f}x'.format(r['keysPerSec'] / b['keysPerSec']) if b else '-'
+            print('{:8} {:15} {:8d} {:10.1f} {:8.2f} {:9.1f} {:>9}'.format(
+                scale, bench, r['keys'], r['keysPerSec'], r['mbPerSec'], r['peakRssMb'], ratio))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time ingest on synthetic LevelDBs and compare against a stored baseline')
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=list(SCALES))
+    parser.add_argument('--benches', nargs='+', default=BENCHES, choices=BENCHES)
+    parser.add_argument('-j', '--workers', type=int, default=1, help='for the full ingest')
+    parser.add_argument('--repeat', type=int, default=1, help='keep the best of this many runs')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.25, help='slowdown (fraction) that is a regression')
+    parser.add_argument('--save-baseline', action='store_true', help='record these results as it')
+    parser.add_argument('--data', default=DATA_DIR, help='where to keep the generated LevelDBs')
+    parser.add_argument('--child', nargs=2, metavar=('BENCH', 'DB'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], args.child[1], args.workers)
+        sys.exit()
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE, 'r') as f:
+            baseline = json.load(f)
+    results = {}
+    for scale in args.scales:
+        dbPath = makeDb(scale, args.data)
+        results[scale] = {
+            bench: run(bench, dbPath, args.workers, args.repeat)
+            for bench in args.benches
+        }
+    report(results, baseline)
+
+    if args.save_baseline:
+        for scale, benches in results.items():
+            baseline.setdefault(scale, {}).update(benches)
+        baseline['machine'] = dict(python=platform.python_version(), cpus=os.cpu_count())
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+    else:
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print('REGRESSION', line)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,231 @@
+import plyvel
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import argparse
+import os
+import shutil
+from typing import Dict, List
+import endpoints
+import leveltoxarray as lx
+
+PARQUET_DIR = os.path.join('latest', 'parquet')
+ROW_GROUP = 1 << 18
+
+
+def endpointDirectory(endpointName: str, directory=PARQUET_DIR) -> str:
+    "Hive-style, so Arrow engines see `endpoint` (and `year` under it) as partition columns"
+    return os.path.join(directory, 'endpoint=' + endpointName)
+
+
+def stampDates(stamps: List[bytes]) -> np.ndarray:
+    "Timestamps (`20160101` or `2016-01-01`) as `datetime64[D]`, with arithmetic, not parsing"
+    v = np.array([s.replace(b'-', b'') for s in stamps], dtype=np.int64)
+    months = (v // 10000 - 1970) * 12 + v // 100 % 100 - 1
+    return months.astype('datetime64[M]').astype('datetime64[D]') + (v % 100 - 1)
+
+
+def isTop(endpoint: str) -> bool:
+    return endpoint.find('/top-by-edits/') >= 0
+
+
+def schema(endpoint: str) -> pa.Schema:
+    """One row per day and combination of the endpoint's dimensions (per day, combination, and rank
+    for top-by-edits), with the wiki and every dimension dictionary-encoded"""
+    fields = [
+        pa.field('wiki', pa.dictionary(pa.int32(), pa.string())),
+        pa.field('date', pa.date32())
+    ]
+    fields += [
+        pa.field(dim, pa.dictionary(pa.int8(), pa.string()))
+        for dim in lx.endpointCoords(endpoint)[0][1:]
+    ]
+    if isTop(endpoint):
+        fields += [
+            pa.field('topidx', pa.int8()),
+            pa.field('edits', pa.int64()),
+            pa.field('page_id', pa.int64())
+        ]
+    else:
+        fields.append(pa.field('value', pa.int64()))
+    return pa.schema(fields)
+
+
+def responseRows(endpoint: str, extracted) -> Dict[str, np.ndarray]:
+    """A decoded response's rows, as numpy columns, except its wiki and dimensions: those are
+    constant across a response, so they stay in its URL arguments until `Partition.flush`"""
+    if isTop(endpoint):
+        stamps, counts, edits, pageIds = extracted
+        counts = np.asarray(counts, dtype=np.intp)
+        ranks = np.arange(counts.sum()) - np.repeat(lx.rangeStarts(counts), counts)
+        return dict(
+            date=np.repeat(stampDates(stamps), counts),
+            topidx=ranks.astype(np.int8),
+            edits=np.asarray(edits, dtype=np.int64),
+            page_id=np.asarray(pageIds, dtype=np.int64))
+    stamps, vals = extracted
+    return dict(date=stampDates(stamps), value=np.asarray(vals, dtype=np.int64))
+
+
+class Partition:
+    """One (endpoint, year) partition's Parquet file, written a row group at a time: responses'
+    rows are buffered until there are `rowGroup` of them, then sorted by wiki and date (so each row
+    group's min/max statistics are tight enough for readers to skip it on either) and written."""
+
+    def __init__(self, filename: str, endpoint: str, rowGroup=ROW_GROUP):
+        self.filename = filename
+        self.schema = schema(endpoint)
+        self.dims = lx.endpointCoords(endpoint)[0][1:]
+        self.rowGroup = rowGroup
+        self.writer = None
+        self.chunks = []
+        self.rows = 0
+        self.written = 0
+
+    def add(self, args: Dict[str, str], columns: Dict[str, np.ndarray]):
+        self.chunks.append((args, columns))
+        self.rows += len(columns['date'])
+        if self.rows >= self.rowGroup:
+            self.flush()
+
+    def flush(self):
+        if self.rows == 0:
+            return
+        lengths = [len(columns['date']) for _, columns in self.chunks]
+        labels = dict(endpoints.defaultCombinations)
+        labels['wiki'] = sorted(set(args['project'] for args, _ in self.chunks))
+        codes = {}
+        for name, arg in [('wiki', 'project')] + [(dim, dim) for dim in self.dims]:
+            index = {label: i for i, label in enumerate(labels[name])}
+            codes[name] = np.repeat([index[args[arg]] for args, _ in self.chunks], lengths)
+        plain = {
+            name: np.concatenate([columns[name] for _, columns in self.chunks])
+            for name in self.chunks[0][1]
+        }
+        # `lexsort`'s last key is the primary one: wiki, then date, then dimensions, then rank
+        keys = [codes['wiki'], plain['date']] + [codes[dim] for dim in self.dims]
+        order = np.lexsort(([plain['topidx']] if 'topidx' in plain else []) + keys[::-1])
+        arrays = []
+        for field in self.schema:
+            if field.name in codes:
+                arrays.append(
+                    pa.DictionaryArray.from_arrays(
+                        pa.array(codes[field.name][order], field.type.index_type),
+                        pa.array(labels[field.name], pa.string())))
+            else:
+                arrays.append(pa.array(plain[field.name][order], field.type))
+        table = pa.Table.from_arrays(arrays, schema=self.schema)
+        if self.writer is None:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            self.writer = pq.ParquetWriter(self.filename, self.schema, compression='zstd')
+        self.writer.write_table(table, row_group_size=table.num_rows)
+        self.written += table.num_rows
+        self.chunks = []
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        if self.writer:
+            self.writer.close()
+
+
+def export(db, endpointNames=None, languages=None, directory=PARQUET_DIR, rowGroup=ROW_GROUP,
+           skipErrors=False) -> Dict[str, int]:
+    """Stream the LevelDB's daily responses straight into Parquet, partitioned by endpoint and year
+    (`<directory>/endpoint=<name>/year=<year>/part-0.parquet`), and return each endpoint's rows.
+
+    Nothing dense is built: each response becomes rows as it's decoded, and at most `rowGroup`
+    rows per open partition are buffered (only one endpoint's partitions are open at a time, since
+    the scan visits endpoints in key order). Each endpoint is written to a temporary directory that
+    replaces the old one when done (so exporting some `languages` leaves just those). There's no
+    incremental mode: rerun it."""
+    rows: Dict[str, int] = {}
+    partitions: Dict[int, Partition] = {}
+    current = None
+
+    def finish():
+        for partition in partitions.values():
+            partition.close()
+        final = endpointDirectory(current, directory)
+        if os.path.exists(final):
+            shutil.rmtree(final)
+        if partitions:
+            os.rename(final + '.tmp', final)
+        rows[current] = sum(p.written for p in partitions.values())
+        partitions.clear()
+
+    for endlang, iterator in lx.groupedScan(db, endpointNames, languages):
+        endpoint = endlang['endpoint']
+        name = lx.endpointName(endpoint)
+        if name != current:
+            if current:
+                finish()
+            current = name
+            shutil.rmtree(endpointDirectory(name, directory) + '.tmp', ignore_errors=True)
+        top = isTop(endpoint)
+        for key, value in lx.dailyItems(iterator):
+            try:
+                decoded = lx.decodeResponse(key, value, top)
+            except ValueError as e:
+                if not skipErrors:
+                    raise
+                print('{}, skipping'.format(e))
+                continue
+            if decoded is None:
+                continue
+            args, extracted = decoded
+            columns = responseRows(endpoint, extracted)
+            years = columns['date'].astype('datetime64[Y]').astype(np.int64) + 1970
+            for year in np.unique(years):
+                if year not in partitions:
+                    partitions[year] = Partition(
+                        os.path.join(
+                            endpointDirectory(name, directory) + '.tmp', 'year={}'.format(year),
+                            'part-0.parquet'), endpoint, rowGroup)
+                mine = years == year
+                partitions[year].add(args, {k: v[mine] for k, v in columns.items()})
+    if current:
+        finish()
+    return rows
+
+
+def read(endpointName: str, wikis: List[str] = None, start=None, end=None, columns=None,
+         directory=PARQUET_DIR) -> pd.DataFrame:
+    """An exported endpoint's rows for these wikis and days (`start` to `end`, inclusive), with the
+    filters pushed down: whole years are skipped by partition, and row groups by their wiki and date
+    statistics"""
+    filters = []
+    if wikis:
+        filters.append(('wiki', 'in', list(wikis)))
+    if start:
+        start = pd.Timestamp(start)
+        filters += [('year', '>=', start.year), ('date', '>=', start.date())]
+    if end:
+        end = pd.Timestamp(end)
+        filters += [('year', '<=', end.year), ('date', '<=', end.date())]
+    table = pq.read_table(
+        endpointDirectory(endpointName, directory),
+        columns=columns,
+        filters=filters or None,
+        partitioning='hive')
+    return table.to_pandas()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export the Leveldb as Parquet, partitioned by endpoint and year, for Arrow')
+    parser.add_argument('--db', default='./past-yearly-data', help='Leveldb directory')
+    parser.add_argument('--endpoints', nargs='+', help='only export these, e.g., edits editors')
+    parser.add_argument('--langs', nargs='+', help='only export these wikis, e.g., en.wikipedia')
+    parser.add_argument('--directory', default=PARQUET_DIR)
+    parser.add_argument('--row-group', type=int, default=ROW_GROUP, help='rows per row group')
+    parser.add_argument(
+        '--skip-errors',
+        action='store_true',
+        help='skip responses that fail to decode instead of stopping')
+    args = parser.parse_args()
+    db = plyvel.DB(args.db, create_if_missing=False)
+    rows = export(db, args.endpoints, args.langs, args.directory, args.row_group, args.skip_errors)
+    for name, n in rows.items():
+        print('{}: {} rows'.format(name, n))
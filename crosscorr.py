@@ -0,0 +1,301 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import os
+import shutil
+from typing import List
+import query
+
+CORR_DIR = os.path.join('latest', 'crosscorr')
+WINDOWS = (30, 90, 365)
+
+
+def corrDirectory(endpointName: str, directory=CORR_DIR) -> str:
+    return os.path.join(directory, endpointName)
+
+
+def windowFilename(folder: str, window: int) -> str:
+    return os.path.join(folder, 'w{}.bin'.format(window))
+
+
+def pairs(n: int) -> int:
+    return n * (n - 1) // 2
+
+
+def pairIndex(n: int, i, j):
+    "Where wikis `i < j`'s correlation is in a row of the packed upper triangle (diagonal left out)"
+    return i * n - i * (i + 1) // 2 + j - i - 1
+
+
+def transform(counts: np.ndarray, differences=False) -> np.ndarray:
+    """Log activity (time along axis 0) as float64, or its day-over-day changes with `differences`
+    (which takes out trends every wiki shares), centered on each wiki's mean: correlations ignore
+    shifts, and centering keeps the running cross-products' round-off small"""
+    x = np.log1p(np.maximum(counts, 0).astype(float))
+    if differences:
+        x = np.concatenate([np.zeros_like(x[:1]), np.diff(x, axis=0)])
+    return x - x.mean(0)
+
+
+def rollingMatrices(x: np.ndarray, window: int, ends: np.ndarray, resync=32):
+    """For each of `ends` (ascending row indexes of `x`, time along axis 0 and wikis along axis 1),
+    the correlation matrix of the `window` rows ending there (inclusive), as a float32 packed upper
+    triangle, NaN without a full window or for a wiki that's constant over it.
+
+    The window's sums and cross-products are updated from one end to the next by adding the rows
+    that entered and subtracting the ones that left (two small matrix products, rather than the
+    whole window's), and recomputed from scratch every `resync` ends to keep round-off from
+    accumulating."""
+    n = x.shape[1]
+    upper = np.triu_indices(n, 1)
+    sums = cross = prev = None
+    for k, end in enumerate(ends):
+        lo = end + 1 - window
+        if lo < 0:
+            yield np.full(pairs(n), np.nan, dtype=np.float32)
+            continue
+        if cross is None or k % resync == 0 or end - prev >= window:
+            block = x[lo:end + 1]
+            sums, cross = block.sum(0), block.T @ block
+        else:
+            entered, left = x[prev + 1:end + 1], x[prev + 1 - window:lo]
+            sums += entered.sum(0) - left.sum(0)
+            cross += entered.T @ entered - left.T @ left
+        prev = end
+        cov = cross - np.outer(sums, sums) / window
+        var = np.diag(cov)
+        # Variance lost in the cross-products' round-off (e.g., days before a wiki existed) is none
+        sd = np.where(var > 1e-10 * np.diag(cross), np.sqrt(np.abs(var)), np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = cov[upper] / (sd[upper[0]] * sd[upper[1]])
+        yield np.clip(corr, -1, 1).astype(np.float32)
+
+
+def lastDay(meta: dict) -> pd.Timestamp:
+    return pd.Timestamp(meta['start']) + pd.Timedelta(days=meta['step'] * (meta['rows'] - 1))
+
+
+def loadMeta(folder: str) -> dict:
+    try:
+        with open(os.path.join(folder, 'meta.json'), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def saveMeta(meta: dict, folder: str):
+    filename = os.path.join(folder, 'meta.json')
+    with open(filename + '2', 'w') as f:
+        json.dump(meta, f, sort_keys=True)
+    os.rename(filename + '2', filename)
+
+
+def append(folder: str, meta: dict, x: np.ndarray, ends: np.ndarray, batch=64):
+    "Compute each window's matrices ending on rows `ends` of `x` and append them to its file"
+    for window in meta['windows']:
+        with open(windowFilename(folder, window), 'ab') as f:
+            rows = []
+            for row in rollingMatrices(x, window, ends):
+                rows.append(row)
+                if len(rows) == batch:
+                    f.write(np.stack(rows).tobytes())
+                    rows = []
+            if rows:
+                f.write(np.stack(rows).tobytes())
+
+
+def update(endpointName: str,
+           langs: List[str] = None,
+           windows=WINDOWS,
+           step=7,
+           differences=False,
+           incremental=True,
+           workers=1,
+           dataDirectory='latest',
+           directory=CORR_DIR) -> dict:
+    """Rolling correlation matrices between every pair of wikis' total activity in an endpoint (all
+    its other dimensions summed, through its last real day, see `query.dropEnd`), over each of
+    `windows` days, every `step` days, saved as `w<window>.bin` (float32, one packed upper triangle
+    per row, see `pairIndex`) next to a `meta.json`; `openMatrices` memory-maps them.
+
+    With `incremental`, the last saved row, every row whose window reaches the earliest day whose
+    data changed since (per `query.firstChange` of the `query.sourceSpans` in `meta.json`), and
+    every row after them are recomputed, reading just the data their windows need, and the rest are
+    kept, unless the wikis or parameters changed: then (or without `incremental`) everything is
+    rebuilt in a temporary directory that replaces the old one."""
+    entries = query.catalog(dataDirectory)
+    langs = sorted(entries[endpointName]['langs'] if langs is None else langs)
+    params = dict(
+        endpoint=endpointName,
+        langs=langs,
+        windows=sorted(windows),
+        step=step,
+        differences=differences,
+        dtype='float32',
+        pairs=pairs(len(langs)))
+    sources = query.sourceSpans(endpointName, langs, dataDirectory)
+    folder = corrDirectory(endpointName, directory)
+    meta = loadMeta(folder) if incremental else None
+    if meta and any(meta[k] != v for k, v in params.items()):
+        meta = None
+    reduce = entries[endpointName]['dims'][1:]
+
+    if meta:
+        # Rows before the last saved one whose windows end before any changed day can stay
+        change = query.firstChange(meta.get('sources', {}), sources)
+        changed = lastDay(meta) if change is None else min(lastDay(meta), change)
+        keep = max(0, -(-(changed - pd.Timestamp(meta['start'])).days // step))
+        if keep == 0:
+            meta = None
+
+    if meta:
+        # Drop the rest, and anything written after the last `meta.json` (an update that died
+        # midway), saying so first so a crash in between doesn't leave it promising more rows
+        meta['rows'] = keep
+        saveMeta(meta, folder)
+        for window in meta['windows']:
+            os.truncate(windowFilename(folder, window), keep * meta['pairs'] * 4)
+        first = pd.Timestamp(meta['start']) + pd.Timedelta(days=step * keep)
+        # The first new row's longest window, and the day before it, whose change `differences`
+        # can't know (so it's zero, but outside every window)
+        since = first - pd.Timedelta(days=max(windows))
+        da = query.load(endpointName, langs, slice(since, None), reduce, workers, dataDirectory)
+        da = query.dropEnd(da)
+        time = da.indexes['time']
+        target = folder
+        # Centered on the loaded days' means, not the original run's: correlations don't mind
+        x = transform(da.transpose('time', 'lang').values, differences)
+        ends = np.arange(time.searchsorted(first), len(time), step)
+    else:
+        da = query.load(endpointName, langs, reduce=reduce, workers=workers,
+                        directory=dataDirectory)
+        da = query.dropEnd(da)
+        time = da.indexes['time']
+        target = folder + '.tmp'
+        shutil.rmtree(target, ignore_errors=True)
+        os.makedirs(target)
+        meta = dict(params, start=str(time[0].date()), rows=0)
+        x = transform(da.transpose('time', 'lang').values, differences)
+        ends = np.arange(0, len(time), step)
+
+    append(target, meta, x, ends)
+    meta['rows'] += len(ends)
+    meta['sources'] = sources
+    saveMeta(meta, target)
+    if target != folder:
+        shutil.rmtree(folder, ignore_errors=True)
+        os.rename(target, folder)
+    return meta
+
+
+def openMatrices(endpointName: str, window: int, directory=CORR_DIR) -> xr.DataArray:
+    """A window's saved correlations as a read-only, memory-mapped `(time, pair)` DataArray (`time`
+    being each window's last day), with each pair's two wikis as `lang1` and `lang2` coordinates"""
+    folder = corrDirectory(endpointName, directory)
+    meta = loadMeta(folder)
+    if window not in meta['windows']:
+        raise ValueError('no {}-day window, only {}'.format(window, meta['windows']))
+    data = np.memmap(
+        windowFilename(folder, window),
+        dtype=np.float32,
+        mode='r',
+        shape=(meta['rows'], meta['pairs']))
+    i, j = np.triu_indices(len(meta['langs']), 1)
+    langs = np.array(meta['langs'])
+    return xr.DataArray(
+        data,
+        dims=['time', 'pair'],
+        coords=dict(
+            time=pd.date_range(
+                meta['start'], periods=meta['rows'], freq='{}D'.format(meta['step'])),
+            lang1=('pair', langs[i]),
+            lang2=('pair', langs[j])),
+        name=endpointName)
+
+
+def matrix(endpointName: str, date, window: int, directory=CORR_DIR) -> xr.DataArray:
+    "The full `(lang, lang)` correlation matrix as of `date` (the last saved row on or before it)"
+    da = openMatrices(endpointName, window, directory).sel(time=date, method='ffill')
+    langs = loadMeta(corrDirectory(endpointName, directory))['langs']
+    n = len(langs)
+    full = np.zeros((n, n), dtype=np.float32)
+    i, j = np.triu_indices(n, 1)
+    full[i, j] = full[j, i] = da.values
+    # Like `np.corrcoef`, NaN on the diagonal too for a wiki that's constant over the window (which
+    # has no correlations)
+    full[np.diag_indices(n)] = np.where(np.isfinite(full).sum(1) > 1, 1, np.nan)
+    return xr.DataArray(
+        full, dims=['lang', 'lang2'], coords=dict(lang=langs, lang2=langs, time=da['time']))
+
+
+def topK(endpointName: str, date, window: int, lang: str = None, k=10,
+         directory=CORR_DIR) -> pd.DataFrame:
+    """The `k` most correlated pairs of wikis as of `date`, or with `lang`, the `k` wikis most
+    correlated with it, reading just that one row (or that wiki's `n - 1` cells of it)"""
+    da = openMatrices(endpointName, window, directory)
+    row = da.indexes['time'].get_indexer([pd.Timestamp(date)], method='ffill')[0]
+    if row < 0:
+        raise ValueError('no correlations saved on or before {}'.format(date))
+    if lang is None:
+        values = np.asarray(da.values[row])
+        cells = np.nonzero(np.isfinite(values))[0]
+        cells = cells[np.argsort(-values[cells], kind='stable')[:k]]
+        first, second = da['lang1'].values[cells], da['lang2'].values[cells]
+    else:
+        langs = loadMeta(corrDirectory(endpointName, directory))['langs']
+        n = len(langs)
+        i = langs.index(lang)
+        others = np.delete(np.arange(n), i)
+        cells = pairIndex(n, np.minimum(i, others), np.maximum(i, others))
+        values = np.asarray(da.values[row, cells])
+        order = [m for m in np.argsort(-values, kind='stable') if np.isfinite(values[m])][:k]
+        cells = cells[order]
+        first, second = np.full(len(order), lang), np.array(langs)[others[order]]
+    return pd.DataFrame(
+        dict(
+            date=da.indexes['time'][row],
+            lang1=first,
+            lang2=second,
+            corr=np.asarray(da.values[row, cells])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Precompute rolling correlation matrices between every pair of wikis')
+    parser.add_argument('endpoint', help='e.g., editors')
+    parser.add_argument('--langs', nargs='+', help='only these wikis, e.g., en.wikipedia')
+    parser.add_argument(
+        '--windows', nargs='+', type=int, default=list(WINDOWS), help='window lengths, in days')
+    parser.add_argument('--step', type=int, default=7, help='days between saved matrices')
+    parser.add_argument(
+        '--differences',
+        action='store_true',
+        help="correlate day-over-day changes of log activity instead of its levels")
+    parser.add_argument(
+        '--full', action='store_true', help='rebuild instead of recomputing just what changed')
+    parser.add_argument('--top', help='then print the wikis most correlated with this one')
+    parser.add_argument('--date', help='...as of this day (default: the latest)')
+    parser.add_argument('-k', type=int, default=10, help='how many to print')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='files to read at once')
+    parser.add_argument('--directory', default='latest')
+    args = parser.parse_args()
+    meta = update(
+        args.endpoint,
+        args.langs,
+        args.windows,
+        args.step,
+        args.differences,
+        incremental=not args.full,
+        workers=args.workers,
+        dataDirectory=args.directory,
+        directory=os.path.join(args.directory, 'crosscorr'))
+    print('{}: {} wikis, {} matrices per window, through {}'.format(
+        args.endpoint, len(meta['langs']), meta['rows'], lastDay(meta).date()))
+    date = args.date or pd.Timestamp.max
+    for window in meta['windows']:
+        print('{}-day window:'.format(window))
+        print(
+            topK(args.endpoint, date, window, args.top, args.k,
+                 os.path.join(args.directory, 'crosscorr')).to_string(index=False))
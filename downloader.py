@@ -0,0 +1,238 @@
+import aiohttp
+import asyncio
+import plyvel
+import argparse
+import itertools as it
+import json
+import random
+import re
+import time
+from typing import Iterator, List
+import endpoints
+
+BASE_URL = endpoints.BASE_URL
+USER_AGENT = 'See https://github.com/fasiha/wikiatrisk'
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# See `hourly.py`
+HOURLY_ENDPOINTS = ['pageviews/aggregate', 'unique-devices']
+
+
+def dashToCamelCase(s: str) -> str:
+    return re.sub(r'-(.)', lambda o: o[1].upper(), s)
+
+
+def templateKeys(template: str) -> List[str]:
+    return [dashToCamelCase(s[1:-1]) for s in re.findall(r'{[^}]+}', template)]
+
+
+def templateArgsToUrl(template: str, args: dict) -> str:
+    missing = [key for key in templateKeys(template) if key not in args]
+    if missing:
+        raise ValueError('{} not provided with "{}" key'.format(template, missing[0]))
+    return BASE_URL + re.sub(r'{[^}]+}', lambda o: args[dashToCamelCase(o[0][1:-1])], template)
+
+
+def shortEndpoint(template: str) -> str:
+    "E.g., 'edited-pages/aggregate' or 'unique-devices', what `downloader.ts` calls an endpoint"
+    return '/'.join(s for s in template[:template.index('{')].split('/')[2:4] if s)
+
+
+def endpointYearProjectToUrls(endpoint: str, year: int, project: str,
+                              granularity='daily') -> Iterator[str]:
+    "Every URL `downloader.ts` would fetch for one year of one endpoint for one wiki"
+    templates = [url for url in endpoints.URLS if '/{}/'.format(endpoint) in url]
+    if len(templates) != 1:
+        raise ValueError('{} templates found to match endpoint {}'.format(len(templates), endpoint))
+    template = templates[0]
+    base = dict(project=project, granularity=granularity, start=None, end=None)
+    keys = [key for key in templateKeys(template) if key not in base]
+    missing = [key for key in keys if key not in endpoints.defaultCombinations]
+    if missing:
+        raise ValueError('Key could not be filled in automatically: ' + missing[0])
+
+    spans = [('{}0101'.format(year), '{}0101'.format(year + 1))]
+    if endpoint.find('top-by-edits') >= 0 or granularity == 'hourly':
+        # The top-by-edits endpoint returns 1.2 MB JSON payloads for annual data, and frequently
+        # errors out, and hourly responses stop at 5000 items, so ask for these month by month
+        spans = [('{}{:02d}01'.format(year, m), '{}{:02d}01'.format(year, m + 1) if m < 12 else
+                  '{}0101'.format(year + 1)) for m in range(1, 13)]
+    if granularity == 'hourly':
+        spans = [(start + '00', end + '00') for start, end in spans]
+    for combination in it.product(*[endpoints.defaultCombinations[key] for key in keys]):
+        for start, end in spans:
+            args = dict(base, start=start, end=end, **dict(zip(keys, combination)))
+            yield templateArgsToUrl(template, args)
+
+
+def allUrls(years: List[int], projects: List[str], granularity='daily') -> Iterator[str]:
+    """Every URL for these years, every endpoint (just `HOURLY_ENDPOINTS` for `'hourly'`), and these
+    wikis, newest years first"""
+    shortUrls = HOURLY_ENDPOINTS if granularity == 'hourly' else list(
+        map(shortEndpoint, endpoints.URLS))
+    for year, endpoint, project in it.product(sorted(years, reverse=True), shortUrls, projects):
+        yield from endpointYearProjectToUrls(endpoint, year, project, granularity)
+
+
+def topProjects(n=50, filename='wikilangs.json') -> List[str]:
+    with open(filename, 'r') as f:
+        wikilangs = sorted(json.load(f), key=lambda o: int(o['activeusers']), reverse=True)
+    return [o['prefix'] + '.wikipedia' for o in wikilangs[:n]]
+
+
+class TokenBucket:
+    "Allow `rate` requests per second on average, and bursts of up to `burst`"
+
+    def __init__(self, rate: float, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def take(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def isUnknownError(text: str) -> bool:
+    "Wikimedia's transient failure, which `leveltoxarray` refuses to ingest, so never store it"
+    if text.find('unknown_error') < 0:
+        return False
+    try:
+        return json.loads(text).get('type', '').endswith('errors/unknown_error')
+    except ValueError:
+        return False
+
+
+async def fetch(session, url: str, bucket: TokenBucket, retries=5, backoff=1., baseUrl=BASE_URL):
+    """GET a URL (from `baseUrl` instead of the real server, if given), retrying `unknown_error`
+    responses, 429s and 5xxs, and connection errors, with exponential backoff plus jitter. Returns
+    the body, or None if it never succeeded."""
+    target = baseUrl + url[len(BASE_URL):]
+    for attempt in range(retries + 1):
+        if attempt:
+            await asyncio.sleep(backoff * 2**(attempt - 1) * (1 + random.random()))
+        await bucket.take()
+        try:
+            async with session.get(target) as res:
+                text = await res.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print('retrying {} after {!r}'.format(url, e))
+            continue
+        if res.status in RETRY_STATUSES or isUnknownError(text):
+            print('retrying {} after {}'.format(url, res.status))
+            continue
+        return text
+    return None
+
+
+class BatchWriter:
+    "Buffer `(key, value)` puts and write them to LevelDB `batchSize` at a time"
+
+    def __init__(self, db, batchSize=100):
+        self.db = db
+        self.batchSize = batchSize
+        self.pending = []
+
+    def put(self, key: bytes, value: bytes):
+        self.pending.append((key, value))
+        if len(self.pending) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        with self.db.write_batch() as wb:
+            for key, value in self.pending:
+                wb.put(key, value)
+        self.pending = []
+
+
+async def download(db,
+                   urls: Iterator[str],
+                   concurrency=8,
+                   rate=3.5,
+                   retries=5,
+                   backoff=1.,
+                   batchSize=100,
+                   baseUrl=BASE_URL,
+                   timeout=120):
+    """Fetch every URL not already in LevelDB and store its response under its (real) URL.
+
+    `concurrency` requests are in flight at once over a pool of keep-alive connections, started no
+    faster than `rate` per second. Responses are written in batches; any that never succeeded are
+    skipped, to be retried on the next run. Returns how many were stored and how many failed."""
+    bucket = TokenBucket(rate, burst=concurrency)
+    writer = BatchWriter(db, batchSize)
+    queue = asyncio.Queue(maxsize=2 * concurrency)
+    counts = dict(stored=0, failed=0)
+
+    async def worker(session):
+        while True:
+            url = await queue.get()
+            if url is None:
+                return
+            text = await fetch(session, url, bucket, retries, backoff, baseUrl)
+            if text is None:
+                counts['failed'] += 1
+                print('gave up on', url)
+            else:
+                writer.put(url.encode('utf8'), text.encode('utf8'))
+                counts['stored'] += 1
+                print(url)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(
+            connector=connector,
+            headers={'User-Agent': USER_AGENT},
+            timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        workers = [asyncio.ensure_future(worker(session)) for _ in range(concurrency)]
+        try:
+            for url in urls:
+                if db.get(url.encode('utf8')) is None:
+                    await queue.put(url)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for w in workers:
+                w.cancel()
+            writer.flush()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download Wikimedia REST API data into LevelDB')
+    parser.add_argument('--db', default='./past-yearly-data', help='LevelDB directory')
+    parser.add_argument('--years', nargs=2, type=int, default=[2001, 2018], help='[start, end)')
+    parser.add_argument('--top', type=int, default=50, help='this many wikis, by active users')
+    parser.add_argument('--langs', nargs='+', help='these wikis instead, e.g., en.wikipedia')
+    parser.add_argument(
+        '--hourly', action='store_true', help='hourly pageviews and unique devices instead')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='requests in flight')
+    parser.add_argument('--rate', type=float, default=3.5, help='max requests per second')
+    parser.add_argument('--retries', type=int, default=5, help='per URL, after the first try')
+    parser.add_argument('--batch', type=int, default=100, help='responses per LevelDB write')
+    parser.add_argument(
+        '--base-url', default=BASE_URL, help='fetch from here instead, e.g., a stand-in server')
+    args = parser.parse_args()
+
+    db = plyvel.DB(args.db, create_if_missing=True)
+    urls = allUrls(range(*args.years), args.langs or topProjects(args.top),
+                   'hourly' if args.hourly else 'daily')
+    counts = asyncio.run(
+        download(
+            db,
+            urls,
+            concurrency=args.concurrency,
+            rate=args.rate,
+            retries=args.retries,
+            batchSize=args.batch,
+            baseUrl=args.base_url))
+    db.close()
+    print(counts)
@@ -1,111 +1,118 @@
-from functools import reduce
+import argparse
+import hashlib
 import json
-import pandas as pd
-import xarray as xr
-import numpy as np
-import numpy.fft as fft
-import numpy.ma as ma
-from scipy.signal import welch, hamming
-import matplotlib
-matplotlib.use('TkAgg')
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import matplotlib.colors as mcolors
-
-plt.style.use('ggplot')
-plt.ion()
-with open('wikilangs.json', 'r') as f:
-    wikilangs = sorted(json.load(f), key=lambda o: int(o['activeusers']), reverse=True)
-langToData = {o['prefix']: o for o in wikilangs}
-
-langs = 'en,fr,ja,ru,zh,ar,he'.split(',')
-endpoint = 'pageviews'
-endpoint = 'unique-devices'
-endpoint = 'editors'
-endpoint = 'bytes-difference_net'
-endpoint = 'editors'
-endpoint = 'edits'
-endpoint = 'edited-pages_new'
-endpoint = 'editors'
-endpoint = 'edited-pages'
-endpoint = 'registered-users_new'
-ds = xr.merge(
-    [xr.open_dataset('latest/{}__{}.wikipedia.nc'.format(endpoint, lang)) for lang in langs])
-
-subdict = dict(pageType='content', editorType=['anonymous', 'user'], agent='user')
-for key in list(subdict.keys()):
-    if key not in ds.coords:
-        del subdict[key]
-if 'editorType' in ds.coords:
-    edits = ds.loc[subdict].sum('editorType')
-    if 'activityLevel' in ds.coords:
-        edits = edits.sum('activityLevel')
-elif 'access' in ds.coords:
-    edits = ds.loc[subdict].sum('access')
-elif 'accessSite' in ds.coords:
-    edits = ds.loc[subdict].sum('accessSite')
-else:
-    edits = ds.loc[subdict]
-
-edits = xr.concat(edits.data_vars.values(), 'lang')
-edits.coords['lang'] = langs
-
-
-def save(fname, num=None):
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import List, Tuple
+
+# numpy, xarray, matplotlib, etc. are imported inside the functions that need them, so `--help` and
+# deciding which figures are up to date stay fast, and pool workers only load what they use.
+
+LANGS = 'en,fr,ja,ru,zh,ar,he'.split(',')
+ENDPOINTS = [
+    'pageviews', 'unique-devices', 'editors', 'bytes-difference_net', 'edits', 'edited-pages_new',
+    'edited-pages', 'registered-users_new'
+]
+
+
+def pyplot():
+    "pyplot on a non-interactive backend, so this runs on display-less machines"
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    plt.style.use('ggplot')
+    return plt
+
+
+@lru_cache()
+def langToData():
+    with open('wikilangs.json', 'r') as f:
+        wikilangs = sorted(json.load(f), key=lambda o: int(o['activeusers']), reverse=True)
+    return {o['prefix']: o for o in wikilangs}
+
+
+@lru_cache()
+def loadEndpoint(endpoint: str, langs: Tuple[str]):
+    "Each wiki's headline `(lang, time)` series for an endpoint: content pages, human editors, etc."
+    import rollups
+    edits = rollups.load(endpoint, 'human-content', [lang + '.wikipedia' for lang in langs])
+    edits.coords['lang'] = list(langs)
+    return edits
+
+
+def save(fname, out='.', num=None) -> List[str]:
+    plt = pyplot()
     plt.figure(num or plt.gcf().number)
+    fname = os.path.join(out, fname)
     plt.savefig(fname + '.svg')
     plt.savefig(fname + '.png', dpi=150)
+    return [fname + '.svg', fname + '.png']
 
 
-plt.figure()
-plt.semilogy(edits.coords['time'][:-1], edits.values.T[:-1, :])
-plt.legend([langToData[lang]['lang'] for lang in langs])
-plt.xlabel('date')
-plt.ylabel(endpoint)
-plt.title('Daily Wikipedia {}'.format(endpoint))
-save('1-several-langs-{}'.format(endpoint))
+def stackedAxes(axes):
+    "Hide y ticks, and x ticks on all but the bottom, of vertically-stacked shared axes"
+    plt = pyplot()
+    for ax in axes:
+        plt.setp(ax.get_yticklabels(), visible=False)
+        plt.setp(ax.get_yticklines(), visible=False)
+        plt.setp(ax.get_xticklines(), visible=False)
+    for ax in axes[:-1]:
+        plt.setp(ax.get_xticklabels(), visible=False)
 
 
-def dow(lang, edits):
-    dayOfWeek = edits['time'].to_pandas().dt.weekday_name
+def timeseries(endpoint, langs, out):
+    plt = pyplot()
+    edits = loadEndpoint(endpoint, langs)
     plt.figure()
-    [plt.plot(edits.coords['time'][start:-1:7], edits.loc[lang][start:-1:7]) for start in range(7)]
-    plt.legend(dayOfWeek[:7].values)
+    plt.semilogy(edits.coords['time'][:-1], edits.values.T[:-1, :])
+    plt.legend([langToData()[lang]['lang'] for lang in langs])
     plt.xlabel('date')
     plt.ylabel(endpoint)
-    plt.title('Daily active {} Wikipedia {}'.format(langToData[lang]['lang'], endpoint))
+    plt.title('Daily Wikipedia {}'.format(endpoint))
+    return save('1-several-langs-{}'.format(endpoint), out)
+
 
-    resh2 = lambda x, n: x.ravel()[:(x.size // n) * n].reshape((-1, n))
-    remmax = lambda x: x / np.max(x)
-    dowMedian = np.median(resh2(edits.loc[lang, '2012-12-31':].values, 7), axis=0)
-    print('| Day |  Median {} | % of max |'.format(endpoint))
+def dow(endpoint, langs, out):
+    import seasonal
+    plt = pyplot()
+    edits = loadEndpoint(endpoint, langs)
+    lang, = langs
+    # Rolling year of each weekday's share of its week, from the first full week the wiki has
+    profile = seasonal.weekdayProfile(edits.sel(lang=[lang])).isel(lang=0)
+    plt.figure()
+    lines = []
+    for day in seasonal.WEEKDAYS:
+        p = profile.sel(weekday=day)
+        lines += plt.plot(p['week'], p.sel(quantile=0.5))
+        plt.fill_between(
+            p['week'].values, p.sel(quantile=0.1), p.sel(quantile=0.9), color=lines[-1].get_color(),
+            alpha=0.2)
+    plt.legend(lines, seasonal.WEEKDAYS)
+    plt.xlabel('date')
+    plt.ylabel('share of week mean ({})'.format(endpoint))
+    plt.title('{} Wikipedia {} by weekday (past year)'.format(langToData()[lang]['lang'], endpoint))
+
+    latest = profile.sel(quantile=0.5).isel(week=-1).values
+    print('| Day |  Median share of week, latest year ({}) | % of max |'.format(endpoint))
     print('|-----|-----------------|----------|')
-    days = edits['time'].loc['2012-12-31':].to_pandas().dt.weekday_name[:7].tolist()
     print('\n'.join([
-        '| {} | {:,} | {:.2%} |'.format(day, int(med), pct)
-        for med, pct, day in zip(dowMedian, remmax(dowMedian), days)
+        '| {} | {:.3f} | {:.2%} |'.format(day, med, med / latest.max())
+        for med, day in zip(latest, seasonal.WEEKDAYS)
     ]))
+    return save('2-day-of-week-{}-{}'.format(lang, endpoint), out)
 
 
-dow('en', edits)
-save('2-day-of-week-en-{}'.format(endpoint))
-dow('ja', edits)
-save('2-day-of-week-ja-{}'.format(endpoint))
-
-
-def plotSpectralEstimate(f, phi, note='', recip=False, nperseg=None, axes=None):
+def plotSpectralEstimate(f, phi, langs, note='', recip=False, nperseg=None, axes=None):
+    import numpy as np
+    plt = pyplot()
     if axes is None:
         fig, axes = plt.subplots(len(langs), 1, sharex=True, sharey=True)
     period = 365. / f
     for i, (lang, line) in enumerate(zip(langs, phi)):
         axes[i].loglog(period if recip else f, line / line.max(), color='C{}'.format(i))
         axes[i].set_ylabel(lang)
-    for ax in axes:
-        plt.setp(ax.get_yticklabels(), visible=False)
-        plt.setp(ax.get_yticklines(), visible=False)
-        plt.setp(ax.get_xticklines(), visible=False)
-    for ax in axes[:-1]:
-        plt.setp(ax.get_xticklabels(), visible=False)
+    stackedAxes(axes)
     axes[-1].set_xlabel('period (days)' if recip else "cycles per year")
     axes[0].set_title('Cyclicity in daily editors' + note)
     if nperseg:
@@ -120,92 +127,102 @@ def plotSpectralEstimate(f, phi, note='', recip=False, nperseg=None, axes=None):
     return axes
 
 
-nperseg = 6 * 365
 spectralStart = 2100
-spectralStartStr = str(edits['time'][spectralStart].values)[:10]
-welched = welch(
-    edits.values[:, spectralStart:-1],
-    fs=365.,
-    window='boxcar',
-    nperseg=nperseg,
-    noverlap=int(nperseg * .1),
-    nfft=1024 * 32,
-    detrend='linear')
-plt.figure()
-plt.loglog(365 / welched[0], welched[1].T)
-plt.legend([langToData[lang]['lang'] for lang in langs])
-plt.xlabel('period (days)')
-plt.ylabel('spectral density')
-plt.title('Welch spectrum: {}, {} year chunks, starting {}'.format(endpoint, nperseg // 365,
-                                                                   spectralStartStr))
-plt.ylim((1e-4, max(plt.ylim())))
-save('3-welch-several-langs-{}'.format(endpoint))
-
-
-def acorrc(y, maxlags=None):
-    maxlags = maxlags or (len(y) - 1)
-    a = [1] + [np.corrcoef([y[n:], y[:-n]])[0, 1] for n in range(1, maxlags)]
-    return a, range(len(a))
-
-
-def acorrcArr(arr, maxlags=None):
-    a = np.vstack([acorrc(y, maxlags=maxlags)[0] for y in arr])
-    return a, range(a.shape[1])
-
-
-ac, lags = acorrcArr(edits.values[:, spectralStart:-1])
-plt.figure()
-plt.plot(lags, ac.T)
-plt.legend([langToData[lang]['lang'] for lang in langs])
-plt.xlabel('lag (days)')
-plt.ylabel('correlation')
-plt.title('Auto-correlation between days, {}, starting {}'.format(endpoint, spectralStartStr))
-save('4-acf-several-langs-{}'.format(endpoint))
-
-acf = np.abs(fft.rfft(hamming(ac.shape[1]) * ac, n=1024 * 16, axis=-1))
-fac = fft.rfftfreq(16 * 1024, d=1 / 365)
-plt.figure()
-plt.loglog(365 / fac, acf.T)
-plt.legend([langToData[lang]['lang'] for lang in langs])
-plt.title("Auto-correlation's spectrum, {}, starting {}".format(endpoint, spectralStartStr))
-plt.xlabel('period (days)')
-save('5-acfspectrum-several-langs-{}'.format(endpoint))
-
-
-def sliding(x, nperseg, noverlap=0, f=lambda x: x):
-    hop = nperseg - noverlap
-    return [
-        f(x[i:min(len(x), i + nperseg)]) for i in range(0, hop + len(x) - nperseg, hop)
-        if i < len(x)  # needed for noverlap<0
-    ]
 
 
-lagswanted = [7, 365]
-ns = [30]
-for lagwanted in lagswanted:
-    fig, ax = plt.subplots(len(langs), 1, sharex=True, sharey=True)
-    for i, lang in enumerate(langs):
-        en = edits.values[i, :-1]
-        a = en[:-lagwanted]
-        b = en[lagwanted:]
-        for nperseg in ns:
-            c = sliding(
-                range(len(a)), nperseg, nperseg - 1, lambda r: np.corrcoef(a[r], b[r])[0, 1])
-            tenc = sliding(
-                range(len(a)), nperseg, nperseg - 1, lambda r: edits['time'].values[r[0]])
-            ax[i].plot(tenc, c)
-            ax[i].set_ylabel(lang)
-    for a in ax:
-        plt.setp(a.get_yticklabels(), visible=False)
-        plt.setp(a.get_yticklines(), visible=False)
-        plt.setp(a.get_xticklines(), visible=False)
-    for a in ax[:-1]:
-        plt.setp(a.get_xticklabels(), visible=False)
-    ax[0].set_title('Sliding correlation for {} day lag, {} days training, {}'.format(
-        lagwanted, ','.join(map(str, ns)), endpoint))
-    save('6-sliding-corr-{}-several-langs-{}'.format(lagwanted, endpoint))
-
-# fig.autofmt_xdate()
+def spectralStartStr(edits):
+    return str(edits['time'][spectralStart].values)[:10]
+
+
+def welch(endpoint, langs, out):
+    from spectra import welchSpectrogram
+    plt = pyplot()
+    edits = loadEndpoint(endpoint, langs)
+    nperseg = 6 * 365
+    welched = welchSpectrogram(
+        edits[:, spectralStart:-1], [endpoint, langs],
+        fs=365.,
+        window='boxcar',
+        nperseg=nperseg,
+        noverlap=int(nperseg * .1),
+        nfft=1024 * 32,
+        detrend='linear')
+    plt.figure()
+    plt.loglog(365 / welched['frequency'].values, welched[:, 0].values.T)
+    plt.legend([langToData()[lang]['lang'] for lang in langs])
+    plt.xlabel('period (days)')
+    plt.ylabel('spectral density')
+    plt.title('Welch spectrum: {}, {} year chunks, starting {}'.format(
+        endpoint, nperseg // 365, spectralStartStr(edits)))
+    plt.ylim((1e-4, max(plt.ylim())))
+    return save('3-welch-several-langs-{}'.format(endpoint), out)
+
+
+def acfDataset(da, nfft=1024 * 16, fs=365.):
+    import xarray as xr
+    from acf import acf, acfSpectrum
+    ac, lags = acf(da.values)
+    fac, spectrum = acfSpectrum(ac, nfft=nfft, fs=fs)
+    return xr.Dataset(
+        dict(ac=(('lang', 'lag'), ac), spectrum=(('lang', 'frequency'), spectrum)),
+        coords=dict(lang=da['lang'].values, lag=lags, frequency=fac))
+
+
+def loadAcf(endpoint, langs):
+    from spectra import cached, cacheKey
+    post = loadEndpoint(endpoint, langs)[:, spectralStart:-1]
+    acfKey = cacheKey([endpoint, langs], dict(nfft=1024 * 16), post)
+    return cached('acf', acfKey, lambda: acfDataset(post))
+
+
+def acfFigure(endpoint, langs, out):
+    plt = pyplot()
+    acfs = loadAcf(endpoint, langs)
+    ac, lags = acfs['ac'].values, acfs['lag'].values
+    plt.figure()
+    plt.plot(lags, ac.T)
+    plt.legend([langToData()[lang]['lang'] for lang in langs])
+    plt.xlabel('lag (days)')
+    plt.ylabel('correlation')
+    plt.title('Auto-correlation between days, {}, starting {}'.format(
+        endpoint, spectralStartStr(loadEndpoint(endpoint, langs))))
+    return save('4-acf-several-langs-{}'.format(endpoint), out)
+
+
+def acfSpectrumFigure(endpoint, langs, out):
+    plt = pyplot()
+    acfs = loadAcf(endpoint, langs)
+    fac, acfspec = acfs['frequency'].values, acfs['spectrum'].values
+    plt.figure()
+    plt.loglog(365 / fac, acfspec.T)
+    plt.legend([langToData()[lang]['lang'] for lang in langs])
+    plt.title("Auto-correlation's spectrum, {}, starting {}".format(
+        endpoint, spectralStartStr(loadEndpoint(endpoint, langs))))
+    plt.xlabel('period (days)')
+    return save('5-acfspectrum-several-langs-{}'.format(endpoint), out)
+
+
+def slidingCorr(endpoint, langs, out, lagswanted=(7, 365), ns=(30, )):
+    from rollingcorr import rollingCorr
+    plt = pyplot()
+    edits = loadEndpoint(endpoint, langs)
+    saved = []
+    for lagwanted in lagswanted:
+        fig, ax = plt.subplots(len(langs), 1, sharex=True, sharey=True, squeeze=False)
+        ax = ax[:, 0]
+        y = edits.values[:, :-1]
+        # c[lang, n, day]: correlation of the window ending on `day` with the one `lagwanted` later
+        c = rollingCorr(y[:, :-lagwanted], y[:, lagwanted:], ns)
+        for i, lang in enumerate(langs):
+            for j, nperseg in enumerate(ns):
+                tenc = edits['time'].values[:c.shape[-1] - nperseg + 1]
+                ax[i].plot(tenc, c[i, j, nperseg - 1:])
+                ax[i].set_ylabel(lang)
+        stackedAxes(ax)
+        ax[0].set_title('Sliding correlation for {} day lag, {} days training, {}'.format(
+            lagwanted, ','.join(map(str, ns)), endpoint))
+        saved += save('6-sliding-corr-{}-several-langs-{}'.format(lagwanted, endpoint), out)
+    return saved
 
 
 def extents(f):
@@ -214,6 +231,7 @@ def extents(f):
 
 
 def myim(x, y, *args, **kwargs):
+    plt = pyplot()
     fig, ax = plt.subplots()
     im = ax.imshow(
         *args,
@@ -225,172 +243,269 @@ def myim(x, y, *args, **kwargs):
     return fig, ax, im
 
 
-def slidingCorrScan(y, lag, nperseg=None, noverlap=None, nperseg2=2, noverlap2=1, finallen=1):
-    a = y[lag:]
-    b = y[:-lag]
-    nperseg = nperseg or len(a) // 8
-    noverlap = noverlap or nperseg // 2
-    corr = []
-    idxs = list(map(lambda n: range(n, n + 1), range(len(a))))
-    while len(idxs) > finallen:
-        idxs = sliding(idxs, nperseg, noverlap,
-                       lambda ranges: range(ranges[0][0], 1 + ranges[-1][-1]))
-        corr.append([(np.corrcoef([a[idx], b[idx]])[0, 1], len(idx), idx[0]) for idx in idxs])
-        nperseg = nperseg2
-        noverlap = noverlap2
-    return corr
-
-
-def lenStartToArrTail(lst, lag):
-    width = lst[-1][0][1] + 365
-    arr = np.zeros((len(lst), width))
-    for i, row in enumerate(lst):
-        data = np.array(row)
-        corrs = data[:, 0]
-        lens = data[:, 1].astype(int)
-        starts = data[:, 2].astype(int)
-        ends = starts + lag + lens
-        tmp = np.repeat(np.nan, width)
-        for e, f, c in zip(ends[0:-1], ends[1:], corrs[1:]):
-            tmp[e:f] = c
-        dstart = starts[1] - starts[0] if starts.size > 1 else 20
-        end = np.minimum(width, ends[0])
-        tmp[(end - dstart):end] = corrs[0]
-        arr[i, :] = tmp
-    return arr
-
-
-en = edits.values[0, :-1]
-
-lagswanted = [7, 365]
-cslides = [slidingCorrScan(en, lagwanted, 100, 80) for lagwanted in lagswanted]
-
-
-class SqueezedNorm(matplotlib.colors.Normalize):
-    """Via https://stackoverflow.com/a/44438440/500207"""
-
-    def __init__(self, vmin=None, vmax=None, mid=0, s1=2, s2=2, clip=False):
-        self.vmin = vmin  # minimum value
-        self.mid = mid  # middle value
-        self.vmax = vmax  # maximum value
-        self.s1 = s1
-        self.s2 = s2
-        f = lambda x, zero, vmax, s: np.abs((x - zero) / (vmax - zero))**(1. / s) * 0.5
-        self.g = lambda x, zero,vmin,vmax, s1,s2: f(x,zero,vmax,s1)*(x>=zero) - \
-                                             f(x,zero,vmin,s2)*(x<zero)+0.5
-        matplotlib.colors.Normalize.__init__(self, vmin, vmax, clip)
-
-    def __call__(self, value, clip=None):
-        r = self.g(value, self.mid, self.vmin, self.vmax, self.s1, self.s2)
-        return np.ma.masked_array(r)
-
-
-mynorm = SqueezedNorm(vmin=-.4, vmax=1, mid=0., s1=1., s2=1.)
-# See https://stackoverflow.com/a/31052741/500207
-colors1 = plt.cm.Oranges(np.linspace(0., 1, 128))  #[::-1, :]
-colors2 = plt.cm.viridis(np.linspace(0, 1, 128))
-colors = np.vstack((colors1, colors2))
-mymap = mcolors.LinearSegmentedColormap.from_list('my_colormap', colors)
-for cslide, lagwanted in zip(cslides, lagswanted):
-    ten = edits['time'][:-1]
-    ts = mdates.date2num(ten)
-    fig, ax, im = myim(
-        ts, [x[0][1] for x in cslide],
-        ma.masked_invalid(lenStartToArrTail(cslide, lagwanted)),
-        cmap=mymap,
-        norm=mynorm)
-    ax.xaxis_date()
-    ax.set_xlabel("window end date")
-    ax.set_ylabel('window length (days)')
-    im.set_clim((-0.4, 1))
-    fig.colorbar(im)
-    ax.set_title('Sliding correlations, {} days prior lag, en, {}'.format(lagwanted, endpoint))
-    save('7-sliding-heatmap-{}-{}-{}'.format(lagwanted, 'en', endpoint))
-
-# I like this view I think. For each (X, Y) pixel, X days and Y window length (also days), it says
-# "The Y-long window of time starting at X is (not) correlated with the Y-long window starting at
-# X-365 days".
-
-# so what's going on here?
-df = pd.DataFrame(
-    lenStartToArrTail(cslides[1], lagswanted[1]).T,
-    index=edits['time'].values[:-1],
-    columns=[x[0][1] for x in cslides[1]])
-enddate = '2007-06-01'
-nwindow = df.loc[enddate].idxmin()
-
-exactendidx = df.index.get_loc(enddate)
-arr = np.array(cslides[1][df.columns.get_loc(nwindow)])
-corrs, lens, starts = arr.T
-ends = starts + lagswanted[1] + lens
-endidx = (ends < exactendidx).sum()
-end = int(ends[endidx])
-actual = np.corrcoef(en[end - nwindow:end], en[end - nwindow - 365:end - 365])[0, 1]
-expected = df.loc[enddate].loc[nwindow]
-print({'actual': actual, 'expected': expected})
-
-# Example 2
-enddate = '2009-01-01'
-nwindow = 365 * 3
-
-end = df.index.get_loc(enddate)
-foo, bar = en[end - nwindow:end], en[end - nwindow - 365:end - 365]
-foo = foo.reshape((3, -1))
-bar = bar.reshape((3, -1))
-plt.figure()
-[plt.scatter(x, y) for x, y in zip(foo, bar)]
-plt.xlabel('{}'.format(endpoint))
-plt.ylabel('{}, 365 days ago'.format(endpoint))
-plt.title('The 2007 discontinuity')
-plt.legend(['2005/2006', '2006/2007', '2007/2008'])
-save('8-peak-wiki-en-{}'.format(endpoint))
-# Recall that Peak Wiki happened late April 2007, but edits had been stagnant since Jan 2007.
-#
-# The long dark diagonal slash of low correlation in the sliding correlation heatmap reflects this:
-# the first half of 2006 sees rapidly-increasing edits, and 365 days later (first half of 2007) is
-# stagnant edits, which destoys collinearity.
-#
-# The second half of 2006 continued seeing rapid growth, and this correlates nicely with the second
-# half of 2007: recall that the collapse started early May 2007, but saw a dead-cat bounce in July,
-# before bottoming out in early August. August 2006 through Jan 2007 look similar enough to a year
-# later that they correlate well (~0.5).
-#
-# The presence of the high-growth portion of early 2006 in the 365-day lag correlations reduces
-# correlation values by destroying collinearity, due to its marked contrast to the first half of 2007
-# (which saw flat edits till April and then freefall May, )
-
-# Example 3
-
-# Another phase change is indicated by the dark black vertical section of low correlation in late
-# 2015. Specifically, both halves of 2014 are uncorrelated with the both halves of 2015.
-# In a nutshell: 2014 continues the previous several years' drop. Most years see either flat or
-# dropping edits for the first half, then a substantial drop in mid-year that sometimes recovers
-# before the December crash. 2015 however began with a strong recovery after the holiday break,
-# followed by a robust plateau throughout the year, frequently breaking highs, and spiking edits
-# to levels last seen in early 2011.
-#
-# Correlation is low because we have a region of steady decline correlating poorly against a region
-# of stagnation-then-growth. Note how the dark region moves up and a bit right: any window that
-# includes that last half of 2015 (and therefore correlates it against the last half of 2014) is
-# plagued by low correlation. However, if the segment includes much more before or after that last
-# half of 2015, the correlation returns, as this data conjoined with prior/subsequent data emulate
-# collinearity.
-
-# Example 4
-enddate = '2016-01-01'
-yrs = 2
-nwindow = 365 * yrs
-
-end = df.index.get_loc(enddate)
-
-foo, bar = en[end - nwindow:end], en[end - nwindow - 365:end - 365]
-resh = lambda x, n: x.ravel()[:(x.size // n) * n].reshape((n, -1))
-foo = resh(foo, yrs * 2)
-bar = resh(bar, yrs * 2)
-plt.figure()
-[plt.scatter(x, y) for x, y in zip(foo, bar)]
-plt.xlabel('{}'.format(endpoint))
-plt.ylabel('{}, 365 days ago'.format(endpoint))
-plt.title('The 2015 discontinuity')
-plt.legend(list(map(lambda n: str(n), list(np.arange(yrs * 2) / 2 + 2014))))
-save('9-2014-bump-en-{}'.format(endpoint))
+def squeezedNorm(vmin=None, vmax=None, mid=0, s1=2, s2=2, clip=False):
+    import numpy as np
+    import matplotlib.colors as mcolors
+
+    class SqueezedNorm(mcolors.Normalize):
+        """Via https://stackoverflow.com/a/44438440/500207"""
+
+        def __init__(self, vmin=None, vmax=None, mid=0, s1=2, s2=2, clip=False):
+            mcolors.Normalize.__init__(self, vmin, vmax, clip)
+            self.vmin = vmin  # minimum value
+            self.mid = mid  # middle value
+            self.vmax = vmax  # maximum value
+            self.s1 = s1
+            self.s2 = s2
+            f = lambda x, zero, vmax, s: np.abs((x - zero) / (vmax - zero))**(1. / s) * 0.5
+            self.g = lambda x, zero,vmin,vmax, s1,s2: f(x,zero,vmax,s1)*(x>=zero) - \
+                                                 f(x,zero,vmin,s2)*(x<zero)+0.5
+
+        def __call__(self, value, clip=None):
+            r = self.g(value, self.mid, self.vmin, self.vmax, self.s1, self.s2)
+            return np.ma.masked_array(r)
+
+    return SqueezedNorm(vmin, vmax, mid, s1, s2, clip)
+
+
+def heatmap(endpoint, langs, out, lagswanted=(7, 365)):
+    import numpy as np
+    import numpy.ma as ma
+    import matplotlib.colors as mcolors
+    import matplotlib.dates as mdates
+    from rollingcorr import corrScan, scanHeatmap
+    plt = pyplot()
+    edits = loadEndpoint(endpoint, langs)
+    lang, = langs
+    en = edits.loc[lang].values[:-1]
+    # Each is (corrs, lens, starts), see `corrScan`
+    cslides = [corrScan(en, lagwanted, 100, 80) for lagwanted in lagswanted]
+
+    mynorm = squeezedNorm(vmin=-.4, vmax=1, mid=0., s1=1., s2=1.)
+    # See https://stackoverflow.com/a/31052741/500207
+    colors1 = plt.cm.Oranges(np.linspace(0., 1, 128))  #[::-1, :]
+    colors2 = plt.cm.viridis(np.linspace(0, 1, 128))
+    colors = np.vstack((colors1, colors2))
+    mymap = mcolors.LinearSegmentedColormap.from_list('my_colormap', colors)
+    saved = []
+    for cslide, lagwanted in zip(cslides, lagswanted):
+        ten = edits['time'][:-1]
+        ts = mdates.date2num(ten)
+        fig, ax, im = myim(
+            ts, cslide[1][:, 0],
+            ma.masked_invalid(scanHeatmap(*cslide, lagwanted)),
+            cmap=mymap,
+            norm=mynorm)
+        ax.xaxis_date()
+        ax.set_xlabel("window end date")
+        ax.set_ylabel('window length (days)')
+        im.set_clim((-0.4, 1))
+        fig.colorbar(im)
+        ax.set_title('Sliding correlations, {} days prior lag, {}, {}'.format(
+            lagwanted, lang, endpoint))
+        saved += save('7-sliding-heatmap-{}-{}-{}'.format(lagwanted, lang, endpoint), out)
+
+    # I like this view I think. For each (X, Y) pixel, X days and Y window length (also days), it
+    # says "The Y-long window of time starting at X is (not) correlated with the Y-long window
+    # starting at X-365 days".
+
+    # so what's going on here?
+    if 365 in lagswanted:
+        heatmapCheck(en, edits['time'].values[:-1], cslides[lagswanted.index(365)])
+    return saved
+
+
+def heatmapCheck(en, time, cslide, enddate='2007-06-01'):
+    "Example 1: check one pixel of the 365-day lag heatmap against a direct `corrcoef`"
+    import numpy as np
+    import pandas as pd
+    from rollingcorr import scanHeatmap
+    df = pd.DataFrame(scanHeatmap(*cslide, 365).T, index=time, columns=cslide[1][:, 0])
+    if df.loc[enddate].isnull().all():
+        return
+    nwindow = df.loc[enddate].idxmin()
+
+    exactendidx = df.index.get_loc(enddate)
+    row = df.columns.get_loc(nwindow)
+    valid = cslide[1][row] > 0
+    corrs, lens, starts = [x[row][valid] for x in cslide]
+    ends = starts + 365 + lens
+    endidx = (ends < exactendidx).sum()
+    end = int(ends[endidx])
+    actual = np.corrcoef(en[end - nwindow:end], en[end - nwindow - 365:end - 365])[0, 1]
+    expected = df.loc[enddate].loc[nwindow]
+    print({'actual': actual, 'expected': expected})
+
+
+def peakWiki(endpoint, langs, out):
+    # Example 2
+
+    # Recall that Peak Wiki happened late April 2007, but edits had been stagnant since Jan 2007.
+    #
+    # The long dark diagonal slash of low correlation in the sliding correlation heatmap reflects
+    # this: the first half of 2006 sees rapidly-increasing edits, and 365 days later (first half of
+    # 2007) is stagnant edits, which destoys collinearity.
+    #
+    # The second half of 2006 continued seeing rapid growth, and this correlates nicely with the
+    # second half of 2007: recall that the collapse started early May 2007, but saw a dead-cat
+    # bounce in July, before bottoming out in early August. August 2006 through Jan 2007 look
+    # similar enough to a year later that they correlate well (~0.5).
+    #
+    # The presence of the high-growth portion of early 2006 in the 365-day lag correlations reduces
+    # correlation values by destroying collinearity, due to its marked contrast to the first half of
+    # 2007 (which saw flat edits till April and then freefall May, )
+    plt = pyplot()
+    edits = loadEndpoint(endpoint, langs)
+    lang, = langs
+    en = edits.loc[lang].values[:-1]
+    enddate = '2009-01-01'
+    nwindow = 365 * 3
+
+    end = edits.indexes['time'].get_loc(enddate)
+    foo, bar = en[end - nwindow:end], en[end - nwindow - 365:end - 365]
+    foo = foo.reshape((3, -1))
+    bar = bar.reshape((3, -1))
+    plt.figure()
+    [plt.scatter(x, y) for x, y in zip(foo, bar)]
+    plt.xlabel('{}'.format(endpoint))
+    plt.ylabel('{}, 365 days ago'.format(endpoint))
+    plt.title('The 2007 discontinuity')
+    plt.legend(['2005/2006', '2006/2007', '2007/2008'])
+    return save('8-peak-wiki-{}-{}'.format(lang, endpoint), out)
+
+
+def bump2015(endpoint, langs, out):
+    # Example 3
+
+    # Another phase change is indicated by the dark black vertical section of low correlation in
+    # late 2015. Specifically, both halves of 2014 are uncorrelated with the both halves of 2015.
+    # In a nutshell: 2014 continues the previous several years' drop. Most years see either flat or
+    # dropping edits for the first half, then a substantial drop in mid-year that sometimes recovers
+    # before the December crash. 2015 however began with a strong recovery after the holiday break,
+    # followed by a robust plateau throughout the year, frequently breaking highs, and spiking edits
+    # to levels last seen in early 2011.
+    #
+    # Correlation is low because we have a region of steady decline correlating poorly against a
+    # region of stagnation-then-growth. Note how the dark region moves up and a bit right: any
+    # window that includes that last half of 2015 (and therefore correlates it against the last half
+    # of 2014) is plagued by low correlation. However, if the segment includes much more before or
+    # after that last half of 2015, the correlation returns, as this data conjoined with
+    # prior/subsequent data emulate collinearity.
+
+    # Example 4
+    import numpy as np
+    plt = pyplot()
+    edits = loadEndpoint(endpoint, langs)
+    lang, = langs
+    en = edits.loc[lang].values[:-1]
+    enddate = '2016-01-01'
+    yrs = 2
+    nwindow = 365 * yrs
+
+    end = edits.indexes['time'].get_loc(enddate)
+
+    foo, bar = en[end - nwindow:end], en[end - nwindow - 365:end - 365]
+    resh = lambda x, n: x.ravel()[:(x.size // n) * n].reshape((n, -1))
+    foo = resh(foo, yrs * 2)
+    bar = resh(bar, yrs * 2)
+    plt.figure()
+    [plt.scatter(x, y) for x, y in zip(foo, bar)]
+    plt.xlabel('{}'.format(endpoint))
+    plt.ylabel('{}, 365 days ago'.format(endpoint))
+    plt.title('The 2015 discontinuity')
+    plt.legend(list(map(lambda n: str(n), list(np.arange(yrs * 2) / 2 + 2014))))
+    return save('9-2014-bump-{}-{}'.format(lang, endpoint), out)
+
+
+# Figure type: (function, whether it's one figure per wiki, wikis it's drawn for by default)
+FIGURES = {
+    'timeseries': (timeseries, False, LANGS),
+    'dow': (dow, True, ['en', 'ja']),
+    'welch': (welch, False, LANGS),
+    'acf': (acfFigure, False, LANGS),
+    'acfspectrum': (acfSpectrumFigure, False, LANGS),
+    'slidingcorr': (slidingCorr, False, LANGS),
+    'heatmap': (heatmap, True, ['en']),
+    'peakwiki': (peakWiki, True, ['en']),
+    'bump2015': (bump2015, True, ['en']),
+}
+
+
+def jobs(figures: List[str], endpoints: List[str], langs: List[str] = None):
+    "`(figure, endpoint, langs)` for each figure to draw"
+    for figure in figures:
+        f, perLang, defaults = FIGURES[figure]
+        langs_ = langs or defaults
+        for endpoint in endpoints:
+            for ls in ([lang] for lang in langs_) if perLang else [langs_]:
+                yield figure, endpoint, tuple(ls)
+
+
+def stampFilename(job, out='.') -> str:
+    return os.path.join(out, '.stamps', '{}-{}-{}.json'.format(job[0], job[1], ','.join(job[2])))
+
+
+def jobKey(job) -> str:
+    """Hash of a job, its input files' sizes and modification times, and the source of the code
+    that reads, rolls up, and plots them"""
+    import query
+    h = hashlib.blake2b(digest_size=16)
+    stats = [(f, os.stat(f).st_size, os.stat(f).st_mtime_ns)
+             for f in query.sourceFiles(job[1], [lang + '.wikipedia' for lang in job[2]])]
+    h.update(json.dumps([job, stats]).encode())
+    here = os.path.dirname(os.path.abspath(__file__))
+    # Everything figures' numbers go through, including how they're read and rolled up
+    for module in [
+            'eda.py', 'acf.py', 'rollingcorr.py', 'spectra.py', 'seasonal.py', 'rollups.py',
+            'query.py', 'store.py'
+    ]:
+        with open(os.path.join(here, module), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def upToDate(job, out='.') -> bool:
+    "Whether a job's figures exist and were drawn from the same inputs"
+    try:
+        with open(stampFilename(job, out), 'r') as f:
+            stamp = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return stamp['key'] == jobKey(job) and all(map(os.path.exists, stamp['files']))
+
+
+def run(job, out='.') -> List[str]:
+    "Draw one job's figures, record what they were drawn from, and return their filenames"
+    figure, endpoint, langs = job
+    files = FIGURES[figure][0](endpoint, langs, out)
+    pyplot().close('all')
+    os.makedirs(os.path.dirname(stampFilename(job, out)), exist_ok=True)
+    with open(stampFilename(job, out), 'w') as f:
+        json.dump(dict(key=jobKey(job), files=files), f)
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Draw the exploratory figures, headless')
+    parser.add_argument('--endpoints', nargs='+', default=ENDPOINTS, help='e.g., editors edits')
+    parser.add_argument(
+        '--langs', nargs='+', help='wikis, e.g., en ja (default: depends on the figure)')
+    parser.add_argument(
+        '--figures', nargs='+', choices=list(FIGURES), default=list(FIGURES), help='figure types')
+    parser.add_argument('--out', default='.', help='directory to save figures in')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='figures drawn in parallel')
+    parser.add_argument('--force', action='store_true', help='redraw even if inputs are unchanged')
+    args = parser.parse_args()
+
+    todo = [
+        job for job in jobs(args.figures, args.endpoints, args.langs)
+        if args.force or not upToDate(job, args.out)
+    ]
+    print('{} figure job(s) to run'.format(len(todo)))
+    if args.workers > 1:
+        with ProcessPoolExecutor(args.workers) as executor:
+            for files in executor.map(run, todo, [args.out] * len(todo)):
+                print(*files)
+    else:
+        for job in todo:
+            print(*run(job, args.out))
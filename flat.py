@@ -0,0 +1,116 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import os
+import shutil
+from typing import List
+import leveltoxarray
+import rollups
+import store
+
+FLAT_DIR = os.path.join('latest', 'flat')
+
+
+def flatDirectory(endpointName: str, directory=FLAT_DIR) -> str:
+    return os.path.join(directory, endpointName)
+
+
+def export(endpointName: str, dataDirectory='latest', directory=FLAT_DIR, sources=None) -> str:
+    """Write every wiki's file for an endpoint as one raw, uncompressed `(lang, time, ...)` array,
+    `<endpoint>.bin` (C order, starting at offset 0, so page-aligned), next to a `meta.json` with
+    its dtype, shape, and coordinates, for `openFlat` to memory-map.
+
+    Wikis are written one at a time through a writable memory map, so memory stays at one wiki's
+    worth. Written into a temporary directory that replaces the old one when done, so readers never
+    see a half-written array."""
+    files = store.langFiles(endpointName, dataDirectory)
+    langs = sorted(files)
+    if len(langs) == 0:
+        return
+    coords, dtype = store.layout(files, langs)
+    inner = {d: v for d, v in coords.items() if d != 'lang'}
+    dims = list(coords)
+    shape = tuple(map(len, coords.values()))
+
+    final = flatDirectory(endpointName, directory)
+    tmp = '{}.{}'.format(final, os.getpid())
+    os.makedirs(tmp)
+    arr = np.memmap(os.path.join(tmp, endpointName + '.bin'), dtype=dtype, mode='w+', shape=shape)
+    for i, lang in enumerate(langs):
+        with xr.open_dataset(files[lang]) as ds:
+            arr[i] = ds[lang].reindex(inner, fill_value=0).transpose(*dims[1:]).values
+    arr.flush()
+    del arr
+    meta = dict(
+        name=endpointName,
+        dtype=dtype.str,
+        shape=shape,
+        dims=dims,
+        langs=langs,
+        start=str(coords['time'][0].date()),
+        days=len(coords['time']),
+        coords={d: list(map(str, v))
+                for d, v in inner.items() if d != 'time'},
+        sources=sources or {})
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f, sort_keys=True)
+    if os.path.exists(final):
+        shutil.rmtree(final)
+    os.rename(tmp, final)
+    return final
+
+
+def refresh(endpointNames: List[str], dataDirectory='latest', directory=FLAT_DIR,
+            force=False) -> List[str]:
+    "Re-export the endpoints whose per-wiki files changed since they were last exported"
+    exported = []
+    for name in endpointNames:
+        files = store.langFiles(name, dataDirectory)
+        sources = {lang: rollups.sourceFingerprint(filename) for lang, filename in files.items()}
+        try:
+            with open(os.path.join(flatDirectory(name, directory), 'meta.json'), 'r') as f:
+                if json.load(f)['sources'] == sources and not force:
+                    continue
+        except FileNotFoundError:
+            pass
+        if export(name, dataDirectory, directory, sources):
+            exported.append(name)
+    return exported
+
+
+def openFlat(endpointName: str, directory=FLAT_DIR) -> xr.DataArray:
+    """An exported endpoint as a read-only, memory-mapped `(lang, time, ...)` DataArray.
+
+    Nothing is read until used, then only the pages touched, from the OS page cache, which every
+    process that opens the same array shares. Integer and slice selections (`isel`, and `sel` with
+    labels or slices) are views into the map; asking for a copy (`.load()` on a fancy-indexed
+    result, arithmetic, `astype`) is what costs memory."""
+    folder = flatDirectory(endpointName, directory)
+    with open(os.path.join(folder, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    data = np.memmap(
+        os.path.join(folder, endpointName + '.bin'),
+        dtype=np.dtype(meta['dtype']),
+        mode='r',
+        shape=tuple(meta['shape']))
+    coords = dict(lang=meta['langs'], time=pd.date_range(meta['start'], periods=meta['days']))
+    coords.update(meta['coords'])
+    return xr.DataArray(data, coords=coords, dims=meta['dims'], name=endpointName)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export per-wiki files as flat arrays that analyses can memory-map')
+    parser.add_argument(
+        'endpoints', nargs='*', help='e.g., edits editors (default: all but top-by-edits)')
+    parser.add_argument('--force', action='store_true', help="even if sources haven't changed")
+    args = parser.parse_args()
+    names = args.endpoints or [
+        name for name in map(leveltoxarray.endpointName, leveltoxarray.endpoints.URLS)
+        if not name.endswith('top-by-edits')
+    ]
+    exported = refresh(names, force=args.force)
+    for name in names:
+        print('{}: {}'.format(name, 'exported' if name in exported else 'up to date'))
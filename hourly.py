@@ -0,0 +1,209 @@
+import plyvel
+import xarray as xr
+import numpy as np
+import pandas as pd
+import argparse
+import glob
+import json
+import os
+import re
+from collections import defaultdict
+from typing import Dict, List
+import endpoints
+import instrument
+import leveltoxarray
+
+HOURLY_DIR = os.path.join('latest', 'hourly')
+# Endpoint names (see `leveltoxarray.endpointName`) with hourly data
+ENDPOINTS = ['pageviews', 'unique-devices']
+# How each level of the pyramid summarizes the one below. Hourly unique devices don't add up (a
+# device seen in two hours of a day is still one of that day's uniques), so their daily and weekly
+# levels keep the busiest hour's (or day's) count, a lower bound.
+REDUCE = {'pageviews': 'sum', 'unique-devices': 'max'}
+# Weeks start on Mondays
+LEVELS = {'daily': 'D', 'weekly': 'W-MON'}
+
+HOUR_RE = re.compile(rb'"timestamp":\s*"(\d{10})')
+
+
+def yearFilename(endpointName: str, lang: str, year, directory=HOURLY_DIR) -> str:
+    return os.path.join(directory, '{}__{}'.format(endpointName, lang), '{}.nc'.format(year))
+
+
+def levelFilename(endpointName: str, lang: str, level: str, directory=HOURLY_DIR) -> str:
+    return os.path.join(directory, '{}__{}.{}.nc'.format(endpointName, lang, level))
+
+
+def yearHours(year: int) -> pd.DatetimeIndex:
+    return pd.date_range(str(year), str(year + 1), freq='H')[:-1]
+
+
+def extractHourly(value: bytes):
+    "An hourly response's `YYYYMMDDHH` stamps (as bytes) and numbers, like `extractSeries`"
+    stamps = HOUR_RE.findall(value)
+    numbers = leveltoxarray.NUMBER_RE.findall(value)
+    if len(stamps) == len(numbers) and len(set(k for k, _ in numbers)) <= 1:
+        return stamps, [int(v) for _, v in numbers]
+    items = json.loads(value)['items']
+    key = [k for k, v in items[0].items() if not isinstance(v, str)][0] if items else None
+    return [item['timestamp'][:10].encode('ascii') for item in items], [item[key] for item in items]
+
+
+def hourOffsets(time: pd.DatetimeIndex, stamps: List[bytes]) -> np.ndarray:
+    "Hours since `time[0]`; stamps outside `time` (responses overlap a year's ends) get -1"
+    hours = pd.to_datetime(np.array(stamps).astype('U10'), format='%Y%m%d%H')
+    offsets = np.asarray((hours - time[0]) // pd.Timedelta(hours=1), dtype=np.intp)
+    offsets[(offsets < 0) | (offsets >= len(time))] = -1
+    return offsets
+
+
+def template(endpointName: str) -> str:
+    return [url for url in endpoints.URLS if leveltoxarray.endpointName(url) == endpointName][0]
+
+
+def yearKeys(db, endpointName: str, langs: List[str] = None) -> Dict[str, Dict[int, List[bytes]]]:
+    "An endpoint's hourly LevelDB keys, by wiki and year (of `{start}`), without reading values"
+    endpoint = template(endpointName)
+    keys = defaultdict(lambda: defaultdict(list))
+    for key in leveltoxarray.groupedScan(db, [endpointName], langs, includeValue=False):
+        if leveltoxarray.isHourly(key):
+            args = leveltoxarray.urlToArgs(key, endpoint)
+            keys[args['project']][int(args['start'][:4])].append(key)
+    return keys
+
+
+def ingestYear(db, endpoint: str, lang: str, year: int, keys: List[bytes],
+               incremental=False) -> dict:
+    """Decode one wiki's hourly responses for one year into that year's own file, chunked by month,
+    and return a record of how that went (see `instrument.GroupStats`).
+
+    Only this year is ever in memory. An existing file is skipped, or with `incremental`, rebuilt
+    from all its keys if any of them changed."""
+    name = leveltoxarray.endpointName(endpoint)
+    stats = instrument.GroupStats('{}/hourly/{}'.format(name, year), lang)
+    filename = yearFilename(name, lang, year)
+    exists = os.path.exists(filename)
+    if exists and not incremental:
+        stats.info['status'] = 'exists'
+        stats.counts['skipped'] = len(keys)
+        return stats.record()
+    reader = instrument.Counted((key, db.get(key)) for key in keys)
+    items = list(reader)
+    manifest = {key.decode('utf8'): leveltoxarray.valueHash(value) for key, value in items}
+    if exists and manifest == leveltoxarray.loadManifest(filename):
+        stats.info['status'] = 'unchanged'
+        stats.counts['skipped'] = len(keys)
+        return stats.record(reader)
+
+    time = yearHours(year)
+    dims, coords = leveltoxarray.endpointCoords(endpoint, time)
+    da = xr.DataArray(
+        np.zeros(list(map(len, coords)), dtype=np.int64),
+        coords=dict(zip(dims, coords)),
+        dims=dims)
+    for key, value in items:
+        with stats.phase('decode'):
+            if not leveltoxarray.hasItems(key, value):
+                stats.counts['notFound'] += 1
+                continue
+            args = leveltoxarray.urlToArgs(key, endpoint)
+            stamps, vals = extractHourly(value)
+        with stats.phase('fill'):
+            offsets = hourOffsets(time, stamps)
+            ok = offsets >= 0
+            da.values[(offsets[ok], ) + leveltoxarray.fixedIndex(da, args)] = np.array(vals)[ok]
+        stats.counts['decoded'] += 1
+
+    with stats.phase('save'):
+        stats.counts['allocatedBytes'] = da.nbytes
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        ds = leveltoxarray.minimizeDtypes(xr.Dataset({lang: da}))
+        ds.to_netcdf(filename + '2', encoding=leveltoxarray.compressedEncoding(ds, timeChunk=744))
+        os.rename(filename + '2', filename)
+        leveltoxarray.saveManifest(manifest, filename)
+    stats.counts['fileBytes'] = os.path.getsize(filename)
+    return stats.record(reader)
+
+
+def downsample(da: xr.DataArray, endpointName: str, level: str) -> xr.DataArray:
+    resampled = da.resample(time=LEVELS[level], closed='left', label='left')
+    return getattr(resampled, REDUCE[endpointName])().astype(np.int64)
+
+
+def updateLevels(endpointName: str, lang: str, years: List[int], directory=HOURLY_DIR):
+    """Recompute the daily level for just these (rewritten) years, splice them into the rest, and
+    redo the weekly level from the daily one, so only these years' hourly data is read"""
+    fresh = []
+    for year in years:
+        with xr.open_dataset(yearFilename(endpointName, lang, year, directory)) as ds:
+            fresh.append(downsample(ds[lang].load(), endpointName, 'daily'))
+    daily = fresh
+    filename = levelFilename(endpointName, lang, 'daily', directory)
+    if os.path.exists(filename):
+        with xr.open_dataset(filename) as ds:
+            old = ds[lang].load()
+        daily = daily + [old.isel(time=~np.isin(old.indexes['time'].year, years))]
+    daily = xr.concat(daily, 'time').sortby('time').astype(np.int64)
+    for level, da in [('daily', daily), ('weekly', downsample(daily, endpointName, 'weekly'))]:
+        ds = leveltoxarray.minimizeDtypes(xr.Dataset({lang: da}))
+        leveltoxarray.saveAndMove(ds, levelFilename(endpointName, lang, level, directory))
+
+
+def load(endpointName: str, lang: str, level='daily', time=slice(None),
+         directory=HOURLY_DIR) -> xr.DataArray:
+    """One wiki's hourly data, or its precomputed `daily` or `weekly` level, over `time`, e.g.,
+    `load('pageviews', 'en.wikipedia', 'hourly', slice('2016-03-01', '2016-03-07'))`. Hourly loads
+    only open the years `time` overlaps; the other levels never touch the hourly files."""
+    if level != 'hourly':
+        with xr.open_dataset(levelFilename(endpointName, lang, level, directory)) as ds:
+            return ds[lang].sel(time=time).load()
+    first = pd.Timestamp(time.start).year if time.start else 0
+    last = pd.Timestamp(time.stop).year if time.stop else 9999
+    parts = []
+    for filename in sorted(glob.glob(yearFilename(endpointName, lang, '*', directory))):
+        year = int(os.path.basename(filename)[:-len('.nc')])
+        if first <= year <= last:
+            with xr.open_dataset(filename) as ds:
+                parts.append(ds[lang].sel(time=time).load())
+    if not parts:
+        raise ValueError('no hourly {} for {} in {}'.format(endpointName, lang, time))
+    return xr.concat(parts, 'time')
+
+
+def ingest(db, endpointNames=ENDPOINTS, langs=None, incremental=False, progress=None) -> dict:
+    "Ingest every hourly response, one wiki-year at a time, then update the downsampled levels"
+    keys = {name: yearKeys(db, name, langs) for name in endpointNames}
+    progress = progress or instrument.Progress()
+    progress.totalKeys = sum(
+        len(yearly) for byLang in keys.values() for byYear in byLang.values()
+        for yearly in byYear.values())
+    for name in endpointNames:
+        for lang, byYear in sorted(keys[name].items()):
+            written = []
+            for year in sorted(byYear):
+                record = ingestYear(db, template(name), lang, year, byYear[year], incremental)
+                progress.group(record)
+                if record['status'] == 'saved':
+                    written.append(year)
+            if written:
+                updateLevels(name, lang, written)
+    return progress.finish()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Ingest hourly pageviews and unique devices, with daily and weekly levels')
+    parser.add_argument('--db', default='./past-yearly-data', help='LevelDB directory')
+    parser.add_argument(
+        '--endpoints', nargs='+', default=ENDPOINTS, choices=ENDPOINTS, help='default: both')
+    parser.add_argument('--langs', nargs='+', help='only these wikis, e.g., en.wikipedia')
+    parser.add_argument(
+        '--incremental', action='store_true', help='rebuild years whose responses changed')
+    parser.add_argument('--metrics', help='append per-year timings and counts here, as JSON lines')
+    args = parser.parse_args()
+
+    db = plyvel.DB(args.db, create_if_missing=False)
+    metrics = open(args.metrics, 'a') if args.metrics else None
+    ingest(db, args.endpoints, args.langs, args.incremental, instrument.Progress(out=metrics))
+    if metrics:
+        metrics.close()
@@ -0,0 +1,186 @@
+import cProfile
+import json
+import os
+import resource
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Iterator
+
+
+class Counted:
+    "Wrap a `(key, value, ...)` iterator, counting keys and value bytes, and timing the reads"
+
+    def __init__(self, iterator: Iterator):
+        self.iterator = iter(iterator)
+        self.keys = 0
+        self.bytes = 0
+        self.seconds = 0.
+
+    def __iter__(self):
+        while True:
+            start = time.perf_counter()
+            item = next(self.iterator, None)
+            self.seconds += time.perf_counter() - start
+            if item is None:
+                return
+            self.keys += 1
+            self.bytes += len(item[1])
+            yield item
+
+
+class GroupStats:
+    """Where one (endpoint, wiki) group's ingest time went, and what it saw: phase timings, counts
+    of keys, bytes, unchanged or hourly (`skipped`), `not_found`, and undecodable (`errors`) keys,
+    and the size of the in-memory dataset and the saved file. `record` is for the metrics log."""
+
+    def __init__(self, endpointName: str, language: str):
+        self.start = time.perf_counter()
+        self.info = dict(endpoint=endpointName, language=language, status='saved')
+        self.phases = Counter()
+        self.counts = Counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def record(self, reader: Counted = None) -> dict:
+        counts = Counter(self.counts)
+        phases = Counter(self.phases)
+        if reader is not None:
+            counts.update(keys=reader.keys, bytes=reader.bytes)
+            phases['read'] += reader.seconds
+        return dict(
+            self.info,
+            seconds=time.perf_counter() - self.start,
+            phases=dict(phases),
+            maxRssMb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            pid=os.getpid(),
+            **{k: int(v)
+               for k, v in counts.items()})
+
+
+class Progress:
+    """Running totals over finished groups, with an ETA from how many of `totalKeys` are done.
+
+    Prints one line per group, and, given an `out` file, writes every group's record and a final
+    summary as JSON lines."""
+
+    def __init__(self, totalKeys: int = None, out=None):
+        self.start = time.perf_counter()
+        self.totalKeys = totalKeys
+        self.out = out
+        self.totals = Counter()
+        self.phases = Counter()
+        self.groups = 0
+
+    def emit(self, record: dict):
+        if self.out:
+            self.out.write(json.dumps(record, sort_keys=True) + '\n')
+            self.out.flush()
+
+    def eta(self) -> float:
+        elapsed = time.perf_counter() - self.start
+        done = self.totals['keys']
+        if not self.totalKeys or not done:
+            return None
+        return max(0., elapsed * (self.totalKeys - done) / done)
+
+    def group(self, record: dict, skipped=0):
+        "Account for one finished group, plus `skipped` keys its worker never saw"
+        record = dict(record, skipped=record.get('skipped', 0) + skipped)
+        record['keys'] = record.get('keys', 0) + skipped
+        self.groups += 1
+        for k, v in record.items():
+            if isinstance(v, int) and k != 'pid':
+                # Peaks don't add up
+                peak = k.endswith('PeakBytes')
+                self.totals[k] = max(self.totals[k], v) if peak else self.totals[k] + v
+        self.phases.update(record.get('phases', {}))
+        eta = self.eta()
+        record.update(
+            event='group',
+            elapsed=time.perf_counter() - self.start,
+            keysDone=self.totals['keys'],
+            keysTotal=self.totalKeys,
+            eta=eta)
+        self.emit(record)
+        phases = ', '.join('{} {:.2f}'.format(k, v) for k, v in sorted(record['phases'].items()))
+        print('{} {}: {}, {} keys, {:.1f} MB in {:.2f} s ({}); {}/{} keys{}'.format(
+            record['endpoint'], record['language'], record['status'], record['keys'],
+            record.get('bytes', 0) / 2**20, record['seconds'], phases or '-', record['keysDone'],
+            '?' if self.totalKeys is None else self.totalKeys,
+            '' if eta is None else ', ETA {:.0f} s'.format(eta)))
+
+    def finish(self):
+        summary = dict(
+            event='summary',
+            elapsed=time.perf_counter() - self.start,
+            groups=self.groups,
+            keysTotal=self.totalKeys,
+            phases=dict(self.phases),
+            **self.totals)
+        self.emit(summary)
+        print('ingested {} groups, {} keys in {:.1f} s'.format(self.groups, self.totals['keys'],
+                                                               summary['elapsed']))
+        return summary
+
+
+class Profiler:
+    """cProfile or tracemalloc around some code (`with profiler: ...`), accumulating over every use
+    in this process. `dump` writes (and overwrites) `<prefix>.<pid>.prof` or `.txt`."""
+
+    def __init__(self, kind: str, prefix: str):
+        if kind not in ('cprofile', 'tracemalloc'):
+            raise ValueError('unknown profiler ' + kind)
+        self.kind = kind
+        self.prefix = prefix
+        self.profile = cProfile.Profile() if kind == 'cprofile' else None
+        self.peak = 0
+        self.sincePeak = 0
+
+    def __enter__(self):
+        if self.profile:
+            self.profile.enable()
+        else:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile:
+            self.profile.disable()
+        else:
+            peak = tracemalloc.get_traced_memory()[1] - self.before
+            self.peak = max(self.peak, peak)
+            self.sincePeak = max(self.sincePeak, peak)
+
+    def takePeak(self) -> int:
+        "Most bytes tracemalloc saw allocated in one use since the last `takePeak`"
+        peak, self.sincePeak = self.sincePeak, 0
+        return peak
+
+    def dump(self):
+        filename = '{}.{}.{}'.format(self.prefix, os.getpid(), 'prof' if self.profile else 'txt')
+        if self.profile:
+            self.profile.dump_stats(filename)
+            return filename
+        with open(filename, 'w') as f:
+            f.write('peak bytes allocated in one call: {}\n'.format(self.peak))
+            for stat in tracemalloc.take_snapshot().statistics('lineno')[:50]:
+                f.write(str(stat) + '\n')
+        return filename
+
+
+@lru_cache(maxsize=None)
+def profiler(kind: str, prefix: str) -> Profiler:
+    "This process' profiler, so pool workers each accumulate (and dump) their own"
+    return Profiler(kind, prefix)
@@ -3,182 +3,756 @@ import xarray as xr
 import numpy as np
 import pandas as pd
 import json
+import hashlib
 import re
 import os
 import itertools as it
+import argparse
+from functools import lru_cache
+from typing import Dict, List
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import nullcontext
 import endpoints
+import instrument
 
 
 def dashToCamelCase(s: str) -> str:
     return re.sub(r'-(.)', lambda o: o[1].upper(), s)
 
 
-def endpointToDataset(endpoint: str,
-                      project: str,
-                      t=pd.date_range('2001-01-01', '2018-01-01'),
-                      dtype=np.int64) -> xr.Dataset:
+def endpointCoords(endpoint: str, t=pd.date_range('2001-01-01', '2018-01-01')):
     keys = list(
         filter(lambda key: key in endpoints.defaultCombinations,
                map(lambda s: dashToCamelCase(re.sub(r'[{}]', '', s)),
                    filter(lambda s: len(s) and s[0] == '{', endpoint.split('/')))))
     combinations = list(map(lambda key: endpoints.defaultCombinations[key], keys))
-    alldims = ['time'] + keys
-    allcoords = [t] + combinations
-    size = [t.size] + list(map(len, combinations))
-    top = endpoint.find('/top-by-edits/') >= 0
-    if top:
-        alldims += ['topidx']
-        allcoords += [np.arange(100)]
-        size += [100]
-        dtype = np.int32
+    return ['time'] + keys, [t] + combinations
+
+
+def endpointToDataset(endpoint: str,
+                      project: str,
+                      t=pd.date_range('2001-01-01', '2018-01-01'),
+                      dtype=np.int32) -> xr.Dataset:
+    alldims, allcoords = endpointCoords(endpoint, t)
     ds = xr.Dataset()
-    ds[project] = (alldims, np.zeros(size, dtype=dtype))
+    ds[project] = (alldims, np.zeros(list(map(len, allcoords)), dtype=dtype))
     for dim, coord in zip(alldims, allcoords):
         ds.coords[dim] = coord
-    if top:
-        dtype = np.int64
-        project += '-page_id'
-        ds[project] = (alldims, np.zeros(size, dtype=dtype))
-        for dim, coord in zip(alldims, allcoords):
-            ds.coords[dim] = coord
     return ds
 
 
-def appendToDataset(ds: xr.Dataset, newProject: str, like=None):
+def appendToDataset(ds: xr.Dataset, newProject: str):
     if len(ds.data_vars) == 0:
         raise ValueError('dataset needs to have at least one data variable')
     if newProject not in ds:
-        existing = ds[like or (list(it.islice(ds.data_vars, 1))[0])]
+        existing = ds[list(it.islice(ds.data_vars, 1))[0]]
         arr = existing.values
         dims = existing.coords.dims
         ds[newProject] = (dims, np.zeros_like(arr))
 
 
-def dataArrayAndKeysToCut(da, keyvals, full=True):
-    for key, value in keyvals.items():
-        key = dashToCamelCase(key)
-        if key in da.coords:
-            da = da.loc[dict([[key, value]])]
-            # FIXME this might fail because leveldb contains values for keys that ds lacks
-            # because endpoints.py doesn't specify them: this will then fail.
-    if full and len(da.coords.dims) != 1:
+INT_DTYPES = [np.int8, np.int16, np.int32, np.int64]
+
+
+def smallestInt(arr: np.ndarray):
+    lo, hi = (arr.min(), arr.max()) if arr.size else (0, 0)
+    return next(t for t in INT_DTYPES if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max)
+
+
+def minimizeDtypes(ds: xr.Dataset) -> xr.Dataset:
+    "Store each signed integer variable in the smallest dtype that holds it"
+    return ds.assign({
+        name: ds[name].astype(smallestInt(ds[name].values))
+        for name in ds.data_vars if np.issubdtype(ds[name].dtype, np.signedinteger)
+    })
+
+
+def widenDtypes(ds: xr.Dataset) -> xr.Dataset:
+    "Undo `minimizeDtypes` enough that new data (usually) fits, see `updateDataset`"
+    return ds.assign({
+        name: ds[name].astype(np.promote_types(ds[name].dtype, np.int32))
+        for name in ds.data_vars if np.issubdtype(ds[name].dtype, np.signedinteger)
+    })
+
+
+@lru_cache(maxsize=8)
+def dayIndex(start: str, periods: int) -> Dict[bytes, int]:
+    """Map both `YYYYMMDD` and `YYYY-MM-DD` (as bytes) to the day's offset from `start`"""
+    days = pd.date_range(start, periods=periods)
+    idx = {d.encode('ascii'): i for i, d in enumerate(days.strftime('%Y%m%d'))}
+    idx.update({d.encode('ascii'): i for i, d in enumerate(days.strftime('%Y-%m-%d'))})
+    return idx
+
+
+def timeOffsets(time: pd.DatetimeIndex, stamps: List[bytes]) -> np.ndarray:
+    idx = dayIndex(str(time[0].date()), len(time))
+    return np.fromiter((idx[s] for s in stamps), dtype=np.intp, count=len(stamps))
+
+
+def urlToArgs(url: bytes, endpoint: str) -> Dict[str, str]:
+    "Recover the template's (camelCased) arguments from the URL: same as the items' metadata"
+    parts = url[len(endpoints.BASE_URL):].decode('utf8').split('/')
+    return {
+        dashToCamelCase(t[1:-1]): v
+        for t, v in zip(endpoint.split('/'), parts) if len(t) and t[0] == '{'
+    }
+
+
+def fixedIndex(da: xr.DataArray, args: Dict[str, str], skip=('time', )) -> tuple:
+    try:
+        return tuple(da.get_index(dim).get_loc(args[dim]) for dim in da.dims if dim not in skip)
+    except KeyError:
+        # FIXME leveldb might contain values for keys that ds lacks because endpoints.py doesn't
+        # specify them.
         raise ValueError('data does not fully specify non-time axes')
-    return da
 
 
-def updateDataset(ds, keyval):
-    key, value = keyval
+# These pull just the numbers out of the raw responses, without building Python dicts for each item
+TIMESTAMP_RE = re.compile(rb'"timestamp":\s*"(\d{4}-?\d\d-?\d\d)')
+NUMBER_RE = re.compile(rb'"(\w+)":\s*(-?\d+)\s*[,}]')
+EDITS_RE = re.compile(rb'"edits":\s*(\d+)')
+PAGE_ID_RE = re.compile(rb'"page_id":\s*(?:"(\d*)"|(\d+)|null)')
+
+
+def dayKey(timestamp: str) -> bytes:
+    return timestamp[:10 if timestamp[4] == '-' else 8].encode('ascii')
+
+
+def extractSeries(value: bytes):
+    stamps = TIMESTAMP_RE.findall(value)
+    numbers = NUMBER_RE.findall(value)
+    if len(stamps) == len(numbers) and len(set(k for k, _ in numbers)) <= 1:
+        return stamps, [int(v) for _, v in numbers]
+    # Fall back to the slow path for anything unexpected
+    items = json.loads(value)['items']
+    records = items if 'timestamp' in items[0] else [r for item in items for r in item['results']]
+    key = [k for k, v in records[0].items() if not isinstance(v, str)][0]
+    return [dayKey(r['timestamp']) for r in records], [r[key] for r in records]
+
+
+def extractTop(value: bytes):
+    stamps = TIMESTAMP_RE.findall(value)
+    counts, edits, pageIds = [], [], []
+    for chunk in value.split(b'"timestamp"')[1:]:
+        rowEdits = EDITS_RE.findall(chunk)
+        rowIds = PAGE_ID_RE.findall(chunk)
+        if len(rowEdits) != len(rowIds):
+            break
+        counts.append(len(rowEdits))
+        edits += rowEdits
+        # `page_id` can be `null`??
+        pageIds += [a or b or 0 for a, b in rowIds]
+    else:
+        if len(stamps) == len(counts):
+            return stamps, counts, list(map(int, edits)), list(map(int, pageIds))
+    stamps, counts, edits, pageIds = [], [], [], []
+    for item in json.loads(value)['items']:
+        for result in item['results']:
+            stamps.append(dayKey(result['timestamp']))
+            counts.append(len(result['top']))
+            edits += [x['edits'] for x in result['top']]
+            pageIds += [int(x.get('page_id') or 0) for x in result['top']]
+    return stamps, counts, edits, pageIds
+
+
+def isHourly(key: bytes) -> bool:
+    "Hourly responses go in their own storage, see `hourly.py`"
+    return key.find(b'/hourly/') >= 0
+
+
+def dailyItems(iterator):
+    "Leave out hourly `(key, value)`s before anything hashes, decodes, or ships them to a worker"
+    return (item for item in iterator if not isHourly(item[0]))
+
+
+def hasItems(key: bytes, value: bytes) -> bool:
+    if value.find(b'"items"') >= 0:
+        return True
     value = json.loads(value)
     if 'type' in value:
         if value['type'].find('errors/unknown_error') >= 0:
             raise ValueError('unknown error in ' + key.decode('utf8') + ', delete and redownload?')
         elif value['type'].find('errors/not_found') >= 0:
             print('not_found in ' + key.decode('utf8') + ', skipping')
-            return 0
+            return False
+    raise ValueError('no items in ' + key.decode('utf8'))
 
-    # quick setup and checks
-    item = value['items'][0]
-    thisProject = item['project']
-    appendToDataset(ds, thisProject)
-    if 'granularity' in item and item['granularity'] != 'daily':
+
+def decodeResponse(key: bytes, value: bytes, top=False):
+    "A response's URL arguments and its `extractSeries` (or `extractTop`), or None if `not_found`"
+    if not hasItems(key, value):
+        return None
+    args = urlToArgs(key, whichEndpoint(key))
+    if args.get('granularity', 'daily') != 'daily':
         raise ValueError("Don't yet know how to deal with non-daily data")
+    return args, extractTop(value) if top else extractSeries(value)
+
+
+def fillDataset(ds, args, stamps, vals):
+    "Scatter one decoded response into its wiki's variable"
+    thisProject = args['project']
+    appendToDataset(ds, thisProject)
+    vals = np.array(vals, dtype=np.int64)
+    dtype = np.promote_types(ds[thisProject].dtype, smallestInt(vals))
+    if dtype != ds[thisProject].dtype:
+        ds[thisProject] = ds[thisProject].astype(dtype)
+    arr = ds[thisProject].values
+    arr[(timeOffsets(ds.indexes['time'], stamps), ) + fixedIndex(ds[thisProject], args)] = vals
 
-    if 'timestamp' in value['items'][0]:
-        vec = dataArrayAndKeysToCut(ds[thisProject], item)
-        # `views` e.g. is indexed by hours so it might have YYDDMMHH
-        fix = lambda t: (t + '00') if len(t) == len('2018010200') else t
-        arr = vec.loc[fix(value['items'][0]['timestamp']):fix(value['items'][-1][
-            'timestamp'])].values
-        key = 'views' if 'views' in item else 'devices'
-        if len(value['items']) != arr.size:
-            # See https://wikimedia.org/api/rest_v1/metrics/pageviews/aggregate/en.wikipedia/mobile-app/spider/daily/20150101/20160101
-            # A whole year, only three days with a *mobile* spider. Just iterate in those cases.
-            for item in value['items']:
-                vec.loc[fix(item['timestamp'])] = item[key]
-        else:
-            vals = list(map(lambda item: item[key], value['items']))
-            arr[:] = vals
-    else:
-        for item in value['items']:
-            if "top" in item['results'][0]:
-                pageIdList = list(
-                    it.islice(filter(lambda s: s.find('-page_id') >= 0, ds.data_vars), 1))
-                thisPageId = thisProject + '-page_id'
-                appendToDataset(ds, thisPageId, like=pageIdList[0])
 
-                vecPageId = dataArrayAndKeysToCut(ds[thisPageId], item, False)
-                pageIdArr = vecPageId.loc[item['results'][0]['timestamp']:item['results'][-1][
-                    'timestamp']].values
+def updateDataset(ds, keyval):
+    # Sparse responses are fine, see https://wikimedia.org/api/rest_v1/metrics/pageviews/aggregate/en.wikipedia/mobile-app/spider/daily/20150101/20160101
+    # A whole year, only three days with a *mobile* spider.
+    decoded = decodeResponse(*keyval)
+    if decoded is None:
+        return 0
+    args, (stamps, vals) = decoded
+    fillDataset(ds, args, stamps, vals)
+    return 1
 
-                vec = dataArrayAndKeysToCut(ds[thisProject], item, False)
-                vecArr = vec.loc[item['results'][0]['timestamp']:item['results'][-1][
-                    'timestamp']].values
 
-                for ridx, result in enumerate(item['results']):
-                    tmp = [x['edits'] for x in result['top']]
-                    vecArr[ridx, :len(tmp)] = tmp
+class TopRankings:
+    """Top-by-edits, stored ragged (CSR-style) rather than in a mostly-empty dense `topidx` axis.
 
-                    # x['page_id'] can be `null`??
-                    tmp = [int(x['page_id'] or 0) for x in result['top']]
-                    pageIdArr[ridx, :len(tmp)] = tmp
+    For each (time, editorType, pageType) row, the `-count` variable says how many (edits, page)
+    entries it has; the entries themselves are concatenated in row-major, rank order, and pages are
+    codes into a `-page_id` dictionary. `denseRankings` reconstitutes the dense view."""
 
-            else:
-                k = list(filter(lambda s: s != 'timestamp', item['results'][0].keys()))[0]
-                vals = list(map(lambda x: x[k], item['results']))
-                vec = dataArrayAndKeysToCut(ds[thisProject], item)
-                subvec = vec.loc[item['results'][0]['timestamp']:item['results'][-1]['timestamp']]
-                if subvec.size != len(vals):
-                    raise ValueError('sub-vector data dimensions mismatch')
-                subvec[:] = vals
-    return 1
+    def __init__(self, endpoint: str, t=pd.date_range('2001-01-01', '2018-01-01')):
+        self.dims, self.coords = endpointCoords(endpoint, t)
+        self.counts: Dict[str, xr.DataArray] = {}
+        self.pageCodes: Dict[int, int] = {}
+        # (project, LevelDB key) -> (row indexes, count per row, edits, page codes)
+        self.chunks: Dict[tuple, tuple] = {}
+
+    @classmethod
+    def fromDataset(cls, endpoint: str, ds: xr.Dataset):
+        self = cls(endpoint, ds.indexes['time'])
+        for name in ds.data_vars:
+            if name.endswith('-count'):
+                project = name[:-len('-count')]
+                count = self.count(project)
+                count.values[:] = ds[name].values
+                rows = np.nonzero(count.values)
+                codes = self.intern(ds[project + '-page_id'].values)[ds[project + '-page'].values]
+                self.chunks[project, None] = (rows, count.values[rows],
+                                              ds[project].values.astype(np.int32), codes)
+        return self
+
+    def count(self, project: str) -> xr.DataArray:
+        if project not in self.counts:
+            self.counts[project] = xr.DataArray(
+                np.zeros(list(map(len, self.coords)), dtype=np.uint8),
+                coords=dict(zip(self.dims, self.coords)),
+                dims=self.dims)
+        return self.counts[project]
+
+    def intern(self, pageIds) -> np.ndarray:
+        uniq, inverse = np.unique(np.asarray(pageIds, dtype=np.int64), return_inverse=True)
+        codes = [self.pageCodes.setdefault(p, len(self.pageCodes)) for p in uniq.tolist()]
+        return np.array(codes, dtype=np.int32)[inverse]
+
+    def grow(self, key: bytes):
+        end = responseEnd(key)
+        time = self.coords[0]
+        if end > time[-1]:
+            self.coords[0] = pd.date_range(time[0], end)
+            self.counts = {
+                project: count.reindex(time=self.coords[0], fill_value=0)
+                for project, count in self.counts.items()
+            }
+
+    def fill(self, key: bytes, args, stamps, counts, edits, pageIds):
+        count = self.count(args['project'])
+        rows = (timeOffsets(count.indexes['time'], stamps), ) + fixedIndex(count, args)
+        count.values[rows] = counts
+        rows = tuple(np.array(r, dtype=np.int32) for r in np.broadcast_arrays(*rows))
+        self.chunks[args['project'], key] = (rows, np.array(counts, dtype=np.uint8),
+                                             np.array(edits, dtype=np.int32), self.intern(pageIds))
+
+    def update(self, keyval):
+        decoded = decodeResponse(*keyval, top=True)
+        if decoded is None:
+            return 0
+        args, extracted = decoded
+        self.fill(keyval[0], args, *extracted)
+        return 1
+
+    def nbytes(self) -> int:
+        "Memory held by the counts and the not-yet-concatenated chunks"
+        arrays = [a for chunk in self.chunks.values() for a in chunk[0] + chunk[1:]]
+        return sum(a.nbytes for a in arrays) + sum(c.nbytes for c in self.counts.values())
+
+    def toDataset(self) -> xr.Dataset:
+        ds = xr.Dataset(coords=dict(zip(self.dims, self.coords)))
+        pageIds = np.fromiter(self.pageCodes, dtype=np.int64, count=len(self.pageCodes))
+        for project, count in self.counts.items():
+            chunks = [chunk for (p, _), chunk in self.chunks.items() if p == project]
+            # Where responses overlap, the latest one's row wins (it also set `count`). Work on
+            # rows, not entries, then copy each chunk's surviving rows straight into place.
+            flat = np.concatenate([np.ravel_multi_index(chunk[0], count.shape) for chunk in chunks])
+            which = np.repeat(np.arange(len(chunks)), [chunk[1].size for chunk in chunks])
+            lengths = np.concatenate([chunk[1] for chunk in chunks]).astype(np.intp)
+            starts = np.concatenate([rangeStarts(chunk[1]) for chunk in chunks])
+            order = np.lexsort((-which, flat))
+            order = order[np.r_[True, flat[order][1:] != flat[order][:-1]]]
+            which, lengths, starts = which[order], lengths[order], starts[order]
+            destinations = rangeStarts(lengths)
+
+            edits = np.zeros(lengths.sum(), dtype=np.int32)
+            codes = np.zeros(lengths.sum(), dtype=np.int32)
+            for i, chunk in enumerate(chunks):
+                mine = which == i
+                source = expandRanges(starts[mine], lengths[mine])
+                destination = expandRanges(destinations[mine], lengths[mine])
+                edits[destination] = chunk[2][source]
+                codes[destination] = chunk[3][source]
+
+            # Renumber the used pages in sorted page id order
+            used = np.unique(codes)
+            used = used[np.argsort(pageIds[used])]
+            renumber = np.zeros(pageIds.size, dtype=np.int32)
+            renumber[used] = np.arange(used.size)
+
+            ds[project + '-count'] = count
+            ds[project] = (project + '-entry', edits)
+            ds[project + '-page'] = (project + '-entry', renumber[codes])
+            ds[project + '-page_id'] = (project + '-pages', pageIds[used])
+        return ds
+
+
+def rangeStarts(lengths: np.ndarray) -> np.ndarray:
+    return np.cumsum(lengths, dtype=np.intp) - lengths
+
+
+def expandRanges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    "Concatenation of `arange(start, start + length)` for each pair"
+    return np.repeat(starts - rangeStarts(lengths), lengths) + np.arange(lengths.sum())
+
+
+def denseRankings(ds: xr.Dataset, project: str, time=slice(None)) -> xr.Dataset:
+    "Some days of a project's top-by-edits, in the dense (time, ..., topidx) layout"
+    count = ds[project + '-count']
+    lengths = count.values.ravel().astype(np.intp)
+    starts = rangeStarts(lengths)
+    rows = xr.DataArray(
+        np.arange(count.size).reshape(count.shape), coords=count.coords,
+        dims=count.dims).sel(time=time)
+    topidx = np.arange(100)
+    mask = topidx < lengths[rows.values][..., np.newaxis]
+    entries = (starts[rows.values][..., np.newaxis] + topidx)[mask]
+    edits = np.zeros(mask.shape, dtype=ds[project].dtype)
+    edits[mask] = ds[project].values[entries]
+    pageIds = np.zeros(mask.shape, dtype=np.int64)
+    pageIds[mask] = ds[project + '-page_id'].values[ds[project + '-page'].values[entries]]
+    dims = rows.dims + ('topidx', )
+    coords = dict(rows.coords, topidx=topidx)
+    return xr.Dataset({project: (dims, edits), project + '-page_id': (dims, pageIds)}, coords)
+
+
+def buildRoutes(urls: List[str] = endpoints.URLS) -> dict:
+    "Trie over the path segments before `{project}`, with endpoint templates at the leaves"
+    routes: dict = {}
+    for url in urls:
+        if url.find('{') != url.find('{project}'):
+            raise ValueError('expected `{project}` to be the first template argument in ' + url)
+        *segments, last = url[:url.find('{')].strip('/').split('/')
+        node = routes
+        for segment in segments:
+            node = node.setdefault(segment.encode('utf8'), {})
+        node[last.encode('utf8')] = url
+    return routes
+
+
+ROUTES = buildRoutes()
+BASE_URL_BYTES = endpoints.BASE_URL.encode('utf8')
+
+
+def route(url: bytes):
+    "Endpoint template and language of a LevelDB key, in one pass over its path"
+    if url.startswith(BASE_URL_BYTES):
+        segments = url[len(BASE_URL_BYTES) + 1:].split(b'/')
+        node = ROUTES
+        for i, segment in enumerate(segments[:-1]):
+            node = node.get(segment)
+            if isinstance(node, str):
+                return node, segments[i + 1].decode('utf8')
+            if node is None:
+                break
+    raise ValueError('could not determine endpoint for ', url)
 
 
 def whichEndpoint(url):
-    endpoint = list(
-        filter(lambda ns: ns[1] == url[:len(ns[1])].decode('utf8'),
-               map(lambda ns: [ns[0], endpoints.BASE_URL + ns[1][:ns[1].find('{')]],
-                   enumerate(endpoints.URLS))))
-    if len(endpoint) != 1:
-        raise ValueError('could not determine endpoint for ', url)
-    return endpoints.URLS[endpoint[0][0]]
+    return route(url)[0]
 
 
 def whichLanguage(url, endpoint):
-    lang = url[len(endpoints.BASE_URL) + endpoint.find('{project}'):]
-    return lang[:lang.find(b'/')].decode('utf8')
+    return route(url)[1]
 
 
 def whichEndpointLanguage(url):
-    endpoint = whichEndpoint(url)
-    return {"endpoint": endpoint, "language": whichLanguage(url, endpoint)}
+    endpoint, language = route(url)
+    return {"endpoint": endpoint, "language": language}
+
+
+def endpointName(endpoint: str) -> str:
+    "Short name used in filenames, e.g., `edited-pages_new`"
+    fi = lambda s: len(s) and s != 'metrics' and s != 'aggregate' and s[0] != '{'
+    return '_'.join(filter(fi, endpoint.split('/')))
+
+
+def scanPrefixes(endpointNames=None, languages=None) -> List[bytes]:
+    "Sorted, disjoint LevelDB key prefixes covering just these endpoints' and languages' keys"
+    templates = endpoints.URLS
+    if endpointNames:
+        byName = {endpointName(url): url for url in endpoints.URLS}
+        missing = [name for name in endpointNames if name not in byName]
+        if missing:
+            raise ValueError('unknown endpoints {}, expected some of {}'.format(
+                missing, list(byName)))
+        templates = [byName[name] for name in endpointNames]
+    prefixes = [endpoints.BASE_URL + url[:url.find('{')] for url in templates]
+    if languages:
+        prefixes = [prefix + language + '/' for prefix in prefixes for language in languages]
+    return sorted(set(prefix.encode('utf8') for prefix in prefixes))
+
+
+def compressedEncoding(ds: xr.Dataset, complevel=4, timeChunk=366, entryChunk=1 << 16) -> dict:
+    "zlib-compress data variables, chunked into years (or runs of entries) along their first axis"
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        encoding[name] = dict(zlib=complevel > 0, complevel=complevel)
+        if var.size:
+            first = timeChunk if var.dims[0] == 'time' else entryChunk
+            encoding[name]['chunksizes'] = (min(first, var.shape[0]), ) + var.shape[1:]
+    return encoding
 
 
 def saveAndMove(ds, filename):
-    ds.to_netcdf(filename + '2')
+    ds.to_netcdf(filename + '2', encoding=compressedEncoding(ds))
     os.rename(filename + '2', filename)
 
 
-def groupToDataset(group):
+def groupFilename(endpoint: str, language: str) -> str:
+    return 'latest/{e}__{l}.nc'.format(e=endpointName(endpoint), l=language)
+
+
+def manifestFilename(filename: str) -> str:
+    return re.sub(r'\.nc$', '', filename) + '.manifest.json'
+
+
+def loadManifest(filename: str) -> Dict[str, str]:
+    "Ingested LevelDB keys (including `not_found` ones) mapped to a hash of their values"
+    try:
+        with open(manifestFilename(filename), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def saveManifest(manifest: Dict[str, str], filename: str):
+    manifestname = manifestFilename(filename)
+    with open(manifestname + '2', 'w') as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.rename(manifestname + '2', manifestname)
+
+
+def valueHash(value: bytes) -> str:
+    return hashlib.blake2b(value, digest_size=16).hexdigest()
+
+
+def changedItems(iterator, manifest: Dict[str, str]):
+    for key, value in iterator:
+        digest = valueHash(value)
+        if manifest.get(key.decode('utf8')) != digest:
+            yield key, value, digest
+
+
+def responseEnd(key: bytes) -> pd.Timestamp:
+    return pd.Timestamp(urlToArgs(key, whichEndpoint(key))['end'][:8])
+
+
+def growTime(ds: xr.Dataset, key: bytes) -> xr.Dataset:
+    "Extend the time axis, zero-filled, if this response's `{end}` is past it"
+    end = responseEnd(key)
+    time = ds.indexes['time']
+    if end <= time[-1]:
+        return ds
+    return ds.reindex(time=pd.date_range(time[0], end), fill_value=0)
+
+
+def groupToDataset(group, incremental=False, profile=None, skipErrors=False,
+                   maxMemory=None) -> dict:
+    """Ingest one (endpoint, wiki) group of responses into its file, and return a record of how that
+    went (see `instrument.GroupStats`).
+
+    `profile`, e.g., `('cprofile', 'ingest-profile')`, runs each response's decode and fill (what
+    `updateDataset` does) under that profiler. With `skipErrors`, responses that fail to decode are
+    counted and left out of the manifest (so the next `incremental` run retries them) instead of
+    stopping the ingest. With `maxMemory` (bytes), the group is streamed to disk a year at a time
+    instead of held in memory whole, and can resume after a crash: see `stream.streamGroup`."""
+    if maxMemory:
+        import stream
+        return stream.streamGroup(group, incremental, profile, skipErrors, maxMemory)
     endlang, iterator = group
     endpoint = endlang['endpoint']
     language = endlang['language']
-    fi = lambda s: len(s) and s != 'metrics' and s != 'aggregate' and s[0] != '{'
-    filename = 'latest/{e}__{l}.nc'.format(e='_'.join(filter(fi, endpoint.split('/'))), l=language)
-    try:
-        editedPages = xr.open_dataset(filename)
-        return
-    except FileNotFoundError:
-        editedPages = endpointToDataset(endpoint, language)
-    print(endlang)
-    for res in iterator:
-        updateDataset(editedPages, res)
-    saveAndMove(editedPages, filename)
-    return endpoint
+    stats = instrument.GroupStats(endpointName(endpoint), language)
+    filename = groupFilename(endpoint, language)
+    exists = os.path.exists(filename)
+    if exists and not incremental:
+        stats.info['status'] = 'exists'
+        return stats.record()
+    # Without a manifest, everything is new, but re-decoding a key just overwrites the same cells
+    manifest = loadManifest(filename) if exists else {}
+    reader = instrument.Counted(iterator)
+    items = changedItems(dailyItems(reader), manifest)
+    first = next(items, None)
+    if first is None:
+        stats.info['status'] = 'unchanged'
+        stats.counts['skipped'] = reader.keys
+        return stats.record(reader)
+    top = endpoint.find('/top-by-edits/') >= 0
+    with stats.phase('load'):
+        if exists:
+            with xr.open_dataset(filename) as saved:
+                loaded = saved.load()
+            editedPages = TopRankings.fromDataset(endpoint, loaded) if top else widenDtypes(loaded)
+        else:
+            editedPages = TopRankings(endpoint) if top else endpointToDataset(endpoint, language)
+    profiler = instrument.profiler(*profile) if profile else None
+    changed = 0
+    for key, value, digest in it.chain([first], items):
+        changed += 1
+        with profiler or nullcontext():
+            try:
+                with stats.phase('decode'):
+                    decoded = decodeResponse(key, value, top)
+            except ValueError as e:
+                if not skipErrors:
+                    raise
+                print('{}, skipping'.format(e))
+                stats.counts['errors'] += 1
+                continue
+            with stats.phase('fill'):
+                if top:
+                    editedPages.grow(key)
+                    if decoded:
+                        editedPages.fill(key, decoded[0], *decoded[1])
+                else:
+                    editedPages = growTime(editedPages, key)
+                    if decoded:
+                        fillDataset(editedPages, decoded[0], *decoded[1])
+        stats.counts['notFound' if decoded is None else 'decoded'] += 1
+        manifest[key.decode('utf8')] = digest
+    stats.counts['skipped'] = reader.keys - changed
+    if profiler:
+        if profile[0] == 'tracemalloc':
+            stats.counts['updatePeakBytes'] = profiler.takePeak()
+        profiler.dump()
+
+    with stats.phase('save'):
+        ds = editedPages.toDataset() if top else editedPages
+        stats.counts['allocatedBytes'] = ds.nbytes + (editedPages.nbytes() if top else 0)
+        saveAndMove(minimizeDtypes(ds), filename)
+        saveManifest(manifest, filename)
+    stats.counts['fileBytes'] = os.path.getsize(filename)
+    return stats.record(reader)
+
+
+class Scan:
+    """One ascending scan of the LevelDB's keys under `prefixes` (disjoint and sorted, e.g., from
+    `scanPrefixes`) or of all of them, which `seek` can jump ahead in without reading the keys in
+    between"""
+
+    def __init__(self, db, prefixes=None, includeValue=True):
+        self.db = db
+        self.prefixes = prefixes or [None]
+        self.includeValue = includeValue
+        self.i = 0
+        self.iterator = self.open()
+
+    def open(self):
+        prefix = self.prefixes[self.i]
+        if prefix is None:
+            return self.db.iterator(include_value=self.includeValue)
+        return self.db.iterator(prefix=prefix, include_value=self.includeValue)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            try:
+                return next(self.iterator)
+            except StopIteration:
+                if self.i + 1 == len(self.prefixes):
+                    raise
+                self.i += 1
+                self.iterator = self.open()
+
+    def seek(self, key: bytes):
+        "Continue with the first key after `key`, which must be under the current prefix"
+        self.iterator.seek(key + b'\x00')
+
+
+class Group:
+    "One (endpoint, language)'s `(key, value)`s from `groupedScan`, which `seek` skips ahead in"
+
+    def __init__(self, items, scan: Scan):
+        self.items = items
+        self.scan = scan
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.items)
+
+    def seek(self, key: bytes):
+        "Continue after `key`, except for the group's first item, which the scan already read"
+        self.scan.seek(key)
+
+
+def groupedScan(db, endpointNames=None, languages=None, includeValue=True):
+    # Disjoint prefixes, visited in sorted order, so this is still one ascending key scan
+    prefixes = scanPrefixes(endpointNames, languages) if endpointNames or languages else None
+    scan = Scan(db, prefixes, includeValue)
+    if not includeValue:
+        return scan
+    return ((endlang, Group(items, scan))
+            for endlang, items in it.groupby(scan, lambda kv: whichEndpointLanguage(kv[0])))
+
+
+def countKeys(db, endpointNames=None, languages=None) -> int:
+    "How many keys `groupedScan` will visit, for an ETA (this reads only keys, but the whole range)"
+    return sum(1 for _ in groupedScan(db, endpointNames, languages, includeValue=False))
+
+
+def ingestSerial(groups, incremental=False, progress=None, **kwargs) -> dict:
+    "Ingest each group in turn, reporting to `progress`, and return its summary"
+    progress = progress or instrument.Progress()
+    for endlang, iterator in groups:
+        record = groupToDataset((endlang, iterator), incremental, **kwargs)
+        # Whatever `groupToDataset` didn't read, it skipped
+        progress.group(record, skipped=sum(1 for _ in iterator))
+    return progress.finish()
+
+
+def ingestParallel(groups, workers: int, incremental=False, maxPending=None, progress=None,
+                   **kwargs) -> dict:
+    # LevelDB takes an exclusive LOCK on the database directory, so workers can't open their own
+    # handles while we hold ours. Instead we walk the keys once here, cut them into contiguous
+    # (endpoint, language) key ranges, and ship each range's raw values to a worker, which decodes
+    # and saves exactly as `ingestSerial` would (same keys, same order, so identical `.nc` files).
+    # `maxPending` bounds how many groups are held in memory at once.
+    maxPending = maxPending or 2 * workers
+    progress = progress or instrument.Progress()
+    with ProcessPoolExecutor(workers) as pool:
+        # future -> how many of its group's keys were skipped here, before submitting
+        pending = {}
+
+        def collect(done):
+            for fut in done:
+                progress.group(fut.result(), skipped=pending.pop(fut))
+
+        for endlang, iterator in groups:
+            filename = groupFilename(endlang['endpoint'], endlang['language'])
+            exists = os.path.exists(filename)
+            reader = instrument.Counted(iterator)
+            if not exists:
+                items = list(dailyItems(reader))
+            elif incremental:
+                items = [(key, value) for key, value, _ in
+                         changedItems(dailyItems(reader), loadManifest(filename))]
+            else:
+                items = []
+            if len(items) == 0:
+                stats = instrument.GroupStats(
+                    endpointName(endlang['endpoint']), endlang['language'])
+                stats.info['status'] = 'unchanged' if incremental else 'exists'
+                stats.counts['skipped'] = reader.keys
+                progress.group(stats.record(reader), skipped=sum(1 for _ in iterator))
+                continue
+            fut = pool.submit(groupToDataset, (endlang, items), incremental, **kwargs)
+            pending[fut] = reader.keys - len(items)
+            if len(pending) >= maxPending:
+                collect(wait(pending, return_when=FIRST_COMPLETED).done)
+        collect(wait(pending).done)
+    return progress.finish()
 
 
 if __name__ == '__main__':
-    db = plyvel.DB('./past-yearly-data', create_if_missing=False)
-    dbscan = db.iterator()
-    dbgrouped = it.groupby(dbscan, lambda kv: whichEndpointLanguage(kv[0]))
-    for x in dbgrouped:
-        groupToDataset(x)
+    parser = argparse.ArgumentParser(description='Convert LevelDB of Wikimedia responses to xarray')
+    parser.add_argument('--db', default='./past-yearly-data', help='LevelDB directory')
+    parser.add_argument(
+        '-j', '--workers', type=int, default=1, help='ingest groups in this many processes')
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='patch new or changed keys into existing files instead of skipping them')
+    parser.add_argument(
+        '--endpoints', nargs='+', help='only ingest these endpoints, e.g., edits edited-pages_new')
+    parser.add_argument('--langs', nargs='+', help='only ingest these wikis, e.g., en.wikipedia')
+    parser.add_argument(
+        '--consolidate',
+        action='store_true',
+        help='afterwards, gather each endpoint\'s wikis into one store (see store.py)')
+    parser.add_argument(
+        '--no-rollups',
+        action='store_true',
+        help='skip refreshing the per-wiki rollups of changed files (see rollups.py)')
+    parser.add_argument(
+        '--no-index',
+        action='store_true',
+        help='skip rebuilding the top-by-edits page index if it changed (see topindex.py)')
+    parser.add_argument('--metrics', help='append per-group timings and counts here, as JSON lines')
+    parser.add_argument(
+        '--no-eta', action='store_true', help="don't count the keys first (to estimate time left)")
+    parser.add_argument(
+        '--skip-errors',
+        action='store_true',
+        help='count and skip responses that fail to decode instead of stopping')
+    parser.add_argument(
+        '--profile',
+        choices=['cprofile', 'tracemalloc'],
+        help='profile decoding and filling, per process, into PROFILE_OUT.<pid>.prof or .txt')
+    parser.add_argument('--profile-out', default='ingest-profile', help='profile filename prefix')
+    parser.add_argument(
+        '--max-memory',
+        type=float,
+        help='stream each group to disk in years, checkpointing, holding at most this many MB')
+    args = parser.parse_args()
+    if args.max_memory and args.workers > 1:
+        parser.error("--max-memory streams groups straight from the LevelDB, so it can't use -j")
+
+    db = plyvel.DB(args.db, create_if_missing=False)
+    totalKeys = None if args.no_eta else countKeys(db, args.endpoints, args.langs)
+    metrics = open(args.metrics, 'a') if args.metrics else None
+    progress = instrument.Progress(totalKeys, metrics)
+    groups = groupedScan(db, args.endpoints, args.langs)
+    kwargs = dict(
+        profile=args.profile and (args.profile, args.profile_out),
+        skipErrors=args.skip_errors,
+        maxMemory=args.max_memory and int(args.max_memory * 2**20))
+    if args.workers > 1:
+        ingestParallel(groups, args.workers, args.incremental, progress=progress, **kwargs)
+    else:
+        ingestSerial(groups, args.incremental, progress=progress, **kwargs)
+    if metrics:
+        metrics.close()
+    if args.consolidate:
+        import store
+        for name in args.endpoints or map(endpointName, endpoints.URLS):
+            store.consolidate(name)
+    if not args.no_rollups:
+        import rollups, store
+        for name in args.endpoints or map(endpointName, endpoints.URLS):
+            files = store.langFiles(name)
+            langs = [lang for lang in args.langs or files if lang in files]
+            if langs and not name.endswith('top-by-edits'):
+                rollups.refresh(name, langs)
+    if not args.no_index and 'edited-pages_top-by-edits' in (args.endpoints or
+                                                            map(endpointName, endpoints.URLS)):
+        import topindex
+        topindex.refresh()
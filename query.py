@@ -0,0 +1,283 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Union
+import leveltoxarray
+
+CATALOG = 'catalog.json'
+FILE_RE = re.compile(r'(.+?)(?:__(.+))?\.nc$')
+# Only the ingest's files (and their consolidated stores), not derived ones like `war-edits.nc`
+ENDPOINT_NAMES = set(map(leveltoxarray.endpointName, leveltoxarray.endpoints.URLS))
+
+_catalogs = {}
+
+
+def describe(filename: str) -> dict:
+    "What the catalog records about one `.nc` file: only its header is read"
+    st = os.stat(filename)
+    with xr.open_dataset(filename) as ds:
+        # Top-by-edits files (and stores) have a `-count` (or `count`) variable beside their ragged
+        # entries, the other endpoints' files just one variable
+        counts = [name for name in ds.data_vars if name.endswith('-count') or name == 'count']
+        top = len(counts) > 0
+        var = ds[counts[0] if top else list(ds.data_vars)[0]]
+        time = ds.indexes['time']
+        return dict(
+            stat=[st.st_size, st.st_mtime_ns],
+            top=top,
+            dims=[d for d in var.dims if d != 'lang'],
+            coords={d: ds.indexes[d].tolist()
+                    for d in var.dims if d not in ('time', 'lang')},
+            start=str(time[0].date()),
+            days=len(time),
+            langs=ds.indexes['lang'].tolist() if 'lang' in ds.dims else None)
+
+
+def catalog(directory='latest', refresh=True) -> Dict[str, dict]:
+    """Every endpoint in `directory`: its dims, non-time coordinates, and which files (per-wiki, or
+    a consolidated store) hold which wikis and days.
+
+    Built once and kept in `directory/catalog.json`; after that, only files whose size or mtime
+    changed are re-read (and only their headers). Without `refresh`, a process reuses the catalog it
+    already has, so it won't see files written since."""
+    if not refresh and directory in _catalogs:
+        return _catalogs[directory]
+    filename = os.path.join(directory, CATALOG)
+    try:
+        with open(filename, 'r') as f:
+            files = json.load(f)
+    except (OSError, ValueError):
+        files = {}
+    fresh, changed = {}, False
+    for entry in os.scandir(directory):
+        match = FILE_RE.match(entry.name)
+        if not entry.is_file() or not match or match[1] not in ENDPOINT_NAMES:
+            continue
+        st = entry.stat()
+        old = files.get(entry.name)
+        if old and old['stat'] == [st.st_size, st.st_mtime_ns]:
+            fresh[entry.name] = old
+        else:
+            fresh[entry.name] = describe(entry.path)
+            changed = True
+    if changed or set(fresh) != set(files):
+        tmp = '{}.{}'.format(filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(fresh, f, sort_keys=True)
+        os.replace(tmp, filename)
+
+    endpoints = {}
+    for name, info in sorted(fresh.items()):
+        endpointName, lang = FILE_RE.match(name).groups()
+        e = endpoints.setdefault(endpointName,
+                                 dict(dims=info['dims'], coords=info['coords'], top=info['top'],
+                                      files={}, store=None))
+        if lang is None and info['langs'] is not None:
+            e['store'] = dict(info, file=os.path.join(directory, name))
+        elif lang is not None:
+            e['files'][lang] = dict(info, file=os.path.join(directory, name))
+    # A consolidated store stands in only for the wikis whose own files haven't changed since
+    for e in endpoints.values():
+        s = e['store']
+        e['langs'] = sorted(set(e['files']) | set(s['langs'] if s else []))
+        e['fromStore'] = [] if s is None else [
+            lang for lang in s['langs']
+            if lang not in e['files'] or e['files'][lang]['stat'][1] <= s['stat'][1]
+        ]
+    _catalogs[directory] = endpoints
+    return endpoints
+
+
+def entrySources(e: dict, langs: List[str]) -> List[dict]:
+    "The catalog's entries for the files (per-wiki, or the consolidated store) holding these wikis"
+    sources = [e['files'][lang] for lang in langs if lang not in e['fromStore']]
+    return sources + ([e['store']] if set(langs) & set(e['fromStore']) else [])
+
+
+def sourceFiles(endpointName: str, langs: List[str] = None, directory='latest') -> List[str]:
+    "The files a `load` of these wikis would read"
+    e = catalog(directory, refresh=False)[endpointName]
+    return [s['file'] for s in entrySources(e, e['langs'] if langs is None else langs)]
+
+
+def sourceSpans(endpointName: str, langs: List[str] = None,
+                directory='latest') -> Dict[str, Dict[str, str]]:
+    """For each file a `load` of these wikis would read, a hash of its manifest's entries per day
+    their responses start on (their `{start}`), for `firstChange`. A file without a manifest (the
+    consolidated store) is one span, from its first day, hashed by its size and mtime."""
+    e = catalog(directory, refresh=False)[endpointName]
+    out = {}
+    for s in entrySources(e, e['langs'] if langs is None else langs):
+        manifest = leveltoxarray.loadManifest(s['file'])
+        if not manifest:
+            out[os.path.basename(s['file'])] = {s['start'].replace('-', ''): str(s['stat'])}
+            continue
+        spans = {}
+        for key, digest in sorted(manifest.items()):
+            spans.setdefault(key.rsplit('/', 2)[1][:8], []).append(key + ' ' + digest)
+        out[os.path.basename(s['file'])] = {
+            start: leveltoxarray.valueHash('\n'.join(entries).encode())
+            for start, entries in spans.items()
+        }
+    return out
+
+
+def firstChange(old: Dict[str, Dict[str, str]], new: Dict[str, Dict[str, str]]):
+    """The earliest day whose data may differ between two `sourceSpans` (e.g., a saved result's and
+    the current ones), or None if none does"""
+    days = [
+        pd.Timestamp(start) for name in set(old) | set(new)
+        for start in set(old.get(name, {})) | set(new.get(name, {}))
+        if old.get(name, {}).get(start) != new.get(name, {}).get(start)
+    ]
+    return min(days) if days else None
+
+
+def contiguous(positions: List[int]) -> Union[slice, List[int]]:
+    "A slice if the positions are consecutive, which the NetCDF layer reads in one go"
+    if len(positions) and list(positions) == list(range(positions[0], positions[-1] + 1)):
+        return slice(positions[0], positions[-1] + 1)
+    return list(positions)
+
+
+def readSlice(task) -> np.ndarray:
+    "Read one hyperslab of one variable, summing out `reduce` dims; for `Query.compute`'s pool"
+    filename, variable, indexers, reduce = task
+    with xr.open_dataset(filename) as ds:
+        da = ds[variable].isel(**indexers)
+        if reduce:
+            return da.sum(reduce, dtype=np.int64).values
+        return da.values.astype(np.int64)
+
+
+class Query:
+    """A lazy selection from one endpoint, checked against the catalog but not read until
+    `compute`, e.g., `Query('edits', ['en.wikipedia'], slice('2016', '2017'), reduce=['pageType'],
+    editorType=['anonymous', 'user'])`.
+
+    `time` is a slice of dates (or a date); other dimensions are selected by keyword, with a scalar
+    dropping the dimension and a list keeping it; `reduce` dimensions are summed out as they're
+    read. Only the selected slices of each file (or of the consolidated store) are read."""
+
+    def __init__(self,
+                 endpointName: str,
+                 langs: List[str] = None,
+                 time=slice(None),
+                 reduce: List[str] = None,
+                 directory='latest',
+                 **selection):
+        entries = catalog(directory, refresh=False)
+        if endpointName not in entries:
+            raise ValueError('no {} in {}, only {}'.format(endpointName, directory, list(entries)))
+        e = self.entry = entries[endpointName]
+        if e['top']:
+            raise ValueError('top-by-edits is ragged, see `topindex.py` or `denseRankings`')
+        self.endpointName = endpointName
+        self.langs = e['langs'] if langs is None else list(langs)
+        missing = [lang for lang in self.langs if lang not in e['langs']]
+        if missing:
+            raise ValueError('{} has no {}'.format(endpointName, missing))
+        unknown = [dim for dim in list(selection) + list(reduce or []) if dim not in e['coords']]
+        if unknown:
+            raise ValueError('{} has no dimension {}, only {}'.format(endpointName, unknown,
+                                                                   list(e['coords'])))
+        self.indexers, self.coords = {}, {}
+        for dim in e['dims'][1:]:
+            values = e['coords'][dim]
+            wanted = selection.get(dim, values)
+            scalar = not isinstance(wanted, (list, tuple))
+            try:
+                positions = [values.index(v) for v in ([wanted] if scalar else wanted)]
+            except ValueError:
+                raise ValueError('{} must be some of {}'.format(dim, values))
+            self.indexers[dim] = positions[0] if scalar else contiguous(positions)
+            if not scalar:
+                self.coords[dim] = [values[i] for i in positions]
+        self.reduce = [dim for dim in reduce or [] if dim in self.coords]
+        for dim in self.reduce:
+            del self.coords[dim]
+
+        if not isinstance(time, slice):
+            time = slice(time, time)
+        sources = entrySources(e, self.langs)
+        starts = [pd.Timestamp(s['start']) for s in sources]
+        first = min(starts)
+        last = max(start + pd.Timedelta(days=s['days'] - 1) for start, s in zip(starts, sources))
+        self.time = pd.date_range(first, last).to_series()[time].index
+
+    def tasks(self, chunk=16) -> List[tuple]:
+        "What to read (`readSlice`'s arguments), and which output rows and days each fills"
+        e, out = self.entry, []
+        for i, lang in enumerate(self.langs):
+            if lang not in e['fromStore']:
+                out.append(([i], e['files'][lang], lang, {}))
+        fromStore = [i for i, lang in enumerate(self.langs) if lang in e['fromStore']]
+        storeLangs = e['store']['langs'] if e['store'] else []
+        for j in range(0, len(fromStore), chunk):
+            rows = fromStore[j:j + chunk]
+            lang = contiguous([storeLangs.index(self.langs[i]) for i in rows])
+            out.append((rows, e['store'], self.endpointName, dict(lang=lang)))
+        tasks = []
+        for rows, source, variable, indexers in out:
+            start = pd.Timestamp(source['start'])
+            a = max(0, (self.time[0] - start).days) if len(self.time) else 0
+            b = min(source['days'], (self.time[-1] - start).days + 1) if len(self.time) else 0
+            if b <= a:
+                continue
+            indexers = dict(indexers, time=slice(a, b), **self.indexers)
+            offset = (start + pd.Timedelta(days=a) - self.time[0]).days
+            tasks.append((rows, slice(offset, offset + b - a),
+                          (source['file'], variable, indexers, self.reduce)))
+        return tasks
+
+    def compute(self, workers=1) -> xr.DataArray:
+        "Read the selection, `workers` files (or store chunks) at a time, as `(lang, time, ...)`"
+        shape = [len(self.langs), len(self.time)] + [len(v) for v in self.coords.values()]
+        out = np.zeros(shape, dtype=np.int64)
+        tasks = self.tasks()
+        reads = [task for _, _, task in tasks]
+        if workers > 1 and len(reads) > 1:
+            with ProcessPoolExecutor(workers) as pool:
+                results = list(pool.map(readSlice, reads))
+        else:
+            results = map(readSlice, reads)
+        for (rows, days, _), result in zip(tasks, results):
+            out[rows, days] = result.reshape((len(rows), days.stop - days.start) + out.shape[2:])
+        coords = dict(lang=self.langs, time=self.time, **self.coords)
+        return xr.DataArray(out, coords=coords, dims=list(coords), name=self.endpointName)
+
+
+def load(endpointName: str,
+         langs: List[str] = None,
+         time=slice(None),
+         reduce: List[str] = None,
+         workers=1,
+         directory='latest',
+         **selection) -> xr.DataArray:
+    """An endpoint's `(lang, time, ...)` counts, zero-filled where a wiki has no data, reading only
+    what's selected: e.g., `load('editors', ['en.wikipedia', 'fr.wikipedia'], slice('2016', None),
+    editorType=['anonymous', 'user'], pageType='content', reduce=['activityLevel'])`. See
+    `Query`."""
+    return Query(endpointName, langs, time, reduce, directory, **selection).compute(workers)
+
+
+def dropEnd(da: xr.DataArray) -> xr.DataArray:
+    """A `load` that reaches the end of the data, without its last day: every response's `{end}` is
+    exclusive, so the day the ingest's time axis ends on is always zero-filled, not a count"""
+    return da.isel(time=slice(None, -1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update and print the catalog of ingested data')
+    parser.add_argument('--directory', default='latest')
+    args = parser.parse_args()
+    for name, e in sorted(catalog(args.directory).items()):
+        print('{}: {} wikis ({} from the consolidated store), dims {}'.format(
+            name, len(e['langs']), len(e['fromStore']), e['dims']))
+        for dim, values in e['coords'].items():
+            print('  {}: {}'.format(dim, ', '.join(map(str, values))))
@@ -0,0 +1,95 @@
+import numpy as np
+
+
+def prefixSums(x: np.ndarray, y: np.ndarray):
+    "Running Σx, Σy, Σxy, Σx², Σy² along the last axis, with a leading zero"
+    # Correlations ignore shifts, and centering keeps the running sums' round-off small
+    x = x - x.mean(-1, keepdims=True)
+    y = y - y.mean(-1, keepdims=True)
+    pad = lambda s: np.concatenate([np.zeros(s.shape[:-1] + (1, )), np.cumsum(s, -1)], -1)
+    return [pad(s) for s in (x, y, x * y, x * x, y * y)]
+
+
+def windowCorr(x, y, starts, ends, sums=None) -> np.ndarray:
+    """Pearson correlation of `x[..., s:e]` and `y[..., s:e]` for every (broadcast) pair of `starts`
+    and `ends`, in O(1) each. Result has shape `x.shape[:-1] + broadcast(starts, ends).shape`."""
+    sx, sy, sxy, sxx, syy = sums or prefixSums(np.asarray(x, dtype=float), np.asarray(y, float))
+    starts, ends = np.broadcast_arrays(starts, ends)
+    n = (ends - starts).astype(float)
+    d = lambda s: s[..., ends] - s[..., starts]
+    # Windows whose variance is lost in the running sums' round-off (e.g., days of all zeros before
+    # a wiki existed) are treated as constant
+    tol = lambda s: 1e-10 * s[..., -1].reshape(s.shape[:-1] + (1, ) * starts.ndim)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = d(sxy) - d(sx) * d(sy) / n
+        varx, vary = d(sxx) - d(sx)**2 / n, d(syy) - d(sy)**2 / n
+        ok = (n > 1) & (varx > tol(sxx)) & (vary > tol(syy))
+        return np.where(ok, np.clip(cov / np.sqrt(np.abs(varx * vary)), -1, 1), np.nan)
+
+
+def rollingCorr(x, y, windows) -> np.ndarray:
+    """Correlation of `x` and `y` over every window length in `windows`, ending (inclusive) on every
+    day, as a dense `(..., len(windows), N)` array, NaN where there isn't enough history."""
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    N = x.shape[-1]
+    windows = np.asarray(windows)[:, np.newaxis]
+    ends = np.arange(1, N + 1)
+    out = windowCorr(x, y, np.maximum(ends - windows, 0), ends)
+    return np.where(ends - windows >= 0, out, np.nan)
+
+
+def laggedRollingCorr(y, lag: int, windows) -> np.ndarray:
+    """For every window length `W` and day `d`, the correlation of the `W` days ending on `d` with
+    the `W` days ending `lag` days before, as `(..., len(windows), N)`, aligned with `y`'s days"""
+    y = np.asarray(y, dtype=float)
+    out = np.full(y.shape[:-1] + (len(windows), y.shape[-1]), np.nan)
+    out[..., lag:] = rollingCorr(y[..., lag:], y[..., :-lag], windows)
+    return out
+
+
+def corrScan(y, lag: int, nperseg=None, noverlap=None):
+    """Vectorized `slidingCorrScan` (with its default `nperseg2=2, noverlap2=1, finallen=1`).
+
+    Windows of `nperseg` days hopping by `nperseg - noverlap` form the first level, and each next
+    level merges neighboring windows of the previous one, so level `k` has windows `hop * k` days
+    longer (cut off at the end of the data). Returns `(corrs, lens, starts)`, each `(levels,
+    windows)` (`corrs` with `y`'s leading axes in front), row `k` being level `k`'s
+    `(corr, len, start)` tuples; cells past the end of a level have NaN correlation, zero length."""
+    y = np.asarray(y, dtype=float)
+    a = y[..., lag:]
+    b = y[..., :-lag]
+    L = a.shape[-1]
+    nperseg = nperseg or L // 8
+    noverlap = noverlap or nperseg // 2
+    hop = nperseg - noverlap
+    firsts = np.array([i for i in range(0, hop + L - nperseg, hop) if i < L])
+    levels = max(len(firsts), 1)
+    k = np.arange(levels)[:, np.newaxis]
+    j = np.arange(len(firsts))[np.newaxis, :]
+    valid = j < len(firsts) - k
+    starts = np.where(valid, hop * j, 0)
+    ends = np.where(valid, np.minimum(L, hop * (j + k) + nperseg), 0)
+    corrs = np.where(valid, windowCorr(a, b, starts, ends), np.nan)
+    return corrs, ends - starts, starts
+
+
+def scanHeatmap(corrs, lens, starts, lag: int) -> np.ndarray:
+    """Vectorized `lenStartToArrTail`: each level's correlations as a step function of window end
+    day (in `y`'s days, plus 365 days of padding), each day showing the next window to end"""
+    levels, windows = lens.shape
+    nvalid = (lens > 0).sum(-1)
+    width = lens[-1, 0] + 365
+    ends = np.where(lens > 0, starts + lag + lens, width)
+    # Day t of level k shows window j, where j is how many of level k's windows ended by t
+    marks = np.zeros((levels, width + 1), dtype=int)
+    np.add.at(marks, (np.repeat(np.arange(levels), windows), np.minimum(ends, width).ravel()), 1)
+    which = np.cumsum(marks, -1)[:, :width]
+    rows = np.arange(levels)[:, np.newaxis]
+    t = np.arange(width)
+    heat = corrs[..., rows, np.minimum(which, windows - 1)]
+    heat = np.where((which >= 1) & (which < nvalid[:, np.newaxis]), heat, np.nan)
+    # ...and the first window also fills one hop's worth of days before its end
+    hop = np.where(nvalid > 1, starts[:, 1 % windows] - starts[:, 0], 20)[:, np.newaxis]
+    end = np.minimum(width, ends[:, :1])
+    first = (t >= end - hop) & (t < end)
+    return np.where(first, corrs[..., :, :1], heat)
@@ -0,0 +1,142 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import argparse
+import glob
+import hashlib
+import json
+import os
+from typing import List
+import leveltoxarray
+import store
+
+ROLLUP_DIR = os.path.join('latest', 'rollups')
+MAX_BYTES = 256 << 20
+
+# Each rollup keeps these categories (summing over lists) of whichever of these dimensions an
+# endpoint has, then sums over all its other non-time dimensions, leaving one series per wiki
+ROLLUPS = {
+    'total': {},
+    'content': dict(pageType='content'),
+    'human': dict(editorType=['anonymous', 'user'], agent='user'),
+    'human-content': dict(pageType='content', editorType=['anonymous', 'user'], agent='user'),
+}
+
+
+def rollupFilename(endpointName: str, directory=ROLLUP_DIR) -> str:
+    return os.path.join(directory, endpointName + '.nc')
+
+
+def sourceFingerprint(filename: str) -> str:
+    "Hash of a per-wiki file's manifest (which changes whenever its contents do), else of its stat"
+    manifest = leveltoxarray.manifestFilename(filename)
+    h = hashlib.blake2b(digest_size=16)
+    if os.path.exists(manifest):
+        with open(manifest, 'rb') as f:
+            h.update(f.read())
+    else:
+        st = os.stat(filename)
+        h.update('{} {}'.format(st.st_size, st.st_mtime_ns).encode())
+    return h.hexdigest()
+
+
+def rollup(da: xr.DataArray, selection: dict) -> xr.DataArray:
+    da = da.sel(**{k: v for k, v in selection.items() if k in da.dims})
+    return da.sum([d for d in da.dims if d != 'time'], dtype=np.int64)
+
+
+def langRollups(filename: str, lang: str) -> xr.Dataset:
+    with xr.open_dataset(filename) as ds:
+        da = ds[lang].load()
+    return xr.Dataset({name: rollup(da, selection) for name, selection in ROLLUPS.items()})
+
+
+def evict(directory=ROLLUP_DIR, maxBytes=MAX_BYTES, keep=None):
+    "Delete the least-recently-used rollup files until the rest fit in `maxBytes`"
+    paths = sorted(glob.glob(os.path.join(directory, '*.nc')), key=os.path.getmtime, reverse=True)
+    total = 0
+    for path in paths:
+        total += os.path.getsize(path)
+        if total > maxBytes and path != keep:
+            os.remove(path)
+
+
+def refresh(endpointName: str,
+            langs: List[str] = None,
+            dataDirectory='latest',
+            directory=ROLLUP_DIR,
+            maxBytes=MAX_BYTES) -> xr.Dataset:
+    """Bring an endpoint's rollups for `langs` (default: every wiki it has files for) up to date and
+    return them as `(lang, time)` variables.
+
+    Only wikis whose per-wiki file changed since their rows were computed (per `sourceFingerprint`)
+    are re-read, so an up-to-date rollup costs a few small manifest reads instead of reducing every
+    wiki's full file. Rows for other wikis are kept. Each use counts as a use for `evict`. Returns
+    None if the endpoint has no files at all; asking for wikis it has no files for is an error."""
+    files = store.langFiles(endpointName, dataDirectory)
+    langs = sorted(files) if langs is None else langs
+    missing = [lang for lang in langs if lang not in files]
+    if missing:
+        raise ValueError('no {} files for {}'.format(endpointName, ', '.join(missing)))
+    if len(langs) == 0:
+        return None
+    current = {lang: sourceFingerprint(files[lang]) for lang in langs}
+    filename = rollupFilename(endpointName, directory)
+    cached, sources = None, {}
+    if os.path.exists(filename):
+        with xr.open_dataset(filename) as ds:
+            cached = ds.load()
+        sources = json.loads(cached.attrs['sources'])
+    stale = [lang for lang in langs if sources.get(lang) != current[lang]]
+
+    if stale:
+        fresh = xr.concat([langRollups(files[lang], lang) for lang in stale],
+                          pd.Index(stale, name='lang'))
+        kept = [lang for lang in sources if lang not in stale]
+        if kept:
+            fresh = xr.concat([cached.sel(lang=kept), fresh], 'lang', join='outer', fill_value=0)
+        cached = fresh.isel(lang=np.argsort(fresh['lang'].values))
+        sources.update({lang: current[lang] for lang in stale})
+        cached.attrs['sources'] = json.dumps(sources, sort_keys=True)
+        os.makedirs(directory, exist_ok=True)
+        # Other processes may be refreshing this same endpoint, so don't share a temporary file
+        tmp = '{}.{}'.format(filename, os.getpid())
+        cached.to_netcdf(tmp, encoding=leveltoxarray.compressedEncoding(cached))
+        os.replace(tmp, filename)
+        evict(directory, maxBytes, keep=filename)
+    elif cached is not None:
+        os.utime(filename)
+    return cached.sel(lang=langs)
+
+
+def load(endpointName: str, name='human-content', langs: List[str] = None,
+         **kwargs) -> xr.DataArray:
+    "One rollup (see `ROLLUPS`) of an endpoint as a `(lang, time)` DataArray, e.g., `load('edits')`"
+    ds = refresh(endpointName, langs, **kwargs)
+    if ds is None:
+        raise ValueError('no {} files'.format(endpointName))
+    return ds[name]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute per-wiki rollups of ingested data')
+    parser.add_argument(
+        'endpoints', nargs='*', help='e.g., edits editors (default: all but top-by-edits)')
+    parser.add_argument('--langs', nargs='+', help='only these wikis, e.g., en.wikipedia')
+    parser.add_argument(
+        '--max-mb', type=float, default=MAX_BYTES / 2**20, help='rollup cache size limit')
+    args = parser.parse_args()
+    names = args.endpoints or [
+        name for name in map(leveltoxarray.endpointName, leveltoxarray.endpoints.URLS)
+        if not name.endswith('top-by-edits')
+    ]
+    for name in names:
+        try:
+            ds = refresh(name, args.langs, maxBytes=int(args.max_mb * 2**20))
+        except ValueError as e:
+            print('{}, skipping'.format(e))
+            continue
+        if ds is None:
+            print('{}: no files, skipping'.format(name))
+            continue
+        print(rollupFilename(name), dict(ds.sizes))
@@ -0,0 +1,191 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import argparse
+import calendar
+import os
+from numpy.lib.stride_tricks import sliding_window_view
+from typing import Dict, List
+import query
+import spectra
+
+QUANTILES = (0.1, 0.5, 0.9)
+WEEKDAYS = list(calendar.day_name)  # Monday first, like `Timestamp.weekday`
+# Day-of-year slots: leap day is always slot 59 (Feb 29), so Mar 1 is always slot 60
+SLOTS = 366
+
+
+def nanQuantiles(x: np.ndarray, quantiles=QUANTILES, minCount=1) -> np.ndarray:
+    """`np.nanquantile(x, quantiles, axis=-1)` (linear interpolation) with one sort for every row
+    instead of a Python loop over them; NaN where a row has fewer than `minCount` numbers"""
+    s = np.sort(x, axis=-1)  # NaNs sort last
+    n = np.isfinite(x).sum(-1)
+    last = np.maximum(n - 1, 0)
+    out = []
+    for q in quantiles:
+        pos = q * last
+        lo = np.floor(pos).astype(np.intp)
+        hi = np.minimum(lo + 1, last)
+        a = np.take_along_axis(s, lo[..., None], -1)[..., 0]
+        b = np.take_along_axis(s, hi[..., None], -1)[..., 0]
+        out.append(np.where(n >= minCount, a + (b - a) * (pos - lo), np.nan))
+    return np.stack(out)
+
+
+def rollingMean(x: np.ndarray, n: int) -> np.ndarray:
+    "Centered `n`-day mean along the last axis, NaN unless all `n` days are numbers"
+    ok = np.isfinite(x)
+    zero = np.zeros(x.shape[:-1] + (1, ))
+    sums = np.concatenate([zero, np.cumsum(np.where(ok, x, 0), -1)], -1)
+    counts = np.concatenate([zero, np.cumsum(ok, -1)], -1)
+    mean = (sums[..., n:] - sums[..., :-n]) / n
+    mean[(counts[..., n:] - counts[..., :-n]) < n] = np.nan
+    out = np.full(x.shape, np.nan)
+    out[..., (n - 1) // 2:(n - 1) // 2 + mean.shape[-1]] = mean
+    return out
+
+
+def series(da: xr.DataArray) -> np.ndarray:
+    """`da`'s values with time last, as floats, NaN before each series' first non-zero day (before
+    the wiki existed, or before the API has data), so wikis can start on different days"""
+    x = da.values.astype(float)
+    x[np.cumsum(x != 0, axis=-1) == 0] = np.nan
+    return x
+
+
+def weekBlocks(x: np.ndarray, time: pd.DatetimeIndex):
+    "`x` (time last) as `(..., week, weekday)`, NaN-padded to Monday-to-Sunday weeks, and the weeks"
+    front, back = time[0].weekday(), 6 - time[-1].weekday()
+    pad = lambda n: np.full(x.shape[:-1] + (n, ), np.nan)
+    blocks = np.concatenate([pad(front), x, pad(back)], -1).reshape(x.shape[:-1] + (-1, 7))
+    weeks = pd.date_range(time[0] - pd.Timedelta(days=front), periods=blocks.shape[-2], freq='7D')
+    return blocks, weeks
+
+
+def yearBlocks(x: np.ndarray, time: pd.DatetimeIndex):
+    "`x` (time last) as `(..., year, slot)` (see `SLOTS`), NaN where there's no such day, and years"
+    years = np.arange(time[0].year, time[-1].year + 1)
+    slot = time.dayofyear.values - 1
+    slot[~time.is_leap_year & (slot >= 59)] += 1
+    blocks = np.full(x.shape[:-1] + (len(years), SLOTS), np.nan)
+    blocks[..., time.year.values - years[0], slot] = x
+    return blocks, years
+
+
+def rollingQuantiles(blocks: np.ndarray, window: int, quantiles=QUANTILES, minCount=1):
+    """Quantiles of each `(..., period, slot)` entry over the `window` periods ending with it (fewer
+    at the start), all periods at once: `(quantile, ..., period, slot)`"""
+    pad = np.full(blocks.shape[:-2] + (window - 1, blocks.shape[-1]), np.nan)
+    windows = sliding_window_view(np.concatenate([pad, blocks], -2), window, axis=-2)
+    return nanQuantiles(windows, quantiles, minCount)
+
+
+def weekdayProfile(da: xr.DataArray, weeks=52, quantiles=QUANTILES, minWeeks=8) -> xr.DataArray:
+    """Rolling weekday profile of every series of `da` (any dims, including `time`): for each week
+    and weekday, quantiles of that weekday's share of its week's mean over the last `weeks` full
+    weeks (at least `minWeeks` of them), as `(quantile, ..., week, weekday)`"""
+    da = da.transpose(..., 'time')
+    blocks, starts = weekBlocks(series(da), da.indexes['time'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = blocks / blocks.mean(-1, keepdims=True)
+    ratio[~np.isfinite(ratio)] = np.nan
+    dims = ('quantile', ) + da.dims[:-1] + ('week', 'weekday')
+    coords = {d: da.indexes[d] for d in da.dims[:-1] if d in da.indexes}
+    coords.update(quantile=list(quantiles), week=starts, weekday=WEEKDAYS)
+    return xr.DataArray(
+        rollingQuantiles(ratio, weeks, quantiles, minWeeks), coords=coords, dims=dims)
+
+
+def annualProfile(da: xr.DataArray, years=5, quantiles=QUANTILES, smooth=7) -> xr.DataArray:
+    """Rolling day-of-year profile of every series of `da`: for each year and day of it, quantiles
+    over the last `years` years of that day's `smooth`-day mean (which averages out weekdays) as a
+    share of the centered 365-day mean (which takes out the trend), as `(quantile, ..., year,
+    dayofyear)`. Leap day is filled in from its neighbors for years without one."""
+    da = da.transpose(..., 'time')
+    x = series(da)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = rollingMean(x, smooth) / rollingMean(x, 365)
+    ratio[~np.isfinite(ratio)] = np.nan
+    blocks, labels = yearBlocks(ratio, da.indexes['time'])
+    profile = rollingQuantiles(blocks, years, quantiles)
+    leap = profile[..., 59]
+    profile[..., 59] = np.where(np.isnan(leap), (profile[..., 58] + profile[..., 60]) / 2, leap)
+    dims = ('quantile', ) + da.dims[:-1] + ('year', 'dayofyear')
+    coords = {d: da.indexes[d] for d in da.dims[:-1] if d in da.indexes}
+    coords.update(quantile=list(quantiles), year=labels, dayofyear=np.arange(1, SLOTS + 1))
+    return xr.DataArray(profile, coords=coords, dims=dims)
+
+
+def profiles(da: xr.DataArray, weeks=52, years=5, quantiles=QUANTILES) -> xr.Dataset:
+    return xr.Dataset(
+        dict(
+            byWeekday=weekdayProfile(da, weeks, quantiles),
+            byDayOfYear=annualProfile(da, years, quantiles)))
+
+
+def deseasonalize(da: xr.DataArray, profile: xr.Dataset) -> xr.DataArray:
+    """`da` divided by the median weekday and annual profiles, using only earlier data: each week by
+    the weekday profile as of the week before, and each year by the annual profile as of the year
+    before. NaN where those don't exist yet."""
+    da = da.transpose(..., 'time')
+    time = da.indexes['time']
+    weekday = profile['byWeekday'].sel(quantile=0.5).transpose(..., 'week', 'weekday').values
+    annual = profile['byDayOfYear'].sel(quantile=0.5).transpose(..., 'year', 'dayofyear').values
+    starts = profile.indexes['week']
+    week = (time - pd.to_timedelta(time.weekday, 'D')).values
+    prevWeek = starts.get_indexer(week - np.timedelta64(7, 'D'))
+    prevYear = time.year.values - 1 - profile.indexes['year'][0]
+    slot = time.dayofyear.values - 1
+    slot[~time.is_leap_year & (slot >= 59)] += 1
+    w = np.where(prevWeek >= 0, weekday[..., prevWeek, time.weekday], np.nan)
+    a = np.where(prevYear >= 0, annual[..., np.maximum(prevYear, 0), slot], np.nan)
+    return da.copy(data=series(da) / w / a)
+
+
+def endpointProfiles(endpointNames: List[str],
+                     langs: List[str] = None,
+                     weeks=52,
+                     years=5,
+                     quantiles=QUANTILES,
+                     dataDirectory='latest',
+                     directory=spectra.CACHE_DIR) -> Dict[str, xr.Dataset]:
+    """Cached weekday and annual profiles of every wiki's total (all other dimensions summed) for
+    each endpoint, recomputed only when that endpoint's data or these parameters change"""
+    params = dict(weeks=weeks, years=years, quantiles=list(quantiles))
+    entries = query.catalog(dataDirectory)
+    out = {}
+    for name in endpointNames:
+        reduce = entries[name]['dims'][1:]
+        files = query.sourceFiles(name, langs, dataDirectory)
+        key = spectra.cacheKey([name, dataDirectory, langs], params, files=files)
+        # Only read the data if the profiles aren't cached
+        compute = lambda: profiles(
+            query.load(name, langs, reduce=reduce, directory=dataDirectory), weeks, years,
+            quantiles)
+        out[name] = spectra.cached('seasonal', key, compute, directory)
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Precompute (and cache) weekday and annual profiles of every wiki and endpoint')
+    parser.add_argument(
+        'endpoints', nargs='*', help='e.g., edits editors (default: all but top-by-edits)')
+    parser.add_argument('--langs', nargs='+', help='only these wikis, e.g., en.wikipedia')
+    parser.add_argument('--weeks', type=int, default=52, help='weeks per weekday profile')
+    parser.add_argument('--years', type=int, default=5, help='years per annual profile')
+    parser.add_argument('--directory', default='latest')
+    args = parser.parse_args()
+    names = args.endpoints or [
+        name for name, e in sorted(query.catalog(args.directory).items()) if not e['top']
+    ]
+    for name, ds in endpointProfiles(
+            names,
+            args.langs,
+            args.weeks,
+            args.years,
+            dataDirectory=args.directory,
+            directory=os.path.join(args.directory, 'cache')).items():
+        latest = ds['byWeekday'].sel(quantile=0.5).isel(week=-1).median('lang')
+        print('{}: median weekday share, latest year: {}'.format(
+            name, ', '.join('{} {:.2f}'.format(d[:3], float(v)) for d, v in zip(WEEKDAYS, latest))))
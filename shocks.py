@@ -0,0 +1,290 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import os
+from typing import List
+import leveltoxarray
+import query
+
+SHOCKS_FILE = os.path.join('latest', 'shocks.nc')
+# Annual correction: how far last year's same weekday (±1 week) was from its own baseline
+YEAR = 364
+
+
+# Days of history `robustZ` needs before the first day it scores: four weeks of baseline for each
+# of the four weeks of scale, and a year (and a week) before that for the annual correction
+LOOKBACK = YEAR + 7 + 28 + 28
+
+
+def median3(a, b, c):
+    return np.maximum(np.minimum(a, b), np.minimum(np.maximum(a, b), c))
+
+
+def median4(a, b, c, d):
+    "Elementwise, without `np.median`'s sorting: the sum less the smallest and largest, halved"
+    lo = np.minimum(np.minimum(a, b), np.minimum(c, d))
+    hi = np.maximum(np.maximum(a, b), np.maximum(c, d))
+    return (a + b + c + d - lo - hi) / 2
+
+
+def levels(counts: np.ndarray, started=False) -> np.ndarray:
+    """Signed log activity (time along axis 0) as float32, NaN before a series' first non-zero
+    day (before the wiki existed, or before the API has data), unless `started` (per series) says
+    that day came before these rows"""
+    x = np.asarray(counts, dtype=np.float32)
+    level = np.sign(x) * np.log1p(np.abs(x))
+    before = np.cumsum(np.nan_to_num(x) != 0, axis=0) == 0
+    level[before & ~np.asarray(started, dtype=bool)] = np.nan
+    return level
+
+
+def firstDays(totals: xr.DataArray, known: dict = None) -> dict:
+    """Each `(time, endpoint, lang)` series' first non-zero day, as `{endpoint: {lang: 'YYYY-MM-DD'
+    or None}}`, keeping the ones already `known` (from before these days)"""
+    nonzero = np.nan_to_num(totals.values) != 0
+    first = nonzero.argmax(0)
+    out = {}
+    for i, endpoint in enumerate(totals.indexes['endpoint']):
+        out[endpoint] = {}
+        for j, lang in enumerate(totals.indexes['lang']):
+            day = (known or {}).get(endpoint, {}).get(lang)
+            if day is None and nonzero[:, i, j].any():
+                day = str(totals.indexes['time'][first[i, j]].date())
+            out[endpoint][lang] = day
+    return out
+
+
+def robustZ(level: np.ndarray, days: int, floor=0.05) -> np.ndarray:
+    """Robust z-scores of the last `days` rows of `level` (time along axis 0, series along axis 1),
+    which needs `LOOKBACK` rows of history before them.
+
+    Each day's residual is its level minus the median of the same weekday over the last four
+    weeks (weekly seasonality and the local trend), minus the median of that residual a year (52
+    weeks, ±1) ago (annual seasonality: holidays, summers), once there's a year of history. It's
+    scaled by the median over the four weeks before of each week's mean absolute residual (times
+    1.2533, which makes that a standard deviation for Gaussian noise), so one bad week doesn't
+    inflate it, and by at least `floor`, about 5%, so flat series don't blow up. All medians are of
+    three or four values, so they're elementwise min/max, not sorts. Everything looks only
+    backwards, so a day's score never changes as later days arrive. NaN without enough history."""
+    n = level.shape[0]
+    base = np.full(level.shape, np.nan, dtype=np.float32)
+    if n > 28:
+        base[28:] = median4(*[level[28 - 7 * k:n - 7 * k] for k in range(1, 5)])
+    resid = level - base
+    annual = np.zeros(level.shape, dtype=np.float32)
+    if n > YEAR + 7:
+        lagged = [resid[YEAR + 7 - back:n - back] for back in (YEAR - 7, YEAR, YEAR + 7)]
+        annual[YEAR + 7:] = np.nan_to_num(median3(*lagged))
+    resid -= annual
+
+    # week[t]: mean absolute residual of the 7 days before t
+    start = n - days
+    absolute = np.abs(resid[start - 28:n - 1])
+    week = sum(absolute[k:k + days + 21] for k in range(7)) / 7
+    scale = 1.2533 * median4(*[week[21 - 7 * k:21 - 7 * k + days] for k in range(4)])
+    return resid[start:] / np.maximum(scale, floor)
+
+
+def scan(level: np.ndarray, first: int, chunk=180) -> np.ndarray:
+    """`robustZ` of rows `first` onwards, `chunk` days at a time (each with its own lookback), so
+    scratch memory is bounded by the chunk, not the history"""
+    out = np.full((level.shape[0] - first, ) + level.shape[1:], np.nan, dtype=np.float32)
+    need = LOOKBACK
+    for start in range(first, level.shape[0], chunk):
+        stop = min(start + chunk, level.shape[0])
+        if start < need:
+            # Not enough history for the first rows: pad them with NaN history
+            pad = np.full((need - start, ) + level.shape[1:], np.nan, dtype=np.float32)
+            block = np.concatenate([pad, level[:stop]])
+        else:
+            block = level[start - need:stop]
+        out[start - first:stop - first] = robustZ(block, stop - start)
+    return out
+
+
+def loadTotals(endpointNames: List[str], langs: List[str] = None, time=slice(None), workers=1,
+               directory='latest') -> xr.DataArray:
+    """Each endpoint's total per wiki (all its other dimensions summed), as `(time, endpoint,
+    lang)`, through each endpoint's last real day (`time` must reach the end of the data)"""
+    entries = query.catalog(directory)
+    totals = []
+    for name in endpointNames:
+        mine = entries[name]['langs'] if langs is None else [
+            lang for lang in langs if lang in entries[name]['langs']
+        ]
+        da = query.load(
+            name, mine, time, reduce=entries[name]['dims'][1:], workers=workers,
+            directory=directory)
+        totals.append(query.dropEnd(da).astype(np.float32).rename(None))
+    # Days outside an endpoint's files and wikis it lacks are missing, not zero
+    da = xr.concat(
+        totals, pd.Index(endpointNames, name='endpoint'), join='outer', fill_value=np.nan)
+    return da.transpose('time', 'endpoint', 'lang')
+
+
+def loadLevels(endpointNames: List[str], langs: List[str] = None, time=slice(None), workers=1,
+               directory='latest', firsts: dict = None):
+    """`loadTotals`' `levels`, and `firstDays`: a series whose first non-zero day (per `firsts`)
+    came before `time` is real zeros, not missing, at the start of it"""
+    da = loadTotals(endpointNames, langs, time, workers, directory)
+    firsts = firstDays(da, firsts)
+    start = str(da.indexes['time'][0].date())
+    started = np.array([[firsts[e][lang] is not None and firsts[e][lang] < start
+                         for lang in da.indexes['lang']]
+                        for e in da.indexes['endpoint']])
+    data = levels(da.values.reshape(da.shape[0], -1), started.ravel()).reshape(da.shape)
+    return da.copy(data=data), firsts
+
+
+def summarize(z: xr.DataArray, threshold=4.) -> xr.Dataset:
+    """Per day: the flag of each (endpoint, wiki), -1 for a drop below `-threshold` and 1 for a
+    spike above `threshold`, and how many wikis had a drop (or a spike) in any endpoint, out of
+    how many had any score"""
+    values = z.values
+    flag = np.where(np.abs(values) > threshold, np.sign(values), 0).astype(np.int8)
+    return xr.Dataset(
+        dict(
+            flag=(z.dims, flag),
+            drops=('time', (flag == -1).any(1).sum(1)),
+            spikes=('time', (flag == 1).any(1).sum(1)),
+            valid=('time', np.isfinite(values).any(1).sum(1))),
+        coords={d: z.indexes[d]
+                for d in z.dims})
+
+
+def shocks(endpointNames: List[str],
+           langs: List[str] = None,
+           threshold=4.,
+           chunk=180,
+           incremental=False,
+           workers=1,
+           filename=SHOCKS_FILE,
+           directory='latest') -> xr.Dataset:
+    """Score every (endpoint, wiki) series and count, per day, how many wikis moved together, saving
+    to `filename` (unless it's None), with the `query.sourceSpans` it was scored from beside it.
+
+    With `incremental`, only the last saved day and the days after it are scored, reading just their
+    lookback, plus every day from the earliest one whose data changed since (per `firstChange`,
+    e.g., a year fetched late), unless the parameters, endpoints, or wikis changed. Each series'
+    first non-zero day is saved too, so a lookback that starts with zeros isn't mistaken for days
+    before the wiki existed: the result is a full rescan's (see `checkIncremental`)."""
+    params = dict(threshold=threshold, endpoints=' '.join(endpointNames))
+    entries = query.catalog(directory)
+    sources = {}
+    for name in endpointNames:
+        mine = None if langs is None else [lang for lang in langs if lang in entries[name]['langs']]
+        sources[name] = query.sourceSpans(name, mine, directory)
+    old, time, firsts = None, slice(None), None
+    if incremental and filename and os.path.exists(filename):
+        with xr.open_dataset(filename) as ds:
+            if all(ds.attrs.get(k) == v for k, v in params.items()) and 'firsts' in ds.attrs:
+                old = ds.load()
+        saved = leveltoxarray.loadManifest(filename)
+        since = None
+        if old is not None and saved:
+            # The last saved day too, in case its data was incomplete
+            changes = [
+                query.firstChange(saved.get(name, {}), sources[name]) for name in endpointNames
+            ]
+            since = min([old.indexes['time'][-1]] + [c for c in changes if c is not None])
+        if since is None or since <= old.indexes['time'][0]:
+            old = None
+    if old is not None:
+        time = slice(since - pd.Timedelta(days=LOOKBACK), None)
+        # First non-zero days on or after `since` may have moved: find them again
+        day = str(since.date())
+        firsts = {
+            e: {lang: d if d is not None and d < day else None
+                for lang, d in v.items()}
+            for e, v in json.loads(old.attrs['firsts']).items()
+        }
+    da, firsts = loadLevels(endpointNames, langs, time, workers, directory, firsts)
+    if old is not None and list(da.indexes['lang']) != list(old.indexes['lang']):
+        old, time = None, slice(None)
+        da, firsts = loadLevels(endpointNames, langs, time, workers, directory)
+
+    skip = 0 if old is None else int(da.indexes['time'].searchsorted(since))
+    level = da.values.reshape(da.shape[0], -1)
+    z = scan(level, skip, chunk).reshape((-1, ) + da.shape[1:])
+    new = summarize(da.isel(time=slice(skip, None)).copy(data=z), threshold)
+    if old is not None:
+        new = xr.concat([old.sel(time=slice(None, since - pd.Timedelta(days=1))), new], 'time')
+    new.attrs = dict(params, firsts=json.dumps(firsts, sort_keys=True))
+    if filename:
+        leveltoxarray.saveAndMove(new, filename)
+        leveltoxarray.saveManifest(sources, filename)
+    return new
+
+
+def checkIncremental(ds: xr.Dataset, endpointNames: List[str], langs: List[str] = None,
+                     threshold=4., chunk=180, workers=1, directory='latest'):
+    "Raise unless `ds` (e.g., from an incremental run) is exactly what a full rescan gives"
+    full = shocks(endpointNames, langs, threshold, chunk, False, workers, None, directory)
+    if not full.indexes['time'].equals(ds.indexes['time']):
+        raise ValueError('incremental shocks cover different days than a full rescan')
+    bad = sum((full[v] != ds[v]).any([d for d in full[v].dims if d != 'time'])
+              for v in full.data_vars) > 0
+    if bad.any():
+        raise ValueError('incremental shocks differ from a full rescan on {} days, from {}'.format(
+            int(bad.sum()), full.indexes['time'][bad.values.argmax()].date()))
+    if not full.identical(ds):
+        raise ValueError("incremental shocks' attributes differ from a full rescan's")
+
+
+def topDays(ds: xr.Dataset, n=20, examples=5) -> pd.DataFrame:
+    "The days the most wikis dropped (or spiked) together, with the endpoints and wikis involved"
+    rows = []
+    for direction, sign in [('drop', -1), ('spike', 1)]:
+        count = ds['drops' if sign < 0 else 'spikes'].values
+        for i in np.argsort(-count, kind='stable')[:n]:
+            flagged = ds['flag'].values[i] == sign
+            byEndpoint = flagged.sum(1)
+            byLang = flagged.sum(0)
+            rows.append(
+                dict(
+                    date=ds.indexes['time'][i],
+                    direction=direction,
+                    wikis=int(count[i]),
+                    share=count[i] / max(int(ds['valid'][i]), 1),
+                    endpoints=', '.join(ds.indexes['endpoint'][j]
+                                        for j in np.argsort(-byEndpoint)[:3] if byEndpoint[j]),
+                    examples=', '.join(ds.indexes['lang'][j]
+                                       for j in np.argsort(-byLang)[:examples] if byLang[j])))
+    df = pd.DataFrame(rows)
+    return df.sort_values(['wikis', 'share'], ascending=False).head(n).reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Find days when many Wikipedias deviated from their usual activity at once')
+    parser.add_argument(
+        'endpoints',
+        nargs='*',
+        help='e.g., edits editors (default: all but top-by-edits and net bytes)')
+    parser.add_argument('--langs', nargs='+', help='only these wikis, e.g., en.wikipedia')
+    parser.add_argument('--threshold', type=float, default=4., help='robust z-score to flag')
+    parser.add_argument('--chunk', type=int, default=180, help='days to score at a time')
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='only score days after the saved ones, and ones whose data changed')
+    parser.add_argument('--top', type=int, default=20, help='print this many days')
+    parser.add_argument(
+        '--check', action='store_true', help='afterwards, check the result against a full rescan')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='files to read at once')
+    parser.add_argument('--directory', default='latest')
+    args = parser.parse_args()
+    # Net bytes changes cross zero, where log activity means nothing, so they're opt-in
+    names = args.endpoints or [
+        name for name, e in sorted(query.catalog(args.directory).items())
+        if not e['top'] and name != 'bytes-difference_net'
+    ]
+    ds = shocks(names, args.langs, args.threshold, args.chunk, args.incremental, args.workers,
+                os.path.join(args.directory, 'shocks.nc'), args.directory)
+    if args.check:
+        checkIncremental(ds, names, args.langs, args.threshold, args.chunk, args.workers,
+                         args.directory)
+        print('identical to a full rescan')
+    print(topDays(ds, args.top).to_string())
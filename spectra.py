@@ -0,0 +1,173 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import argparse
+import hashlib
+import json
+import os
+from scipy.signal import welch
+from typing import Callable, Dict, List
+import leveltoxarray
+import query
+import rollups
+
+CACHE_DIR = os.path.join('latest', 'cache')
+
+
+def slidingWindows(x: np.ndarray, segment: int, hop: int):
+    "Read-only `(..., windows, segment)` view of `x`'s last axis, and each window's start"
+    starts = np.arange(0, x.shape[-1] - segment + 1, hop)
+    shape = x.shape[:-1] + (len(starts), segment)
+    strides = x.strides[:-1] + (x.strides[-1] * hop, x.strides[-1])
+    return np.lib.stride_tricks.as_strided(x, shape, strides, writeable=False), starts
+
+
+def spectrogram(x, fs=365., segment=None, hop=None, **welchArgs):
+    """Welch spectrum of every `segment`-day window, every `hop` days, of every series along `x`'s
+    last axis, as `(freqs, starts, spectra)` with `spectra` shaped `(..., windows, freqs)`.
+
+    `welchArgs` go to `scipy.signal.welch`, which runs once over the whole strided block. The
+    default, one window covering everything, is just `welch`."""
+    x = np.ascontiguousarray(x, dtype=float)
+    segment = segment or x.shape[-1]
+    windows, starts = slidingWindows(x, segment, hop or segment)
+    freqs, spectra = welch(windows, fs=fs, axis=-1, **welchArgs)
+    return freqs, starts, spectra
+
+
+def cacheKey(source, params: dict, da: xr.DataArray = None, files: List[str] = None) -> str:
+    """Hash of where the data came from, the parameters applied to it, and either the
+    `rollups.sourceFingerprint`s of the `files` it's read from (so checking the cache reads just
+    their manifests, not the data) or, for a `da` with no files behind it, its time range and
+    contents, so changing any of those (e.g., after an incremental ingest) misses the cache"""
+    h = hashlib.blake2b(digest_size=16)
+    desc = dict(source=source, params=params)
+    if files is not None:
+        desc.update(files={f: rollups.sourceFingerprint(f) for f in files})
+    if da is not None:
+        desc.update(
+            dims=da.dims,
+            shape=da.shape,
+            time=[str(da['time'].values[0]), str(da['time'].values[-1])] if da['time'].size else [])
+    h.update(json.dumps(desc, sort_keys=True, default=str).encode())
+    if da is not None:
+        h.update(np.ascontiguousarray(da.values).tobytes())
+    return h.hexdigest()
+
+
+def cacheFilename(name: str, key: str, directory=CACHE_DIR) -> str:
+    return os.path.join(directory, '{}-{}.nc'.format(name, key))
+
+
+def cached(name: str, key: str, compute: Callable[[], xr.Dataset], directory=CACHE_DIR):
+    "Load `name`/`key`'s Dataset from the cache directory, or `compute` and save it there"
+    filename = cacheFilename(name, key, directory)
+    if os.path.exists(filename):
+        with xr.open_dataset(filename) as ds:
+            return ds.load()
+    ds = compute()
+    os.makedirs(directory, exist_ok=True)
+    leveltoxarray.saveAndMove(ds, filename)
+    return ds
+
+
+def toDataArray(da: xr.DataArray, freqs, starts, spectra) -> xr.DataArray:
+    "Label `spectrogram`'s output for the `(..., time)` DataArray `da`"
+    dims = da.dims[:-1] + ('start', 'frequency')
+    coords = {d: da.indexes[d] for d in da.dims[:-1] if d in da.indexes}
+    coords.update(start=da.indexes['time'][starts].values, frequency=freqs)
+    return xr.DataArray(spectra.astype(np.float32), coords=coords, dims=dims, name='spectrum')
+
+
+def welchSpectrogram(da: xr.DataArray,
+                     source,
+                     fs=365.,
+                     segment=None,
+                     hop=None,
+                     directory=CACHE_DIR,
+                     **welchArgs) -> xr.DataArray:
+    """Cached `spectrogram` of a DataArray with `time` as its last dimension, with dims `(...,
+    start, frequency)`. `source` is anything JSON-able that identifies the data (endpoint, wikis,
+    etc.) and goes into the cache key."""
+    params = dict(fs=fs, segment=segment, hop=hop, **welchArgs)
+    compute = lambda: toDataArray(
+        da, *spectrogram(da.values, fs, segment, hop, **welchArgs)).to_dataset()
+    return cached('welch', cacheKey(source, params, da), compute, directory)['spectrum']
+
+
+def endpointSpectrograms(endpointNames: List[str],
+                         langs: List[str] = None,
+                         fs=365.,
+                         segment=None,
+                         hop=None,
+                         dataDirectory='latest',
+                         directory=CACHE_DIR,
+                         batch=1024,
+                         **welchArgs) -> Dict[str, xr.DataArray]:
+    """Cached spectrograms of every sub-series of every wiki of every endpoint.
+
+    Endpoints whose spectrograms aren't cached yet are stacked into one `(series, time)` block
+    (aligned to a common time axis, zero-filled like the ingest) and Welch'd together, `batch`
+    series at a time to bound memory, then split back up and cached per endpoint."""
+    params = dict(fs=fs, segment=segment, hop=hop, **welchArgs)
+    query.catalog(dataDirectory)
+    out, todo = {}, {}
+    for name in endpointNames:
+        files = query.sourceFiles(name, langs, dataDirectory)
+        key = cacheKey([name, dataDirectory, langs], params, files=files)
+        filename = cacheFilename('welch', key, directory)
+        if os.path.exists(filename):
+            with xr.open_dataset(filename) as ds:
+                out[name] = ds['spectrum'].load()
+        else:
+            da = query.load(name, langs, directory=dataDirectory)
+            todo[name] = (key, da.transpose(*[d for d in da.dims if d != 'time'], 'time'))
+    if len(todo) == 0:
+        return out
+
+    time = pd.DatetimeIndex(sorted(set().union(*(da.indexes['time'] for _, da in todo.values()))))
+    block = np.concatenate([
+        da.reindex(time=time, fill_value=0).values.reshape(-1, len(time)) for _, da in todo.values()
+    ])
+    results = []
+    for i in range(0, len(block), batch):
+        freqs, starts, spectra = spectrogram(block[i:i + batch], fs, segment, hop, **welchArgs)
+        results.append(spectra.astype(np.float32))
+    spectra = np.concatenate(results)
+
+    row = 0
+    for name, (key, da) in todo.items():
+        da = da.reindex(time=time, fill_value=0)
+        rows = int(np.prod(da.shape[:-1]))
+        shaped = spectra[row:row + rows].reshape(da.shape[:-1] + spectra.shape[1:])
+        row += rows
+        spec = toDataArray(da, freqs, starts, shaped)
+        out[name] = cached('welch', key, spec.to_dataset, directory)['spectrum']
+    return {name: out[name] for name in endpointNames}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Precompute (and cache) Welch spectrograms of every wiki and endpoint')
+    parser.add_argument(
+        'endpoints', nargs='*', help='e.g., edits editors (default: all but top-by-edits)')
+    parser.add_argument('--langs', nargs='+', help='only these wikis, e.g., en.wikipedia')
+    parser.add_argument('--segment', type=int, default=3 * 365, help='days per spectrogram window')
+    parser.add_argument('--hop', type=int, default=365 // 4, help='days between windows')
+    parser.add_argument('--nperseg', type=int, default=365, help='days per Welch segment')
+    parser.add_argument('--nfft', type=int, default=1024)
+    args = parser.parse_args()
+    names = args.endpoints or [
+        name for name in map(leveltoxarray.endpointName, leveltoxarray.endpoints.URLS)
+        if not name.endswith('top-by-edits')
+    ]
+    spectra = endpointSpectrograms(
+        names,
+        args.langs,
+        segment=args.segment,
+        hop=args.hop,
+        nperseg=args.nperseg,
+        nfft=args.nfft,
+        detrend='linear')
+    for name, spec in spectra.items():
+        print(name, dict(spec.sizes))
@@ -0,0 +1,106 @@
+import plyvel
+import argparse
+import asyncio
+import random
+from aiohttp import web
+from typing import List
+import downloader
+import endpoints
+
+NOT_FOUND = {
+    'type': 'https://mediawiki.org/wiki/HyperSwitch/errors/not_found',
+    'title': 'Not found.',
+    'method': 'get',
+}
+UNKNOWN_ERROR = {
+    'type': 'https://mediawiki.org/wiki/HyperSwitch/errors/unknown_error',
+    'method': 'get',
+}
+
+
+def makeApp(db, prefix='/api/rest_v1', flaky=0., seed=None) -> web.Application:
+    """A stand-in for the Wikimedia REST API that replays the responses in a LevelDB (e.g., one
+    `downloader.py` already filled), for exercising the downloader without hitting the real server.
+
+    `prefix` plus the path after `endpoints.BASE_URL` is looked up in the LevelDB; keys it doesn't
+    have get a `not_found` 404, and a `flaky` fraction of requests get a 500 `unknown_error`."""
+    rng = random.Random(seed)
+    app = web.Application()
+    # A dict, since aiohttp doesn't want the app's own state changed once it's running
+    app['counts'] = counts = dict(requests=0)
+
+    async def handle(request):
+        counts['requests'] += 1
+        if rng.random() < flaky:
+            return web.json_response(dict(UNKNOWN_ERROR, uri=request.path), status=500)
+        value = db.get((endpoints.BASE_URL + request.path[len(prefix):]).encode('utf8'))
+        if value is None:
+            return web.json_response(dict(NOT_FOUND, uri=request.path), status=404)
+        return web.Response(body=value, content_type='application/json')
+
+    app.router.add_get(prefix + '/{tail:.*}', handle)
+    return app
+
+
+def compare(db, copy) -> List[bytes]:
+    "Keys whose values differ between two LevelDBs, or that only one of them has"
+    a, b = db.iterator(), copy.iterator()
+    x, y = next(a, None), next(b, None)
+    differ = []
+    while x or y:
+        if y is None or (x and x[0] < y[0]):
+            differ.append(x[0])
+            x = next(a, None)
+        elif x is None or y[0] < x[0]:
+            differ.append(y[0])
+            y = next(b, None)
+        else:
+            if x[1] != y[1]:
+                differ.append(x[0])
+            x, y = next(a, None), next(b, None)
+    return differ
+
+
+async def roundtrip(db, copy, flaky=0., seed=None, port=8080, concurrency=8, retries=5):
+    """Serve `db` from a stand-in on `port`, download every key it has into `copy` through it (fast,
+    but with `flaky` failures to retry), and return the download's counts and `compare`'s keys,
+    which should be none"""
+    runner = web.AppRunner(makeApp(db, flaky=flaky, seed=seed))
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        counts = await downloader.download(
+            copy, (key.decode('utf8') for key in db.iterator(include_value=False)),
+            concurrency=concurrency,
+            rate=1000.,
+            retries=retries,
+            backoff=0.01,
+            baseUrl='http://127.0.0.1:{}/api/rest_v1'.format(port))
+    finally:
+        await runner.cleanup()
+    return counts, compare(db, copy)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve canned Wikimedia responses from LevelDB')
+    parser.add_argument('--db', required=True, help='LevelDB of responses to replay')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--flaky', type=float, default=0., help='fraction of unknown_errors')
+    parser.add_argument(
+        '--roundtrip',
+        metavar='COPY_DB',
+        help='instead of serving, download all of --db into this (new) LevelDB and compare them')
+    args = parser.parse_args()
+    db = plyvel.DB(args.db, create_if_missing=False)
+    if args.roundtrip:
+        copy = plyvel.DB(args.roundtrip, create_if_missing=True, error_if_exists=True)
+        counts, differ = asyncio.run(roundtrip(db, copy, args.flaky, port=args.port))
+        copy.close()
+        db.close()
+        print(counts)
+        for key in differ[:10]:
+            print('differs:', key.decode('utf8'))
+        print('{} keys differ'.format(len(differ)) if differ else 'byte-identical')
+        raise SystemExit(1 if differ else 0)
+    print('Try `python downloader.py --base-url http://127.0.0.1:{}/api/rest_v1`'.format(args.port))
+    web.run_app(makeApp(db, flaky=args.flaky), host='127.0.0.1', port=args.port)
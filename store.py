@@ -0,0 +1,135 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import netCDF4
+import argparse
+import glob
+import os
+import re
+from typing import Dict, List
+import leveltoxarray
+
+
+def storeFilename(endpointName: str, directory='latest') -> str:
+    return os.path.join(directory, endpointName + '.nc')
+
+
+def langFiles(endpointName: str, directory='latest') -> Dict[str, str]:
+    "The per-wiki files `leveltoxarray` made for this endpoint, keyed by wiki"
+    pattern = re.compile(re.escape(endpointName) + r'__(.+)\.nc$')
+    names = map(os.path.basename, glob.glob(os.path.join(directory, '*.nc')))
+    matches = map(pattern.match, names)
+    return {m[1]: os.path.join(directory, m[0]) for m in matches if m}
+
+
+def layout(files: Dict[str, str], langs: List[str], top=False):
+    """The `(lang, time, ...)` coordinates that hold all these wikis' files (time is the union of
+    theirs) and a dtype that holds all their values, from only the files' headers"""
+    times, dtypes = [], []
+    for lang in langs:
+        with xr.open_dataset(files[lang]) as ds:
+            skeleton = ds[lang + '-count' if top else lang]
+            times.append(ds.indexes['time'])
+            dtypes.append(skeleton.dtype)
+    time = pd.date_range(min(t[0] for t in times), max(t[-1] for t in times))
+    coords = dict(lang=langs, time=time)
+    coords.update({dim: skeleton.indexes[dim] for dim in skeleton.dims[1:]})
+    return coords, np.result_type(*dtypes)
+
+
+def consolidate(endpointName: str,
+                langs: List[str] = None,
+                directory='latest',
+                complevel=4,
+                timeChunk=366,
+                entryChunk=1 << 16):
+    """Gather every wiki's file for an endpoint into one compressed, chunked NetCDF4 file, with
+    `lang` as a dimension.
+
+    Plain endpoints get one `(lang, time, ...)` variable named after the endpoint, chunked one wiki,
+    one category, and one year at a time, so reading a slice only decompresses that slice.
+    Top-by-edits keeps `TopRankings`' ragged layout, with rows now in (lang, time, ...) order and
+    `entryStart`/`pageStart` saying where each wiki's entries and page ids begin; see
+    `langRankings`. Wikis are written one at a time so memory stays at one wiki's worth."""
+    files = langFiles(endpointName, directory)
+    langs = sorted(files) if langs is None else langs
+    if len(langs) == 0:
+        return
+    top = endpointName.endswith('top-by-edits')
+
+    coords, dtype = layout(files, langs, top)
+    inner = {d: v for d, v in coords.items() if d != 'lang'}
+    dims = list(coords)
+    shape = tuple(map(len, coords.values()))
+
+    filename = storeFilename(endpointName, directory)
+    xr.Dataset(coords=coords).to_netcdf(filename + '2')
+    with netCDF4.Dataset(filename + '2', 'a') as nc:
+        compression = dict(zlib=complevel > 0, complevel=complevel, fill_value=False)
+        chunks = (1, min(timeChunk, len(coords['time']))) + (1, ) * (len(shape) - 2)
+        if not top:
+            var = nc.createVariable(endpointName, dtype, dims, chunksizes=chunks, **compression)
+            for i, lang in enumerate(langs):
+                with xr.open_dataset(files[lang]) as ds:
+                    var[i] = ds[lang].reindex(inner, fill_value=0).transpose(*dims[1:]).values
+        else:
+            nc.createDimension('entry', None)
+            nc.createDimension('pages', None)
+            count = nc.createVariable('count', np.uint8, dims, chunksizes=chunks, **compression)
+            entryStart = nc.createVariable('entryStart', np.int64, ('lang', ))
+            pageStart = nc.createVariable('pageStart', np.int64, ('lang', ))
+            edits = nc.createVariable(
+                'edits', np.int32, ('entry', ), chunksizes=(entryChunk, ), **compression)
+            page = nc.createVariable(
+                'page', np.int32, ('entry', ), chunksizes=(entryChunk, ), **compression)
+            pageId = nc.createVariable(
+                'page_id', np.int64, ('pages', ), chunksizes=(entryChunk, ), **compression)
+            e, p = 0, 0
+            for i, lang in enumerate(langs):
+                entryStart[i], pageStart[i] = e, p
+                with xr.open_dataset(files[lang]) as ds:
+                    # Time only ever grows at the end, so entries stay in row-major order
+                    count[i] = ds[lang + '-count'].reindex(
+                        inner, fill_value=0).transpose(*dims[1:]).values
+                    n, m = ds[lang].size, ds[lang + '-page_id'].size
+                    if n:
+                        edits[e:e + n] = ds[lang].values
+                        page[e:e + n] = ds[lang + '-page'].values.astype(np.int64) + p
+                    if m:
+                        pageId[p:p + m] = ds[lang + '-page_id'].values
+                e, p = e + n, p + m
+    os.rename(filename + '2', filename)
+    return filename
+
+
+def openStore(endpointName: str, directory='latest') -> xr.Dataset:
+    "Lazily open a consolidated store: only what you index (and then ask `.values` of) is read"
+    return xr.open_dataset(storeFilename(endpointName, directory))
+
+
+def langRankings(ds: xr.Dataset, lang: str) -> xr.Dataset:
+    "One wiki's top-by-edits from a consolidated store, in `TopRankings`' layout"
+    i = ds.indexes['lang'].get_loc(lang)
+    count = ds['count'].isel(lang=i).load()
+    entryStart = int(ds['entryStart'][i])
+    pageStart = int(ds['pageStart'][i])
+    pageEnd = int(ds['pageStart'][i + 1]) if i + 1 < ds.sizes['lang'] else ds.sizes['pages']
+    entries = slice(entryStart, entryStart + int(count.sum()))
+    return xr.Dataset({
+        lang + '-count': count.reset_coords('lang', drop=True),
+        lang: (lang + '-entry', ds['edits'][entries].values),
+        lang + '-page': (lang + '-entry', ds['page'][entries].values - pageStart),
+        lang + '-page_id': (lang + '-pages', ds['page_id'][pageStart:pageEnd].values),
+    })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Consolidate leveltoxarray's per-wiki files into one file per endpoint")
+    parser.add_argument(
+        'endpoints', nargs='*', help='e.g., edits edited-pages_new (default: all of them)')
+    parser.add_argument('--langs', nargs='+', help='only these wikis, e.g., en.wikipedia')
+    parser.add_argument('--complevel', type=int, default=4, help='zlib level, 0 for none')
+    args = parser.parse_args()
+    for name in args.endpoints or map(leveltoxarray.endpointName, leveltoxarray.endpoints.URLS):
+        print(consolidate(name, args.langs, complevel=args.complevel))
@@ -0,0 +1,318 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import netCDF4
+import json
+import os
+import shutil
+import itertools as it
+from contextlib import nullcontext
+import instrument
+import leveltoxarray as lx
+
+STREAM_DIR = os.path.join('latest', 'streaming')
+# `groupToDataset`'s files always cover at least these days (`endpointToDataset`'s default)
+DEFAULT_DAYS = pd.date_range('2001-01-01', '2018-01-01')
+
+
+def stagingDirectory(endpoint: str, language: str, directory=STREAM_DIR) -> str:
+    return os.path.join(directory, '{}__{}'.format(lx.endpointName(endpoint), language))
+
+
+def yearDays(year: int) -> pd.DatetimeIndex:
+    return pd.date_range('{}-01-01'.format(year), '{}-12-31'.format(year))
+
+
+def stampYears(stamps) -> np.ndarray:
+    return np.array([int(s[:4]) for s in stamps], dtype=np.int64)
+
+
+def fileStat(filename: str):
+    if not os.path.exists(filename):
+        return None
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def topYear(ds: xr.Dataset, language: str, year: int) -> xr.Dataset:
+    "One year of a saved top-by-edits file, still in its ragged layout (page codes unchanged)"
+    count = ds[language + '-count']
+    time = count.indexes['time']
+    rows = np.nonzero(time.year == year)[0]
+    if rows.size == 0:
+        return None
+    perDay = count.values.reshape(len(time), -1).sum(1, dtype=np.int64)
+    first = int(perDay[:rows[0]].sum())
+    entries = slice(first, first + int(perDay[rows].sum()))
+    return xr.Dataset({
+        language + '-count': count.isel(time=rows),
+        language: ds[language].isel({language + '-entry': entries}),
+        language + '-page': ds[language + '-page'].isel({language + '-entry': entries}),
+        language + '-page_id': ds[language + '-page_id'],
+    })
+
+
+class YearBuffers:
+    """The years of one (endpoint, wiki) group being ingested, each a year-long Dataset (or
+    `TopRankings`), so memory holds only the years touched since the last `flush`.
+
+    A year is loaded when a response first touches it: from its chunk in the staging directory if
+    an earlier flush wrote one, else from the group's existing file, else as zeros. `flush` writes
+    every loaded year back to its chunk (atomically) and forgets them."""
+
+    def __init__(self, endpoint: str, language: str, folder: str, previous: str = None):
+        self.endpoint = endpoint
+        self.language = language
+        self.folder = folder
+        self.previous = previous
+        self.top = endpoint.find('/top-by-edits/') >= 0
+        self.years = {}
+
+    def chunkFilename(self, year: int) -> str:
+        return os.path.join(self.folder, '{}.nc'.format(year))
+
+    def saved(self, year: int) -> xr.Dataset:
+        "A year as last written: its chunk, else the existing file's slice of it, else None"
+        chunk = self.chunkFilename(year)
+        if os.path.exists(chunk):
+            with xr.open_dataset(chunk) as ds:
+                return ds.load()
+        if self.previous:
+            with xr.open_dataset(self.previous) as ds:
+                if self.top:
+                    saved = topYear(ds, self.language, year)
+                    return None if saved is None else saved.load()
+                if (ds.indexes['time'].year == year).any():
+                    return ds.sel(time=str(year)).load()
+        return None
+
+    def load(self, year: int):
+        saved = self.saved(year)
+        days = yearDays(year)
+        if saved is not None:
+            # Only the time-indexed variables (not top-by-edits' entries) are reindexed
+            saved = saved.reindex(time=days, fill_value=0)
+        if self.top:
+            if saved is None:
+                return lx.TopRankings(self.endpoint, days)
+            return lx.TopRankings.fromDataset(self.endpoint, saved)
+        if saved is None:
+            return lx.endpointToDataset(self.endpoint, self.language, days)
+        return lx.widenDtypes(saved)
+
+    def get(self, year: int):
+        if year not in self.years:
+            self.years[year] = self.load(year)
+        return self.years[year]
+
+    def fill(self, key: bytes, args, extracted):
+        "Scatter one decoded response into the years its days fall in"
+        years = stampYears(extracted[0])
+        for year in np.unique(years):
+            mine = years == year
+            if self.top:
+                stamps, counts, edits, pageIds = extracted
+                entries = np.repeat(mine, counts)
+                self.get(year).fill(key, args, [s for s, m in zip(stamps, mine) if m],
+                                    np.asarray(counts)[mine],
+                                    np.asarray(edits)[entries],
+                                    np.asarray(pageIds)[entries])
+            else:
+                stamps, vals = extracted
+                lx.fillDataset(
+                    self.get(year), args, [s for s, m in zip(stamps, mine) if m],
+                    np.asarray(vals)[mine])
+
+    def nbytes(self) -> int:
+        if self.top:
+            return sum(year.nbytes() for year in self.years.values())
+        return sum(year.nbytes for year in self.years.values())
+
+    def flush(self):
+        for year, data in sorted(self.years.items()):
+            ds = data.toDataset() if self.top else data
+            lx.saveAndMove(lx.minimizeDtypes(ds), self.chunkFilename(year))
+        self.years = {}
+
+
+def loadCheckpoint(folder: str) -> dict:
+    try:
+        with open(os.path.join(folder, 'checkpoint.json'), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def saveCheckpoint(folder: str, checkpoint: dict):
+    filename = os.path.join(folder, 'checkpoint.json')
+    with open(filename + '2', 'w') as f:
+        json.dump(checkpoint, f, sort_keys=True)
+    os.rename(filename + '2', filename)
+
+
+def assemble(buffers: YearBuffers, time: pd.DatetimeIndex, filename: str):
+    """Write the group's file from its years, one year in memory at a time, in the same layout (and
+    dtypes) `groupToDataset` saves"""
+    lang = buffers.language
+    years = sorted(set(time.year))
+    dims, coords = lx.endpointCoords(buffers.endpoint, time)
+    shape = tuple(map(len, coords))
+    compression = dict(zlib=True, complevel=4)
+    chunks = (min(366, len(time)), ) + shape[1:]
+
+    def yearPart(year):
+        "This year's (time-sliced) counts or values, and for top-by-edits, each entry's page id"
+        ds = buffers.saved(year)
+        days = time[time.year == year]
+        var = lang + '-count' if buffers.top else lang
+        if ds is None:
+            none = np.zeros(0, dtype=np.int64)
+            return np.zeros((len(days), ) + shape[1:], dtype=np.int64), none, none
+        values = ds[var].reindex(time=days, fill_value=0).transpose(*dims).values
+        if not buffers.top:
+            return values, None, None
+        return values, ds[lang].values, ds[lang + '-page_id'].values[ds[lang + '-page'].values]
+
+    # First pass: the range of values (for `minimizeDtypes`' dtype) and every page id used
+    lo, hi, pageIds, entries = 0, 0, [], 0
+    for year in years:
+        values, edits, pages = yearPart(year)
+        target = edits if buffers.top else values
+        if target.size:
+            lo, hi = min(lo, int(target.min())), max(hi, int(target.max()))
+        if buffers.top:
+            pageIds.append(np.unique(pages))
+            entries += edits.size
+    pageIds = np.unique(np.concatenate(pageIds)) if pageIds else np.zeros(0, np.int64)
+
+    xr.Dataset(coords=dict(zip(dims, coords))).to_netcdf(filename + '2')
+    with netCDF4.Dataset(filename + '2', 'a') as nc:
+        if not buffers.top:
+            dtype = lx.smallestInt(np.array([lo, hi]))
+            var = nc.createVariable(lang, dtype, dims, chunksizes=chunks, **compression)
+        else:
+            ragged = lambda n: dict(chunksizes=(min(1 << 16, n), ), **compression) if n else {}
+            nc.createDimension(lang + '-entry', entries)
+            nc.createDimension(lang + '-pages', pageIds.size)
+            var = nc.createVariable(
+                lang + '-count', np.uint8, dims, chunksizes=chunks, **compression)
+            edits = nc.createVariable(
+                lang, lx.smallestInt(np.array([lo, hi])), (lang + '-entry', ), **ragged(entries))
+            page = nc.createVariable(
+                lang + '-page', lx.smallestInt(np.array([0, max(pageIds.size - 1, 0)])),
+                (lang + '-entry', ), **ragged(entries))
+            pageId = nc.createVariable(
+                lang + '-page_id', lx.smallestInt(pageIds), (lang + '-pages', ),
+                **ragged(pageIds.size))
+            if pageIds.size:
+                pageId[:] = pageIds
+        row, entry = 0, 0
+        for year in years:
+            values, yearEdits, pages = yearPart(year)
+            var[row:row + len(values)] = values
+            row += len(values)
+            if buffers.top and yearEdits.size:
+                edits[entry:entry + yearEdits.size] = yearEdits
+                page[entry:entry + yearEdits.size] = np.searchsorted(pageIds, pages)
+                entry += yearEdits.size
+    os.rename(filename + '2', filename)
+
+
+def streamGroup(group, incremental=False, profile=None, skipErrors=False,
+                maxMemory=256 * 2**20) -> dict:
+    """`groupToDataset`, but holding at most about `maxMemory` bytes of decoded data: years are
+    flushed to a staging directory whenever they add up to more, with a checkpoint (the last key
+    done and the manifest so far) after every flush. Rerunning after a crash seeks past the
+    checkpoint's last key (if the group can `seek`, as `groupedScan`'s can), so the keys before it
+    aren't read again (any that changed since wait for the next incremental run); when every key is
+    in, the group's file is assembled from the staged years, one year at a time, and the staging
+    directory is removed."""
+    endlang, iterator = group
+    endpoint = endlang['endpoint']
+    language = endlang['language']
+    stats = instrument.GroupStats(lx.endpointName(endpoint), language)
+    filename = lx.groupFilename(endpoint, language)
+    folder = stagingDirectory(endpoint, language)
+    exists = os.path.exists(filename)
+    if exists and not incremental:
+        stats.info['status'] = 'exists'
+        return stats.record()
+    checkpoint = loadCheckpoint(folder)
+    if checkpoint is None or checkpoint['previous'] != fileStat(filename):
+        shutil.rmtree(folder, ignore_errors=True)
+        checkpoint = dict(previous=fileStat(filename), lastKey=None, manifest={}, end=None)
+    else:
+        stats.info['resumedAfter'] = checkpoint['lastKey']
+        lastKey = checkpoint['lastKey'].encode('utf8')
+        if hasattr(iterator, 'seek'):
+            iterator.seek(lastKey)
+        # The group's first key was read before the seek
+        iterator = it.dropwhile(lambda kv: kv[0] <= lastKey, iterator)
+    # Keys done before a crash are in the checkpoint's manifest, so they're skipped like unchanged
+    manifest = dict(lx.loadManifest(filename) if exists else {}, **checkpoint['manifest'])
+    reader = instrument.Counted(iterator)
+    items = lx.changedItems(lx.dailyItems(reader), manifest)
+    first = next(items, None)
+    if first is None and checkpoint['lastKey'] is None:
+        stats.info['status'] = 'unchanged'
+        stats.counts['skipped'] = reader.keys
+        return stats.record(reader)
+
+    os.makedirs(folder, exist_ok=True)
+    buffers = YearBuffers(endpoint, language, folder, filename if exists else None)
+    top = buffers.top
+    profiler = instrument.profiler(*profile) if profile else None
+    end = pd.Timestamp(checkpoint['end']) if checkpoint['end'] else None
+    changed = 0
+    peak = 0
+
+    def flush():
+        with stats.phase('flush'):
+            buffers.flush()
+            checkpoint.update(manifest=manifest, end=end and str(end.date()))
+            saveCheckpoint(folder, checkpoint)
+        stats.counts['checkpoints'] += 1
+
+    for key, value, digest in (it.chain([first], items) if first else []):
+        changed += 1
+        with profiler or nullcontext():
+            try:
+                with stats.phase('decode'):
+                    decoded = lx.decodeResponse(key, value, top)
+            except ValueError as e:
+                if not skipErrors:
+                    raise
+                print('{}, skipping'.format(e))
+                stats.counts['errors'] += 1
+                continue
+            with stats.phase('fill'):
+                responseEnd = lx.responseEnd(key)
+                end = responseEnd if end is None else max(end, responseEnd)
+                if decoded:
+                    buffers.fill(key, *decoded)
+        stats.counts['notFound' if decoded is None else 'decoded'] += 1
+        manifest[key.decode('utf8')] = digest
+        checkpoint['lastKey'] = key.decode('utf8')
+        nbytes = buffers.nbytes()
+        peak = max(peak, nbytes)
+        if nbytes > maxMemory:
+            flush()
+    stats.counts['skipped'] = reader.keys - changed
+    if profiler:
+        if profile[0] == 'tracemalloc':
+            stats.counts['updatePeakBytes'] = profiler.takePeak()
+        profiler.dump()
+    flush()
+
+    with stats.phase('save'):
+        start, end = DEFAULT_DAYS[0], max(end, DEFAULT_DAYS[-1]) if end else DEFAULT_DAYS[-1]
+        if exists:
+            with xr.open_dataset(filename) as ds:
+                start = ds.indexes['time'][0]
+                end = max(end, ds.indexes['time'][-1])
+        assemble(buffers, pd.date_range(start, end), filename)
+        lx.saveManifest(manifest, filename)
+        shutil.rmtree(folder)
+    stats.counts['allocatedBytes'] = peak
+    stats.counts['fileBytes'] = os.path.getsize(filename)
+    return stats.record(reader)
@@ -0,0 +1,181 @@
+import plyvel
+import numpy as np
+import pandas as pd
+import argparse
+import itertools as it
+import json
+import os
+from typing import List
+import downloader
+import endpoints
+
+# The number each aggregate endpoint's results report
+RESULT_KEYS = {
+    'edited-pages/aggregate': 'edited_pages',
+    'edits/aggregate': 'edits',
+    'edited-pages/new': 'new_pages',
+    'editors/aggregate': 'editors',
+    'registered-users/new': 'new_registered_users',
+    'bytes-difference/net': 'net_bytes_diff',
+    'bytes-difference/absolute': 'abs_bytes_diff',
+}
+WIKILANGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wikilangs.json')
+# The API has no data before these
+FIRST_DAYS = {'pageviews/aggregate': '2015-07-01', 'unique-devices': '2016-01-01'}
+NOT_FOUND = json.dumps({
+    'type': 'https://mediawiki.org/wiki/HyperSwitch/errors/not_found',
+    'title': 'Not found.',
+    'method': 'get',
+})
+
+
+def wikiNames(n: int, filename=WIKILANGS) -> List[str]:
+    "The top `n` wikis by active users, padded with made-up ones if `wikilangs.json` runs out"
+    names = downloader.topProjects(n, filename) if os.path.exists(filename) else []
+    return names + ['x{}.wikipedia'.format(i) for i in range(n - len(names))]
+
+
+def urlArgs(url: str) -> tuple:
+    "The template, and its arguments (dash-case, as the API echoes them back), behind a URL"
+    parts = url[len(endpoints.BASE_URL):].split('/')
+    for template in endpoints.URLS:
+        tparts = template.split('/')
+        if len(parts) == len(tparts) and all(
+                t.startswith('{') or t == p for t, p in zip(tparts, parts)):
+            return template, dict(
+                (t[1:-1], p) for t, p in zip(tparts, parts) if t.startswith('{'))
+    raise ValueError('no template matches ' + url)
+
+
+class Generator:
+    """Realistic-looking fake Wikimedia responses: every wiki gets a log-normal size, every series a
+    trend, weekly seasonality, and noise; days go missing (as the API omits them) at `sparsity`,
+    whole responses are `not_found` at `notFound` (and always before the API has data), and
+    top-by-edits days have up to `topN` pages drawn from a Zipf-ish pool of `pages` page ids."""
+
+    def __init__(self, seed=0, sparsity=0.02, notFound=0.01, topN=100, pages=50000, z=True):
+        self.rng = np.random.RandomState(seed)
+        self.sparsity = sparsity
+        self.notFound = notFound
+        self.topN = topN
+        self.pages = pages
+        self.z = z
+        self.sizes = {}
+
+    def size(self, project: str) -> float:
+        if project not in self.sizes:
+            self.sizes[project] = np.exp(self.rng.normal(6, 1.5))
+        return self.sizes[project]
+
+    def days(self, args: dict, first=None) -> pd.DatetimeIndex:
+        "The days (or hours, for hourly responses) with data"
+        freq = 'H' if args.get('granularity') == 'hourly' else 'D'
+        days = pd.date_range(args['start'][:8], args['end'][:8], freq=freq)[:-1]
+        if first:
+            days = days[days >= first]
+        return days[self.rng.rand(len(days)) >= self.sparsity]
+
+    def counts(self, project: str, days: pd.DatetimeIndex, signed=False,
+               hourly=False) -> np.ndarray:
+        t = (days - pd.Timestamp('2001-01-01')).days.values
+        level = self.size(project) * self.rng.lognormal(0, 1) * (1 + t / 3000)
+        weekly = 1 + 0.15 * np.cos(2 * np.pi * (days.dayofweek.values - 2) / 7)
+        x = level * weekly * self.rng.lognormal(0, 0.2, len(days))
+        if hourly:
+            x *= (1 + 0.5 * np.cos(2 * np.pi * (days.hour.values - 15) / 24)) / 24
+        if signed:
+            x *= self.rng.choice([-1, 1], len(days), p=[0.2, 0.8])
+        return np.round(x).astype(np.int64)
+
+    def stamp(self, day: pd.Timestamp) -> str:
+        return day.strftime('%Y-%m-%dT00:00:00.000') + ('Z' if self.z else '')
+
+    def response(self, url: str) -> str:
+        template, args = urlArgs(url)
+        short = downloader.shortEndpoint(template)
+        first = FIRST_DAYS.get(short)
+        if self.rng.rand() < self.notFound or (first and args['end'][:8] <= first.replace('-', '')):
+            return NOT_FOUND
+        project = args['project']
+        meta = {k: v for k, v in args.items() if k not in ('start', 'end')}
+        days = self.days(args, first)
+
+        if short in FIRST_DAYS:
+            key = 'devices' if short == 'unique-devices' else 'views'
+            hourly = args['granularity'] == 'hourly'
+            # Daily pageviews are stamped at hour 00, daily unique devices with just the date
+            form = '%Y%m%d%H' if hourly or short != 'unique-devices' else '%Y%m%d'
+            items = [
+                dict(meta, timestamp=day.strftime(form), **{key: int(n)})
+                for day, n in zip(days, self.counts(project, days, hourly=hourly))
+            ]
+            return json.dumps(dict(items=items))
+
+        if short.endswith('top-by-edits'):
+            results = []
+            for day in days:
+                n = self.rng.randint(self.topN // 2, self.topN + 1)
+                ids = np.unique(self.rng.zipf(1.3, 3 * n) % self.pages)[:n]
+                edits = np.sort(self.rng.zipf(2, len(ids)))[::-1]
+                top = [
+                    dict(page_id=str(i), edits=int(e), rank=r + 1)
+                    for r, (i, e) in enumerate(zip(ids, edits))
+                ]
+                results.append(dict(timestamp=self.stamp(day), top=top))
+            return json.dumps(dict(items=[dict(meta, results=results)]))
+
+        key = RESULT_KEYS[short]
+        counts = self.counts(project, days, signed=key == 'net_bytes_diff')
+        results = [{'timestamp': self.stamp(day), key: int(n)} for day, n in zip(days, counts)]
+        return json.dumps(dict(items=[dict(meta, results=results)]))
+
+
+def generate(path: str, wikis=2, years=(2014, 2018), batchSize=500, hourly=False,
+             **kwargs) -> dict:
+    """Fill a new LevelDB at `path` with a fake response for every URL `downloader.py` would fetch
+    for `wikis` wikis over `years` (`[start, end)`), plus its `--hourly` ones if `hourly`, and
+    return how many keys and bytes it wrote"""
+    gen = Generator(**kwargs)
+    db = plyvel.DB(path, create_if_missing=True, error_if_exists=True)
+    keys = nbytes = 0
+    wb = db.write_batch()
+    projects = wikiNames(wikis)
+    urls = downloader.allUrls(range(*years), projects)
+    if hourly:
+        urls = it.chain(urls, downloader.allUrls(range(*years), projects, 'hourly'))
+    for url in urls:
+        value = gen.response(url).encode('utf8')
+        wb.put(url.encode('utf8'), value)
+        keys += 1
+        nbytes += len(value)
+        if keys % batchSize == 0:
+            wb.write()
+            wb = db.write_batch()
+    wb.write()
+    db.close()
+    return dict(keys=keys, bytes=nbytes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Make a LevelDB of fake Wikimedia responses')
+    parser.add_argument('db', help='new LevelDB directory')
+    parser.add_argument('--wikis', type=int, default=2, help='how many wikis')
+    parser.add_argument('--years', nargs=2, type=int, default=[2014, 2018], help='[start, end)')
+    parser.add_argument('--sparsity', type=float, default=0.02, help='fraction of days missing')
+    parser.add_argument('--not-found', type=float, default=0.01, help='fraction of not_founds')
+    parser.add_argument('--top', type=int, default=100, help='max pages per top-by-edits day')
+    parser.add_argument('--no-z', action='store_true', help="timestamps without a trailing 'Z'")
+    parser.add_argument('--hourly', action='store_true', help='also hourly pageviews and devices')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(
+        generate(
+            args.db,
+            args.wikis,
+            args.years,
+            hourly=args.hourly,
+            seed=args.seed,
+            sparsity=args.sparsity,
+            notFound=args.not_found,
+            topN=args.top,
+            z=not args.no_z))
@@ -0,0 +1,258 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import os
+import shutil
+from typing import Dict
+import endpoints
+import leveltoxarray
+import rollups
+import store
+
+INDEX_DIR = os.path.join('latest', 'topindex')
+ENDPOINT_NAME = 'edited-pages_top-by-edits'
+# One array per posting field, all in the same (page_id, wiki, day, editorType, pageType) order
+COLUMNS = dict(
+    wiki=np.int16, day=np.int32, editorType=np.uint8, pageType=np.uint8, rank=np.uint8,
+    edits=np.int32)
+
+
+def langPostings(filename: str, lang: str) -> Dict[str, np.ndarray]:
+    """Every entry of one wiki's ragged top-by-edits file as a posting: page id, day (since 1970),
+    editor and page type codes, rank (from 1), and edits, sorted by page id, day, and types"""
+    with xr.open_dataset(filename) as ds:
+        count = ds[lang + '-count'].load()
+        edits = ds[lang].values
+        pageIds = ds[lang + '-page_id'].values.astype(np.int64)[ds[lang + '-page'].values]
+    lengths = count.values.ravel().astype(np.intp)
+    rows = np.repeat(np.arange(lengths.size), lengths)
+    day, editorType, pageType = np.unravel_index(rows, count.shape)
+    days = count.indexes['time'].values.astype('datetime64[D]').astype(np.int64)
+    postings = dict(
+        pageId=pageIds,
+        day=days[day].astype(np.int32),
+        editorType=editorType.astype(np.uint8),
+        pageType=pageType.astype(np.uint8),
+        rank=(np.arange(rows.size) - np.repeat(leveltoxarray.rangeStarts(lengths), lengths) +
+              1).astype(np.uint8),
+        edits=edits.astype(np.int32))
+    order = np.lexsort((postings['pageType'], postings['editorType'], postings['day'], pageIds))
+    return {k: v[order] for k, v in postings.items()}
+
+
+def churn(postings: Dict[str, np.ndarray], firstDay: int, days: int) -> np.ndarray:
+    """How many pages are in each (day, editorType, pageType) top list that weren't the day before,
+    from postings sorted as `langPostings` sorts them"""
+    p = postings
+    order = np.lexsort((p['day'], p['pageId'], p['pageType'], p['editorType']))
+    day, et, pt, page = (p[k][order] for k in ['day', 'editorType', 'pageType', 'pageId'])
+    same = (et[1:] == et[:-1]) & (pt[1:] == pt[:-1]) & (page[1:] == page[:-1])
+    new = np.r_[True, ~(same & (day[1:] == day[:-1] + 1))]
+    out = np.zeros((days, len(endpoints.defaultCombinations['editorType']),
+                    len(endpoints.defaultCombinations['pageType'])),
+                   dtype=np.uint8)
+    np.add.at(out, (day[new] - firstDay, et[new], pt[new]), 1)
+    return out
+
+
+def build(files: Dict[str, str], directory=INDEX_DIR, sources: Dict[str, str] = None):
+    """Write the inverted index of these wikis' top-by-edits files (`{lang: filename}`) to
+    `directory`, one wiki in memory at a time.
+
+    Postings are grouped by page id: `pages` (sorted) and `offsets` say where each page's postings
+    are in the `COLUMNS` arrays, within which they're sorted by wiki, day, and types. `pairs` sums
+    up each (page, wiki) and `churn` is the daily churn of every top list. All are `.npy` files, so
+    `TopIndex` memory-maps them."""
+    langs = sorted(files)
+    # Pass 1: how many postings each page has, and the days spanned
+    uniques, counts, firstDay, lastDay = [], [], None, None
+    for lang in langs:
+        with xr.open_dataset(files[lang]) as ds:
+            pageIds = ds[lang + '-page_id'].values.astype(np.int64)
+            perPage = np.bincount(ds[lang + '-page'].values, minlength=pageIds.size)
+            time = ds.indexes['time']
+        uniques.append(pageIds)
+        counts.append(perPage)
+        days = time.values.astype('datetime64[D]').astype(np.int64)
+        firstDay = days[0] if firstDay is None else min(firstDay, days[0])
+        lastDay = days[-1] if lastDay is None else max(lastDay, days[-1])
+    pages, inverse = np.unique(np.concatenate(uniques or [np.zeros(0, np.int64)]),
+                               return_inverse=True)
+    perPage = np.bincount(inverse, np.concatenate(counts or [np.zeros(0)]), minlength=pages.size)
+    perPage = perPage.astype(np.int64)
+    offsets = np.r_[0, np.cumsum(perPage, dtype=np.int64)]
+    total = int(offsets[-1])
+
+    tmp = '{}.{}'.format(directory.rstrip(os.sep), os.getpid())
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, 'pages.npy'), pages)
+    np.save(os.path.join(tmp, 'offsets.npy'), offsets)
+    columns = {
+        name: np.lib.format.open_memmap(
+            os.path.join(tmp, name + '.npy'), mode='w+', dtype=dtype, shape=(total, ))
+        for name, dtype in COLUMNS.items()
+    }
+    ndays = 0 if firstDay is None else int(lastDay - firstDay + 1)
+    churns = np.lib.format.open_memmap(
+        os.path.join(tmp, 'churn.npy'),
+        mode='w+',
+        dtype=np.uint8,
+        shape=(len(langs), ndays, len(endpoints.defaultCombinations['editorType']),
+               len(endpoints.defaultCombinations['pageType'])))
+
+    # Pass 2: scatter each wiki's postings into its pages' slots, after earlier wikis'
+    filled = np.zeros(pages.size, dtype=np.int64)
+    pairs = []
+    for wiki, lang in enumerate(langs):
+        postings = langPostings(files[lang], lang)
+        page = np.searchsorted(pages, postings['pageId'])
+        starts = np.r_[0, np.nonzero(page[1:] != page[:-1])[0] + 1] if page.size else page
+        lengths = np.diff(np.r_[starts, page.size])
+        page = page[starts]
+        first = offsets[page] + filled[page]
+        destination = np.repeat(first - starts, lengths) + np.arange(postings['pageId'].size)
+        postings['wiki'] = np.full(destination.size, wiki, dtype=np.int16)
+        for name in COLUMNS:
+            columns[name][destination] = postings[name]
+        filled[page] += lengths
+        pairs.append(
+            dict(
+                page=page,
+                wiki=np.full(page.size, wiki, dtype=np.int16),
+                start=first,
+                count=lengths,
+                firstDay=postings['day'][starts],
+                lastDay=np.maximum.reduceat(postings['day'], starts) if starts.size else starts,
+                bestRank=np.minimum.reduceat(postings['rank'], starts) if starts.size else starts))
+        churns[wiki] = churn(postings, firstDay, ndays)
+    for column in list(columns.values()) + [churns]:
+        column.flush()
+    del columns, churns
+    pairs = {k: np.concatenate([p[k] for p in pairs]) for k in pairs[0]} if pairs else {}
+    order = np.argsort(pairs.get('start', np.zeros(0)), kind='stable')
+    for k, v in pairs.items():
+        np.save(os.path.join(tmp, 'pair-{}.npy'.format(k)), v[order])
+
+    meta = dict(
+        langs=langs,
+        editorTypes=endpoints.defaultCombinations['editorType'],
+        pageTypes=endpoints.defaultCombinations['pageType'],
+        firstDay=None if firstDay is None else str(np.datetime64(int(firstDay), 'D')),
+        postings=total,
+        sources=sources or {})
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f, sort_keys=True)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(tmp, directory)
+
+
+def refresh(directory=INDEX_DIR, dataDirectory='latest', force=False) -> bool:
+    "Rebuild the index if any wiki's top-by-edits file changed since it was built"
+    files = store.langFiles(ENDPOINT_NAME, dataDirectory)
+    if not files:
+        return False
+    sources = {lang: rollups.sourceFingerprint(filename) for lang, filename in files.items()}
+    try:
+        with open(os.path.join(directory, 'meta.json'), 'r') as f:
+            if json.load(f)['sources'] == sources and not force:
+                return False
+    except FileNotFoundError:
+        pass
+    build(files, directory, sources)
+    return True
+
+
+class TopIndex:
+    "Memory-mapped view of the index `build` wrote: lookups only touch the pages asked about"
+
+    def __init__(self, directory=INDEX_DIR):
+        with open(os.path.join(directory, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        load = lambda name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+        self.pages = load('pages')
+        self.offsets = load('offsets')
+        self.columns = {name: load(name) for name in COLUMNS}
+        self.pairs = {
+            k: load('pair-' + k)
+            for k in ['page', 'wiki', 'start', 'count', 'firstDay', 'lastDay', 'bestRank']
+        }
+        self.churns = load('churn')
+        self.langs = self.meta['langs']
+
+    def span(self, pageId: int) -> slice:
+        i = np.searchsorted(self.pages, pageId)
+        if i == self.pages.size or self.pages[i] != pageId:
+            return slice(0, 0)
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def frame(self, rows: slice) -> pd.DataFrame:
+        c = {name: np.asarray(column[rows]) for name, column in self.columns.items()}
+        return pd.DataFrame(
+            dict(
+                wiki=np.array(self.langs, dtype=object)[c['wiki']],
+                date=c['day'].astype('datetime64[D]'),
+                editorType=np.array(self.meta['editorTypes'], dtype=object)[c['editorType']],
+                pageType=np.array(self.meta['pageTypes'], dtype=object)[c['pageType']],
+                rank=c['rank'],
+                edits=c['edits']))
+
+    def postings(self, pageId: int, wiki: str = None) -> pd.DataFrame:
+        """Every (wiki, date, editorType, pageType) top list this page id was on, with its rank and
+        edits. Page ids are per wiki, so the same id on two wikis is two different pages."""
+        rows = self.span(pageId)
+        if wiki is not None:
+            codes = self.columns['wiki'][rows]
+            w = self.langs.index(wiki)
+            rows = slice(rows.start + int(np.searchsorted(codes, w)),
+                         rows.start + int(np.searchsorted(codes, w, side='right')))
+        return self.frame(rows)
+
+    def summary(self, wiki: str = None) -> pd.DataFrame:
+        "Per (page, wiki): how many top lists it was on, its first and last days, and best rank"
+        p = {k: np.asarray(v) for k, v in self.pairs.items()}
+        if wiki is not None:
+            mine = p['wiki'] == self.langs.index(wiki)
+            p = {k: v[mine] for k, v in p.items()}
+        return pd.DataFrame(
+            dict(
+                pageId=np.asarray(self.pages)[p['page']],
+                wiki=np.array(self.langs, dtype=object)[p['wiki']],
+                lists=p['count'],
+                first=p['firstDay'].astype('datetime64[D]'),
+                last=p['lastDay'].astype('datetime64[D]'),
+                bestRank=p['bestRank']))
+
+    def topPages(self, wiki: str, n=20) -> pd.DataFrame:
+        "The pages on the most top lists of a wiki"
+        return self.summary(wiki).nlargest(n, 'lists').reset_index(drop=True)
+
+    def churn(self, wiki: str) -> xr.DataArray:
+        "`(time, editorType, pageType)` counts of pages in a day's top list but not the last day's"
+        da = np.asarray(self.churns[self.langs.index(wiki)])
+        return xr.DataArray(
+            da,
+            coords=dict(
+                time=pd.date_range(self.meta['firstDay'], periods=da.shape[0]),
+                editorType=self.meta['editorTypes'],
+                pageType=self.meta['pageTypes']),
+            dims=['time', 'editorType', 'pageType'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or query the top-by-edits page index')
+    parser.add_argument('--page', type=int, help='print every top list this page id was on')
+    parser.add_argument('--wiki', help='just this wiki, e.g., en.wikipedia')
+    parser.add_argument('--top', type=int, help='print the pages on the most top lists of --wiki')
+    parser.add_argument('--rebuild', action='store_true', help="even if sources haven't changed")
+    args = parser.parse_args()
+
+    if args.rebuild or (args.page is None and args.top is None):
+        print('rebuilt' if refresh(force=args.rebuild) else 'up to date')
+    index = TopIndex()
+    if args.page is not None:
+        print(index.postings(args.page, args.wiki).to_string())
+    if args.top is not None:
+        print(index.topPages(args.wiki, args.top).to_string())
@@ -0,0 +1,159 @@
+import xarray as xr
+import numpy as np
+import pandas as pd
+import argparse
+import os
+from scipy.stats import chi2
+from scipy.special import xlogy
+from typing import Dict
+import leveltoxarray
+import query
+
+
+def losses(x: np.ndarray) -> np.ndarray:
+    """Day-over-day drop in (signed) log activity, along axis 0, as float32. Days before a series'
+    first non-zero value (before the wiki existed, or before the API has data) are NaN."""
+    x = np.asarray(x, dtype=np.float32)
+    level = np.sign(x) * np.log1p(np.abs(x))
+    out = np.full(x.shape, np.nan, dtype=np.float32)
+    out[1:] = level[:-1] - level[1:]
+    started = np.cumsum(x != 0, axis=0) > 0
+    out[1:][~started[:-1]] = np.nan
+    return out
+
+
+def onlineVar(loss: np.ndarray, alpha=0.95, halflife=90, warmup=60) -> np.ndarray:
+    """Each day's `alpha`-quantile forecast of `loss` (time along axis 0, any number of series
+    along the others), using only the days before it.
+
+    Instead of re-sorting a trailing window every day, each series keeps one running quantile
+    estimate that is nudged up by `alpha` steps when a day exceeds it and down by `1 - alpha`
+    steps otherwise, which balances exactly at the `alpha` quantile. Steps are scaled by a running
+    mean absolute deviation (so they're unit-free) and decay like a running mean until they reach
+    the `halflife`-day exponential forgetting rate. That's O(1) per series per day, and every day
+    is one vectorized update of all series at once. NaN losses are skipped, and a series' first
+    `warmup` valid days get no forecast."""
+    loss = np.asarray(loss, dtype=np.float32)
+    shape = loss.shape[1:]
+    out = np.full(loss.shape, np.nan, dtype=np.float32)
+    lam = 1 - 0.5**(1 / halflife)
+    q = np.zeros(shape, dtype=np.float32)
+    s = np.zeros(shape, dtype=np.float32)
+    n = np.zeros(shape, dtype=np.int64)
+    for t in range(loss.shape[0]):
+        x = loss[t]
+        ok = np.isfinite(x)
+        out[t] = np.where(n >= warmup, q, np.nan)
+        n += ok
+        q = np.where(ok & (n == 1), x, q)
+        x = np.where(ok, x, q)
+        step = np.where(ok, np.maximum(lam, 1 / np.maximum(n, 1)), 0).astype(np.float32)
+        s += step * (np.abs(x - q) - s)
+        q += step * s * (alpha - (x <= q)) / (1 - alpha)
+    return out
+
+
+def breakStats(breaks: np.ndarray, valid: np.ndarray, alpha=0.95) -> Dict[str, np.ndarray]:
+    """Backtest statistics of VaR breaks (time along axis 0) over days where `valid`.
+
+    Kupiec's proportion-of-failures likelihood ratio tests whether breaks happen `1 - alpha` of the
+    time; Christoffersen's tests whether a break today makes one tomorrow more or less likely (i.e.,
+    whether breaks clump); their sum tests both ("conditional coverage"). Each comes with its
+    chi-squared p-value."""
+    b = breaks & valid
+    days = valid.sum(0)
+    count = b.sum(0)
+    p = 1 - alpha
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = count / days
+        kupiec = -2 * (xlogy(days - count, 1 - p) + xlogy(count, p) -
+                       xlogy(days - count, 1 - rate) - xlogy(count, rate))
+
+        # Transitions between consecutive valid days
+        pair = valid[1:] & valid[:-1]
+        n = {(i, j): ((b[:-1] == i) & (b[1:] == j) & pair).sum(0) for i in (0, 1) for j in (0, 1)}
+        n0, n1 = n[0, 0] + n[0, 1], n[1, 0] + n[1, 1]
+        pi01, pi11 = n[0, 1] / n0, n[1, 1] / n1
+        pi = (n[0, 1] + n[1, 1]) / (n0 + n1)
+        christoffersen = -2 * (xlogy(n[0, 0] + n[1, 0], 1 - pi) + xlogy(n[0, 1] + n[1, 1], pi) -
+                               xlogy(n[0, 0], 1 - pi01) - xlogy(n[0, 1], pi01) -
+                               xlogy(n[1, 0], 1 - pi11) - xlogy(n[1, 1], pi11))
+    kupiec = np.where(days > 0, np.maximum(kupiec, 0), np.nan)
+    christoffersen = np.where(n0 + n1 > 0, np.maximum(np.nan_to_num(christoffersen), 0), np.nan)
+    return dict(
+        days=days,
+        breakCount=count,
+        kupiec=kupiec,
+        kupiecP=chi2.sf(kupiec, 1),
+        christoffersen=christoffersen,
+        christoffersenP=chi2.sf(christoffersen, 1),
+        conditionalP=chi2.sf(kupiec + christoffersen, 2))
+
+
+def war(series: Dict[str, xr.DataArray], alpha=0.95, halflife=90,
+        warmup=60) -> Dict[str, xr.Dataset]:
+    """Daily `alpha` WaR and its backtest for every sub-series of every endpoint in `series`
+    (`query.load`'s output without its zero-filled end day, see `query.dropEnd`, keyed by endpoint
+    name), all in one batch. That day would otherwise be a break for every series.
+
+    Each endpoint's Dataset has, along `(time, lang, ...)`, `war` (the day's VaR of the drop in log
+    activity), `floor` (the count that breaks it: the best of the worst `1 - alpha` days), and
+    `breaks`; and along `(lang, ...)`, `breakStats`' statistics for each series."""
+    time = pd.DatetimeIndex(sorted(set().union(*(da.indexes['time'] for da in series.values()))))
+    blocks = {}
+    for name, da in series.items():
+        da = da.transpose('time', *[d for d in da.dims if d != 'time'])
+        blocks[name] = da.reindex(time=time).values.reshape(len(time), -1).astype(np.float32)
+    counts = np.concatenate(list(blocks.values()), 1)
+    loss = losses(counts)
+    var = onlineVar(loss, alpha, halflife, warmup)
+    valid = np.isfinite(var) & np.isfinite(loss)
+    breaks = valid & (loss > var)
+    stats = breakStats(breaks, valid, alpha)
+    prev = np.concatenate([np.full((1, ) + counts.shape[1:], np.nan, np.float32), counts[:-1]])
+    level = np.sign(prev) * np.log1p(np.abs(prev)) - var
+    floor = np.sign(level) * np.expm1(np.abs(level))
+
+    out = {}
+    col = 0
+    for name, da in series.items():
+        da = da.transpose('time', *[d for d in da.dims if d != 'time']).reindex(time=time)
+        cols = slice(col, col + blocks[name].shape[1])
+        col = cols.stop
+        dims, coords = da.dims, {d: da.indexes[d] for d in da.dims}
+        full = lambda arr: (dims, arr[:, cols].reshape(da.shape))
+        perSeries = lambda arr: (dims[1:], arr[cols].reshape(da.shape[1:]))
+        data = dict(war=full(var), floor=full(floor), breaks=full(breaks))
+        data.update({k: perSeries(v) for k, v in stats.items()})
+        out[name] = xr.Dataset(
+            data, coords=coords, attrs=dict(alpha=alpha, halflife=halflife, warmup=warmup))
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Daily WaR and backtest for every wiki, endpoint, and sub-series')
+    parser.add_argument(
+        'endpoints', nargs='*', help='e.g., edits editors (default: all but top-by-edits)')
+    parser.add_argument('--langs', nargs='+', help='only these wikis, e.g., en.wikipedia')
+    parser.add_argument('--alpha', type=float, default=0.95, help='VaR probability')
+    parser.add_argument('--halflife', type=float, default=90, help='days of memory')
+    parser.add_argument('--warmup', type=int, default=60, help='days before the first forecast')
+    parser.add_argument('--directory', default='latest')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='files to read at once')
+    args = parser.parse_args()
+    names = args.endpoints or [
+        name for name in map(leveltoxarray.endpointName, leveltoxarray.endpoints.URLS)
+        if not name.endswith('top-by-edits')
+    ]
+    series = {
+        name: query.dropEnd(
+            query.load(name, args.langs, workers=args.workers, directory=args.directory))
+        for name in names
+    }
+    for name, ds in war(series, args.alpha, args.halflife, args.warmup).items():
+        filename = os.path.join(args.directory, 'war-' + name + '.nc')
+        leveltoxarray.saveAndMove(ds, filename)
+        print('{}: {:.1%} of days break, Kupiec passes {:.0%}, Christoffersen passes {:.0%}'.format(
+            filename, float(ds['breakCount'].sum() / ds['days'].sum()),
+            float((ds['kupiecP'] > 0.05).mean()), float((ds['christoffersenP'] > 0.05).mean())))